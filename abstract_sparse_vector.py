@@ -1,7 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from abc import ABCMeta
+from collections import deque
+from contextlib import contextmanager
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
+import io
+import os
+import gc
 import sys
+import threading
+import traceback
+import zlib
+import instrumentation
 
 class AbstractSparseVector:
     '''
@@ -150,3 +161,301 @@ class AbstractSparseVector:
         '''
         return self.dict
 
+
+@contextmanager
+def _gc_paused():
+    '''
+    Disables the cyclic garbage collector while loading, which would otherwise run over and over as millions of
+    entries are allocated.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _read_lines(in_file, jobs=1, block_size=1 << 22, progress=None):
+    '''
+    Reads a plain or gz file in large blocks and yields its lines block by block. The gz file may consist of several
+    members, as written by concatenating gz files or by parallel compressors; with jobs larger than 1 the members
+    are decompressed in parallel threads, as zlib does not hold the interpreter lock while inflating, and at most
+    a few regions of block_size compressed bytes are held in memory at a time.
+
+    :param in_file: the file to be read
+    :param jobs: the number of decompression threads
+    :param block_size: the number of bytes read at once
+    :param progress: a function called with the number of bytes of the file read so far and the file size
+    :return: a generator of lists of lines, without line endings
+    '''
+    total = os.path.getsize(in_file)
+    f = open(in_file, "rb")
+    gz = f.read(2) == "\x1f\x8b"
+    f.seek(0)
+    if not gz:
+        blocks = _plain_blocks(f, block_size)
+    elif jobs > 1:
+        blocks = _gunzip_parallel(in_file, f, jobs, block_size)
+    else:
+        blocks = _gunzip(f, block_size)
+    rest = ""
+    try:
+        for block, done in blocks:
+            lines = (rest + block).split("\n")
+            rest = lines.pop()
+            if instrumentation.enabled:
+                instrumentation.count("io.bytes_read", len(block))
+                instrumentation.count("io.lines_read", len(lines))
+            yield lines
+            if progress is not None:
+                progress(done, total)
+        if rest:
+            instrumentation.count("io.lines_read")
+            yield [rest]
+    finally:
+        f.close()
+
+
+def _plain_blocks(f, block_size):
+    '''
+    :param f: a file opened in binary mode
+    :param block_size: the number of bytes read at once
+    :return: a generator of (block, bytes read so far) pairs
+    '''
+    for block in iter(lambda: f.read(block_size), ""):
+        yield block, f.tell()
+
+
+def _gunzip(f, block_size, start=0):
+    '''
+    Decompresses all members of a gz file one after the other.
+
+    :param f: a gz file opened in binary mode
+    :param block_size: the number of compressed bytes read at once
+    :param start: the offset of the first member
+    :return: a generator of (decompressed block, bytes read so far) pairs
+    '''
+    f.seek(start)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for raw in iter(lambda: f.read(block_size), ""):
+        while raw:
+            block = d.decompress(raw)
+            # data after the end of a member is not consumed, it starts the next member
+            raw = d.unused_data
+            if raw:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if raw.strip("\x00") == "":
+                    raw = ""
+            yield block, f.tell()
+
+
+def _gunzip_parallel(in_file, f, jobs, block_size):
+    '''
+    Splits a gz file at likely member headers into regions of about block_size bytes that are decompressed in
+    parallel threads, each reading its region from a file handle of its own. The headers are searched while the
+    file is read, at most two regions per thread ahead of the caller. A region is only accepted if its members end
+    exactly where the next region starts, so a header pattern inside compressed data is detected; from the first
+    rejected region on, the file is decompressed sequentially.
+
+    :param in_file: the gz file
+    :param f: the gz file opened in binary mode, used to search the headers and to decompress sequentially
+    :param jobs: the number of threads
+    :param block_size: the number of compressed bytes per region, fewer for files of less than 4 regions per thread
+    :return: a generator of (decompressed block, bytes read so far) pairs
+    '''
+    total = os.path.getsize(in_file)
+
+    def inflate(region):
+        (start, end) = region
+        g = open(in_file, "rb")
+        try:
+            g.seek(start)
+            # one byte more than the region, so that a member ending exactly at the region's end leaves unused data
+            raw = g.read(end - start + 1)
+        finally:
+            g.close()
+        if end == total:
+            raw += "\x00"
+        blocks = []
+        try:
+            while len(raw) > 1:
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                blocks.append(d.decompress(raw))
+                if not d.unused_data:
+                    return None
+                raw = d.unused_data
+        except zlib.error:
+            return None
+        return "".join(blocks)
+
+    regions = _member_regions(f, total, max(1, min(block_size, total // (jobs * 4))))
+    pool = ThreadPool(jobs)
+    try:
+        pending = deque()
+        while True:
+            for region in islice(regions, 2 * jobs - len(pending)):
+                pending.append((region, pool.apply_async(inflate, (region,))))
+            if not pending:
+                return
+            ((start, end), result) = pending.popleft()
+            block = result.get()
+            if block is None:
+                for block, done in _gunzip(f, block_size, start):
+                    yield block, done
+                return
+            yield block, end
+    finally:
+        pool.terminate()
+
+
+def _member_regions(f, total, step, size=1 << 16):
+    '''
+    Finds the first likely gz member header at or after every multiple of step, reading the file in chunks.
+
+    :param f: a gz file opened in binary mode
+    :param total: the size of the file
+    :param step: the distance between the offsets the search starts from
+    :param size: the number of bytes read at once
+    :return: a generator of (start, end) offset pairs that cover the file
+    '''
+    start = 0
+    while True:
+        offset = (start // step + 1) * step
+        found = -1
+        # the last two bytes of a chunk are searched again with the next one, for a header spanning both
+        tail = ""
+        f.seek(offset)
+        while found == -1 and offset < total:
+            chunk = tail + f.read(size)
+            found = chunk.find("\x1f\x8b\x08")
+            if found != -1:
+                found += offset - len(tail)
+            elif len(chunk) == len(tail):
+                break
+            offset += len(chunk) - len(tail)
+            tail = chunk[-2:]
+        if found == -1:
+            yield start, total
+            return
+        yield start, found
+        start = found
+
+
+def _formatted_blocks(items, format, size=1 << 14):
+    '''
+    Formats items in batches, so that a file is written with a few large writes instead of one per entry.
+
+    :param items: an iterable of entries
+    :param format: a function formatting a list of entries as one string
+    :param size: the number of entries per block
+    :return: a generator of formatted blocks
+    '''
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield format(batch)
+
+
+def _write_gz(out_file, blocks, level=9, jobs=1):
+    '''
+    Compresses blocks of text into a gz file, which is written under a temporary name and renamed once complete, so
+    that an earlier version of the file stays intact until then. With jobs larger than 1, every block becomes a gz
+    member of its own and the blocks are compressed in parallel threads, as zlib does not hold the interpreter lock
+    while deflating; gzip, _read_lines and the parallel bulk loaders read such files like single-member ones. A
+    single block is compressed without starting threads.
+
+    :param out_file: the file to be written
+    :param blocks: an iterable of strings
+    :param level: the compression level, from 1 (fastest) to 9 (smallest)
+    :param jobs: the number of compression threads
+    '''
+    tmp = "%s.tmp" % out_file
+    f = open(tmp, "wb")
+    try:
+        blocks = iter(blocks)
+        head = list(islice(blocks, 2))
+        blocks = chain(head, blocks)
+        if jobs > 1 and len(head) > 1:
+            pool = ThreadPool(jobs)
+            try:
+                # at most two blocks per thread are compressed ahead of the writer
+                pending = deque()
+                for block in blocks:
+                    if len(pending) == 2 * jobs:
+                        _write_block(f, pending.popleft().get())
+                    pending.append(pool.apply_async(_gzip_member, (block, level)))
+                while pending:
+                    _write_block(f, pending.popleft().get())
+            finally:
+                pool.terminate()
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for block in blocks:
+                _write_block(f, compressor.compress(block))
+            _write_block(f, compressor.flush())
+        f.close()
+    except BaseException:
+        f.close()
+        os.remove(tmp)
+        raise
+    os.rename(tmp, out_file)
+
+
+def _gzip_member(block, level):
+    '''
+    :param block: a string
+    :param level: the compression level
+    :return: the block compressed as a complete gz member
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _write_block(f, data):
+    '''
+    :param f: a file opened in binary mode
+    :param data: compressed bytes to be written
+    '''
+    f.write(data)
+    instrumentation.count("io.bytes_written", len(data))
+
+
+class BackgroundWrite(threading.Thread):
+    '''
+    Writes a snapshot of a vector or cache in a thread of its own, so that training goes on while a checkpoint is
+    written. The snapshot is taken by the caller before the thread starts. Compressing does not hold the interpreter
+    lock, so mostly the formatting of the entries competes with the caller.
+    '''
+
+    def __init__(self, function, *args):
+        '''
+        Starts the thread.
+
+        :param function: the function writing the snapshot
+        :param args: the function's arguments
+        '''
+        threading.Thread.__init__(self)
+        self.function = function
+        self.args = args
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.function(*self.args)
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def wait(self):
+        '''
+        Waits until the snapshot is written.
+
+        :raises RuntimeError: if writing the snapshot failed
+        '''
+        self.join()
+        if self.error is not None:
+            raise RuntimeError("writing a snapshot failed:\n%s" % self.error)
\ No newline at end of file
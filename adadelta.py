@@ -7,7 +7,9 @@ Adadelta as described in (Zeiler, 2013)
 '''
 
 from math import sqrt
-from feature_vector import FeatureVector
+import numpy as np
+from feature_vector import FeatureVector, IndexedFeatureVector, vocabulary
+import instrumentation
 
 class Adadelta:
     def __init__(self, rho=0.95, epsilon=1.0e-6):
@@ -26,6 +28,7 @@ class Adadelta:
         self.accum_update = FeatureVector()
 
 
+    @instrumentation.timed("adadelta.update")
     def update(self, gradient):
         '''
         given a gradient this function computes the delta to be used for
@@ -37,6 +40,10 @@ class Adadelta:
         :return: the delta to be used for the update
         '''
         delta = FeatureVector()
+        # FeatureVector.dict applies a pending scale factor on every access, so it is only looked up once
+        accum_grad = self.accum_grad.dict
+        accum_update = self.accum_update.dict
+        delta_dict = delta.dict
 
         # would be nicer if we could directly do this operation on FeatureVector without the need to iterate
         for key, gradient_value in gradient:
@@ -44,21 +51,331 @@ class Adadelta:
             #print "gradient_value: %s" % gradient_value
 
             # if this dimension hasn't been seen, initialise with 0
-            if key not in self.accum_grad.dict:
-                self.accum_grad.from_function(key, 0.0)  # does this work as there is only 1 item?
-            if key not in self.accum_update.dict:
-                self.accum_update.from_function(key, 0.0)  # does this work as there is only 1 item?
+            if key not in accum_grad:
+                accum_grad[key] = 0.0
+            if key not in accum_update:
+                accum_update[key] = 0.0
 
             # accumulate gradient
-            self.accum_grad.dict[key] = self.rho * self.accum_grad.dict[key] + (1-self.rho) * gradient_value ** 2
-            #print "self.accum_grad.dict[key]: %s" % self.accum_grad.dict[key]
+            accum_grad[key] = self.rho * accum_grad[key] + (1-self.rho) * gradient_value ** 2
+            #print "accum_grad[key]: %s" % accum_grad[key]
 
             # compute update
-            delta.dict[key] = - sqrt(self.accum_update.dict[key] + self.epsilon) / sqrt(self.accum_grad.dict[key] + self.epsilon) * gradient_value
-            #print "delta.dict[key]: %s" % delta.dict[key]
+            delta_dict[key] = - sqrt(accum_update[key] + self.epsilon) / sqrt(accum_grad[key] + self.epsilon) * gradient_value
+            #print "delta_dict[key]: %s" % delta_dict[key]
 
             # accumulate update
-            self.accum_update.dict[key] = self.rho * self.accum_update.dict[key] + (1-self.rho) * delta.dict[key] ** 2
-            #print "self.accum_update.dict[key]: %s" % self.accum_update.dict[key]
+            accum_update[key] = self.rho * accum_update[key] + (1-self.rho) * delta_dict[key] ** 2
+            #print "accum_update[key]: %s" % accum_update[key]
 
-        return delta
\ No newline at end of file
+        instrumentation.count("adadelta.features_updated", len(delta_dict))
+        return delta
+
+
+class IndexedAdadelta:
+    '''
+    Adadelta with the accumulated gradient and update held in NumPy arrays indexed by a FeatureVocabulary. A sparse
+    gradient only gathers and scatters the entries of its features. Over a HashedFeatureVocabulary the arrays have
+    a fixed size.
+    '''
+
+    def __init__(self, rho=0.95, epsilon=1.0e-6, vocab=None):
+        '''
+        Initialises the accumalative gradient and update parameters, as well as
+        the decay constant rho and constant epsilon that ensures non-zero
+        denominator
+
+        :param rho: decay constant
+        :param epsilon: constant that ensures non-zero denominator
+        :param vocab: the FeatureVocabulary to use, the shared vocabulary by default
+        '''
+        self.rho = rho
+        self.epsilon = epsilon
+        self.vocab = vocabulary if vocab is None else vocab
+
+        self.accum_grad = np.zeros(len(self.vocab))
+        self.accum_update = np.zeros(len(self.vocab))
+
+    @instrumentation.timed("adadelta.update")
+    def update(self, gradient):
+        '''
+        given a gradient or a minibatch of gradients this function computes
+        the delta to be used for updating, accumulates gradient and update
+
+        :param gradient: the gradient of the objective function as a
+        FeatureVector or IndexedFeatureVector, or a list of them whose
+        average is used
+
+        :return: the delta to be used for the update as an
+        IndexedFeatureVector
+        '''
+        if not isinstance(gradient, (list, tuple)):
+            gradient = [gradient]
+        ids, values = self._sum(gradient)
+        if len(gradient) > 1:
+            values *= 1.0 / len(gradient)
+        self._grow()
+
+        # accumulate gradient
+        accum_grad = self.rho * self.accum_grad[ids] + (1-self.rho) * values ** 2
+        self.accum_grad[ids] = accum_grad
+
+        # compute update
+        delta = IndexedFeatureVector(self.vocab)
+        delta.ids = ids
+        delta.values = - np.sqrt(self.accum_update[ids] + self.epsilon) / np.sqrt(accum_grad + self.epsilon) * values
+
+        # accumulate update
+        self.accum_update[ids] = self.rho * self.accum_update[ids] + (1-self.rho) * delta.values ** 2
+
+        instrumentation.count("adadelta.features_updated", len(ids))
+        return delta
+
+    def _sum(self, gradients):
+        '''
+        Adds up gradients in one go: the entries of all of them are concatenated and reduced once, and the names of
+        FeatureVector gradients are encoded in one batch.
+
+        :param gradients: a list of FeatureVectors or IndexedFeatureVectors
+        :return: the sorted ids and the summed values of the gradients' entries as two arrays
+        '''
+        ids = [np.zeros(0, dtype=np.int32)]
+        values = [np.zeros(0)]
+        pairs = []
+        for g in gradients:
+            if isinstance(g, IndexedFeatureVector) and g.vocab is self.vocab:
+                (i, v) = g._items()
+                ids.append(i)
+                values.append(v)
+            else:
+                pairs.extend(g)
+        if pairs:
+            (i, v) = self.vocab.encode(pairs)
+            ids.append(i)
+            values.append(v)
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        return ids, np.bincount(inverse, weights=np.concatenate(values), minlength=len(ids))
+
+    def _grow(self):
+        '''
+        Extends the accumulators with zeros for the features added to the vocabulary since the last update.
+        '''
+        missing = len(self.vocab) - len(self.accum_grad)
+        if missing > 0:
+            self.accum_grad = np.concatenate((self.accum_grad, np.zeros(missing)))
+            self.accum_update = np.concatenate((self.accum_update, np.zeros(missing)))
+
+
+class RegularizedAdadelta(Adadelta):
+    '''
+    Adadelta that also holds the weights and regularizes them after every update: all weights are multiplied with
+    1 - l2 and then moved towards zero by l1, stopping at zero. Instead of regularizing every weight on every update,
+    the step at which each weight was last regularized is recorded and the missed steps are caught up with in one
+    go when the weight's feature appears in a gradient again or when the weights are read, so that an update costs
+    time proportional to the gradient's size. The weights are the same as with eager regularization, up to rounding.
+    '''
+
+    def __init__(self, rho=0.95, epsilon=1.0e-6, l1=0.0, l2=0.0, weights=None):
+        '''
+        Initialises Adadelta, the regularization strengths and the weights
+
+        :param rho: decay constant
+        :param epsilon: constant that ensures non-zero denominator
+        :param l1: the amount every weight is moved towards zero per update
+        :param l2: the fraction every weight shrinks by per update
+        :param weights: the initial weights as FeatureVector, zero by default
+        '''
+        Adadelta.__init__(self, rho, epsilon)
+        self.l1 = l1
+        self.l2 = l2
+        self._weights = FeatureVector() if weights is None else weights.copy()
+        # the number of updates and, for each weight, the update after which it was last regularized
+        self.steps = 0
+        self.last = {}
+
+    @property
+    def weights(self):
+        '''
+        :return: the regularized weights as FeatureVector; all weights are brought up to date first
+        '''
+        self._catch_up(list(self._weights.dict))
+        return self._weights
+
+    def update(self, gradient):
+        '''
+        computes the Adadelta delta of a gradient, adds it to the weights and
+        regularizes the weights of the gradient's features
+
+        :param gradient: the gradient of the objective function as a
+        FeatureVector
+
+        :return: the delta that was added to the weights
+        '''
+        delta = Adadelta.update(self, gradient)
+        keys = list(delta.dict)
+        self._catch_up(keys)
+        self.steps += 1
+        weights = self._weights.dict
+        delta_dict = delta.dict
+        values = np.array([weights.get(key, 0.0) for key in keys]) + np.array([delta_dict[key] for key in keys])
+        weights.update(zip(keys, _regularize(values, 1, self.l1, self.l2).tolist()))
+        last = self.last
+        for key in keys:
+            last[key] = self.steps
+        return delta
+
+    def to_file(self, out_file, sep=" "):
+        '''
+        Writes the regularized weights to a file like FeatureVector.to_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        '''
+        self.weights.to_file(out_file, sep)
+
+    def to_gz_file(self, out_file, sep=" ", level=9, jobs=1, background=False):
+        '''
+        Writes the regularized weights to a .gz file like FeatureVector.to_gz_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param jobs: the number of threads compressing blocks of the file as separate gz members
+        :param background: if True, the weights are written by a BackgroundWrite while the caller goes on
+        :return: the BackgroundWrite if background is True
+        '''
+        return self.weights.to_gz_file(out_file, sep, level, jobs, background)
+
+    def _catch_up(self, keys):
+        '''
+        Applies the regularization of the updates since the weights of keys were last regularized.
+
+        :param keys: list of feature names
+        '''
+        weights = self._weights.dict
+        last = self.last
+        steps = np.array([self.steps - last.get(key, 0) for key in keys], dtype=np.int64)
+        values = _regularize(np.array([weights.get(key, 0.0) for key in keys]), steps, self.l1, self.l2)
+        weights.update(zip(keys, values.tolist()))
+        for key in keys:
+            last[key] = self.steps
+
+
+class RegularizedIndexedAdadelta(IndexedAdadelta):
+    '''
+    IndexedAdadelta that also holds the weights in a NumPy array and regularizes them lazily like
+    RegularizedAdadelta.
+    '''
+
+    def __init__(self, rho=0.95, epsilon=1.0e-6, vocab=None, l1=0.0, l2=0.0, weights=None):
+        '''
+        Initialises Adadelta, the regularization strengths and the weights
+
+        :param rho: decay constant
+        :param epsilon: constant that ensures non-zero denominator
+        :param vocab: the FeatureVocabulary to use, the shared vocabulary by default
+        :param l1: the amount every weight is moved towards zero per update
+        :param l2: the fraction every weight shrinks by per update
+        :param weights: the initial weights as FeatureVector or IndexedFeatureVector, zero by default
+        '''
+        IndexedAdadelta.__init__(self, rho, epsilon, vocab)
+        self.l1 = l1
+        self.l2 = l2
+        self._weights = IndexedFeatureVector(self.vocab, dense=True)
+        if weights is not None:
+            self._weights += weights
+        # the number of updates and, for each weight, the update after which it was last regularized
+        self.steps = 0
+        self.last = np.zeros(len(self.vocab), dtype=np.int64)
+        self._grow()
+
+    @property
+    def weights(self):
+        '''
+        :return: a copy of the regularized weights as dense IndexedFeatureVector; all weights are brought up to date
+        first
+        '''
+        self._grow()
+        self._weights.values = _regularize(self._weights.values, self.steps - self.last, self.l1, self.l2)
+        self.last[:] = self.steps
+        return self._weights.copy()
+
+    def update(self, gradient):
+        '''
+        computes the Adadelta delta of a gradient or a minibatch of
+        gradients, adds it to the weights and regularizes the weights of the
+        gradients' features
+
+        :param gradient: the gradient of the objective function as a
+        FeatureVector or IndexedFeatureVector, or a list of them whose
+        average is used
+
+        :return: the delta that was added to the weights as an
+        IndexedFeatureVector
+        '''
+        delta = IndexedAdadelta.update(self, gradient)
+        ids = delta.ids
+        values = self._weights.values
+        caught_up = _regularize(values[ids], self.steps - self.last[ids], self.l1, self.l2)
+        self.steps += 1
+        values[ids] = _regularize(caught_up + delta.values, 1, self.l1, self.l2)
+        self.last[ids] = self.steps
+        return delta
+
+    def to_file(self, out_file, sep=" "):
+        '''
+        Writes the regularized weights to a file like FeatureVector.to_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        '''
+        self.weights.to_file(out_file, sep)
+
+    def to_gz_file(self, out_file, sep=" ", level=9, jobs=1, background=False):
+        '''
+        Writes the regularized weights to a .gz file like FeatureVector.to_gz_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param jobs: the number of threads compressing blocks of the file as separate gz members
+        :param background: if True, the weights are written by a BackgroundWrite while the caller goes on
+        :return: the BackgroundWrite if background is True
+        '''
+        return self.weights.to_gz_file(out_file, sep, level, jobs, background)
+
+    def _grow(self):
+        '''
+        Extends the accumulators, the weights and the regularization steps for the features added to the vocabulary
+        since the last update. New weights are zero, which regularization leaves unchanged, so they start out up to
+        date.
+        '''
+        IndexedAdadelta._grow(self)
+        self._weights._grow()
+        missing = len(self.vocab) - len(self.last)
+        if missing > 0:
+            self.last = np.concatenate((self.last, np.full(missing, self.steps, dtype=np.int64)))
+
+
+def _regularize(values, steps, l1, l2):
+    '''
+    Applies steps rounds of L2 and then L1 regularization in closed form: after k rounds, a weight's magnitude m is
+    (1 - l2)^k m - l1 (1 + (1 - l2) + ... + (1 - l2)^(k-1)), or zero once that becomes negative.
+
+    :param values: an array of weights
+    :param steps: the number of rounds, a number or an array with one number per weight
+    :param l1: the amount every weight is moved towards zero per round
+    :param l2: the fraction every weight shrinks by per round
+    :return: an array of the regularized weights
+    '''
+    decay = 1.0 - l2
+    steps = np.asarray(steps, dtype=np.float64)
+    scale = decay ** steps
+    if decay == 1.0:
+        shrink = l1 * steps
+    else:
+        # for a single round the geometric sum is exactly 1, as with eager regularization
+        shrink = l1 * ((1.0 - scale) / (1.0 - decay))
+    magnitudes = np.abs(values) * scale - shrink
+    # no negative zero, which would be written to weights files as -0.0
+    return np.where(magnitudes > 0.0, np.copysign(magnitudes, values), 0.0)
\ No newline at end of file
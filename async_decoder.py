@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+asyncio counterparts of the cdec calls in decoder, for callers running an event loop. Requires Python 3.7+.
+
+Every call accepts a timeout in seconds and an optional asyncio.Semaphore that limits how many child processes
+run at once. A call that times out or is cancelled kills its child process before the exception is raised.
+Outputs are decoded as UTF-8 strings.
+'''
+import asyncio
+from asyncio.subprocess import PIPE, DEVNULL
+from decoder import _sync_segment, _is_sync_id, _weights_path, _weights_version, _with_id, _SYNC_ERROR
+
+
+async def translate(decoder_bin, ini, weights, nl_file, kbest=0, limit=None, timeout=None):
+    '''Given a file of input sentence, a cdec configuration, some weights and the location of the decoder bin,
+    runs cdec and returns cdec'c translation as a string. Optionally returns a unique k-best list whose size can be
+    set via kbest.
+
+    :param decoder_bin: the location of the cdec script
+    :param ini: the cdec configuration file
+    :param weights: a weights file or WeightsFile
+    :param nl_file: the file containing sentences to be translated
+    :param kbest: the size of the kbest list
+    :param limit: an asyncio.Semaphore bounding the number of concurrent processes
+    :param timeout: the number of seconds after which cdec is killed and asyncio.TimeoutError is raised
+    :return: the translation string as returned by cdec
+    '''
+    args = [decoder_bin,
+            '-c', ini,
+            '-w', _weights_path(weights),
+            '-i', nl_file]
+    if kbest != 0:
+        args += ['-k', '%s' % kbest, '-r']
+    return await _run(args, None, limit, timeout)
+
+
+async def translate_sentence(decoder_bin, ini, weights, nl, kbest=0, limit=None, timeout=None):
+    '''Given a string, a cdec configuration, some weights and the location of the decoder bin,
+    runs cdec and returns cdec'c translation as a string. Optionally returns a unique k-best list whose
+    size can be set via kbest
+
+    :param decoder_bin: the location of the cdec script
+    :param ini: the cdec configuration file
+    :param weights: a weights file or WeightsFile
+    :param nl: the natural language string to be translated
+    :param kbest: the size of the kbest list
+    :param limit: an asyncio.Semaphore bounding the number of concurrent processes
+    :param timeout: the number of seconds after which cdec is killed and asyncio.TimeoutError is raised
+    :return: the translation string as returned by cdec
+    '''
+    args = [decoder_bin,
+            '-c', ini,
+            '-w', _weights_path(weights)]
+    if kbest != 0:
+        args += ['-k', '%s' % kbest, '-r']
+    return await _run(args, "%s\n" % nl, limit, timeout)
+
+
+async def bleu(script_path, references, input, limit=None, timeout=None):
+    '''
+    Given a file to be scores and its true references, runs cdec's corpus-wide BLEU script
+    and returns the value as a string
+
+    :param script_path: the path where cdec's bleu script lies
+    :param references: a file containing translation options for
+    :param input: a file containg the sentence to be scored
+    :param limit: an asyncio.Semaphore bounding the number of concurrent processes
+    :param timeout: the number of seconds after which the script is killed and asyncio.TimeoutError is raised
+    :return: a corpus-wide BLEU score
+    '''
+    args = [script_path,
+            '-r', references,
+            '-i', input]
+    return await _run(args, None, limit, timeout)
+
+
+async def _run(args, stdin, limit, timeout):
+    '''
+    Runs a process to completion, waiting for a free slot of limit first.
+
+    :param args: the command line
+    :param stdin: a string written to the process's stdin, or None
+    :param limit: an asyncio.Semaphore bounding the number of concurrent processes, or None
+    :param timeout: the number of seconds after which the process is killed, or None
+    :return: the process's stdout
+    '''
+    if limit is not None:
+        async with limit:
+            return await _run(args, stdin, None, timeout)
+    proc = await asyncio.create_subprocess_exec(*args, stdin=DEVNULL if stdin is None else PIPE, stdout=PIPE,
+                                                stderr=DEVNULL)
+    try:
+        (out, err) = await asyncio.wait_for(proc.communicate(None if stdin is None else stdin.encode("utf-8")),
+                                            timeout)
+    finally:
+        # only still running after a timeout or cancellation
+        await _kill(proc)
+    return out.decode("utf-8")
+
+
+async def _kill(proc):
+    '''
+    Kills a process unless it has terminated and waits for it.
+
+    :param proc: an asyncio.subprocess.Process
+    '''
+    if proc.returncode is None:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+    # waiting must finish even if the calling task is being cancelled, or the child would be left a zombie
+    await asyncio.shield(proc.wait())
+
+
+class AsyncDecoderSession:
+    '''
+    The asyncio counterpart of decoder.DecoderSession: a long-lived cdec process that translates one sentence at a
+    time via stdin/stdout. A crashed cdec process, or one that was killed because a call timed out or was
+    cancelled, is restarted on the next call, as is one whose WeightsFile got a new version.
+
+    As for decoder.DecoderSession, in k-best mode the cdec configuration must keep the hiero glue grammar or set
+    goal=X, which start checks with a synchronisation sentence.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights, kbest=0, retries=1, start_timeout=600):
+        '''
+        Prepares the cdec command, the process is started on the first call.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param kbest: the size of the kbest list
+        :param retries: how often a sentence is retried on a restarted cdec process if cdec crashes
+        :param start_timeout: in k-best mode, the seconds cdec may take from its start to the output of the first
+        synchronisation sentence, including loading the grammars and the language model
+        '''
+        self.args = [decoder_bin,
+                     '-c', ini,
+                     '-w', _weights_path(weights)]
+        if kbest != 0:
+            self.args += ['-k', '%s' % kbest, '-r']
+        self.ini = ini
+        self.weights = weights
+        self.kbest = kbest
+        self.retries = retries
+        self.start_timeout = start_timeout
+        self.proc = None
+        self.sync_count = 0
+        # the version of the WeightsFile the running process has read
+        self.version = None
+
+    async def start(self):
+        '''
+        (Re)starts the cdec process. cdec's stderr is discarded so that a full pipe can never block the decoder.
+        In k-best mode a synchronisation sentence is decoded to check that it parses.
+        '''
+        await self.close()
+        self.version = _weights_version(self.weights)
+        self.proc = await asyncio.create_subprocess_exec(*self.args, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        if self.kbest != 0:
+            await self._check_sync()
+
+    async def _check_sync(self):
+        '''
+        Decodes a synchronisation sentence like decoder.DecoderSession._check_sync and raises a RuntimeError if its
+        output does not appear within start_timeout seconds.
+        '''
+        self.sync_count += 1
+        (sync_id, segment) = _sync_segment(self.sync_count)
+        self.proc.stdin.write(("%s\n" % segment).encode("utf-8"))
+        await self.proc.stdin.drain()
+        try:
+            await asyncio.wait_for(self._read_until(sync_id), self.start_timeout)
+        except asyncio.TimeoutError:
+            await self.close()
+            raise RuntimeError(_SYNC_ERROR % (self.start_timeout, self.ini)) from None
+
+    def alive(self):
+        '''
+        :return: True if the cdec process is running
+        '''
+        return self.proc is not None and self.proc.returncode is None
+
+    async def close(self):
+        '''
+        Terminates the cdec process.
+        '''
+        if self.proc is not None:
+            proc = self.proc
+            self.proc = None
+            if proc.stdin is not None:
+                proc.stdin.close()
+            await _kill(proc)
+
+    async def translate_sentence(self, nl, timeout=None):
+        '''
+        Sends a string to the running cdec process and returns cdec's translation as a string, i.e. the same
+        output translate_sentence returns for this sentence.
+
+        :param nl: the natural language string to be translated
+        :param timeout: the number of seconds after which cdec is killed and asyncio.TimeoutError is raised
+        :return: the translation string as returned by cdec
+        '''
+        for attempt in range(self.retries + 1):
+            if not self.alive() or self.version != _weights_version(self.weights):
+                await self.start()
+            try:
+                return await asyncio.wait_for(self._communicate(nl), timeout)
+            except asyncio.TimeoutError:
+                # checked first, as it is an OSError since Python 3.11
+                await self.close()
+                raise
+            except (IOError, OSError, EOFError):
+                if attempt == self.retries:
+                    raise
+                await self.start()
+            except BaseException:
+                # cdec may be half way through the sentence, its output can not be matched to the next call
+                await self.close()
+                raise
+
+    async def _communicate(self, nl):
+        '''
+        Writes a sentence to cdec and reads its output, synchronising k-best output like
+        decoder.DecoderSession._communicate.
+
+        :param nl: the natural language string to be translated
+        :return: the translation string as returned by cdec
+        '''
+        if self.kbest != 0:
+            nl = _with_id(nl, 0).rstrip("\n")
+        self.proc.stdin.write(("%s\n" % nl).encode("utf-8"))
+        if self.kbest == 0:
+            await self.proc.stdin.drain()
+            out = await self.proc.stdout.readline()
+            if out == b"":
+                raise EOFError("cdec terminated")
+            return out.decode("utf-8")
+        self.sync_count += 1
+        (sync_id, segment) = _sync_segment(self.sync_count)
+        self.proc.stdin.write(("%s\n" % segment).encode("utf-8"))
+        await self.proc.stdin.drain()
+        return await self._read_until(sync_id)
+
+    async def _read_until(self, sync_id):
+        '''
+        Reads cdec's output up to the first line of a synchronisation sentence.
+
+        :param sync_id: the id of the synchronisation sentence
+        :return: the lines before it, without those of earlier synchronisation sentences
+        '''
+        out = []
+        while True:
+            line = (await self.proc.stdout.readline()).decode("utf-8")
+            if line == "":
+                raise EOFError("cdec terminated")
+            idval = line.split(" ||| ", 1)[0]
+            if idval == sync_id:
+                return "".join(out)
+            if not _is_sync_id(idval):
+                out.append(line)
+
+
+class AsyncDecoderPool:
+    '''
+    A fixed number of AsyncDecoderSessions shared by any number of concurrent calls, which wait for an idle cdec
+    process.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights, kbest=0, size=2):
+        '''
+        Prepares size cdec sessions, their processes are started on first use.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param kbest: the size of the kbest list
+        :param size: the number of cdec processes
+        '''
+        self.sessions = [AsyncDecoderSession(decoder_bin, ini, weights, kbest) for _ in range(size)]
+        self.idle = None
+
+    async def translate_sentence(self, nl, timeout=None):
+        '''
+        Translates a string on the next idle cdec process, waiting while all processes are busy.
+
+        :param nl: the natural language string to be translated
+        :param timeout: the number of seconds after which cdec is killed and asyncio.TimeoutError is raised, not
+        counting the time waited for an idle process
+        :return: the translation string as returned by cdec
+        '''
+        if self.idle is None:
+            # created here so that the queue belongs to the running event loop
+            self.idle = asyncio.Queue()
+            for session in self.sessions:
+                self.idle.put_nowait(session)
+        session = await self.idle.get()
+        try:
+            return await session.translate_sentence(nl, timeout)
+        finally:
+            self.idle.put_nowait(session)
+
+    async def translate_sentences(self, sentences, timeout=None):
+        '''
+        Translates a list of strings using all cdec processes at once.
+
+        :param sentences: list of natural language strings to be translated
+        :param timeout: the per-sentence timeout in seconds
+        :return: list of translation strings as returned by cdec, in the order of sentences
+        '''
+        return await asyncio.gather(*[self.translate_sentence(nl, timeout) for nl in sentences])
+
+    async def close(self):
+        '''
+        Terminates all cdec processes.
+        '''
+        for session in self.sessions:
+            await session.close()
\ No newline at end of file
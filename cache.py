@@ -1,16 +1,96 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import gzip
+import sqlite3
+from collections import OrderedDict
 from ast import literal_eval as make_tuple
-from abstract_sparse_vector import AbstractSparseVector
+from abstract_sparse_vector import AbstractSparseVector, BackgroundWrite, _read_lines, _gc_paused, _formatted_blocks
+from abstract_sparse_vector import _write_gz
+import instrumentation
 
 class Cache(AbstractSparseVector):
     '''
     A sparse vector holding the information of previously parsed sentences, i.e.
     the sentence as key and the following tuple as value: boolean indicator
-    whether it was true or not, the mrl and the answer
+    whether it was true or not, the mrl and the answer.
+
+    Given a capacity, the cache holds at most that many entries and evicts the least recently used (policy "lru")
+    or the least frequently used (policy "lfu", ties broken by age) entry to make room. Lookups via get count
+    hits and misses.
+
+    Given a path, the entries are kept in a DiskStore file instead of memory, so that they survive the process
+    and only the entries that are looked up are read.
     '''
 
+    def __init__(self, capacity=None, policy="lru", path=None):
+        '''
+        Initialises the dictionary and the statistics.
+
+        :param capacity: the maximum number of entries, None for an unbounded cache
+        :param policy: the eviction policy of a bounded cache, "lru" or "lfu"
+        :param path: the file of a persistent cache, None for a cache in memory
+        '''
+        AbstractSparseVector.__init__(self)
+        if policy not in ("lru", "lfu"):
+            raise ValueError("unknown eviction policy %s" % policy)
+        if capacity is not None and capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if capacity is not None and path is not None:
+            raise ValueError("a persistent cache can not be bounded")
+        self.capacity = capacity
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if capacity is not None and policy == "lru":
+            # ordered from least to most recently used
+            self.dict = OrderedDict()
+        # for lfu: the use count of each key and the keys of each count, ordered from least to most recently used
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+        if path is not None:
+            self.dict = DiskStore(path)
+
+    def get(self, key, default=None):
+        '''
+        Looks up a key and counts the lookup as hit or miss.
+
+        :param key: key
+        :param default: the value returned if the key is not in the cache
+        :return: the key's value or default
+        '''
+        if key not in self.dict:
+            self.misses += 1
+            instrumentation.count("cache.misses")
+            return default
+        self.hits += 1
+        instrumentation.count("cache.hits")
+        self._touch(key)
+        return self.dict[key]
+
+    def sync(self):
+        '''
+        Writes all entries of a persistent cache to disk.
+        '''
+        if isinstance(self.dict, DiskStore):
+            self.dict.sync()
+
+    def close(self):
+        '''
+        Writes all entries of a persistent cache to disk and closes its file.
+        '''
+        if isinstance(self.dict, DiskStore):
+            self.dict.close()
+
+    def stats(self):
+        '''
+        :return: a dictionary with the current size, hits, misses, evictions and hit ratio of the cache
+        '''
+        lookups = self.hits + self.misses
+        return {"size": len(self.dict), "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_ratio": float(self.hits) / lookups if lookups else 0.0}
+
     def from_string(self, string, item_sep="\n", key_val_sep=" ||| "):
         '''
         Takes a string and adds it to the dictionary.
@@ -26,16 +106,93 @@ class Cache(AbstractSparseVector):
                 val[0] = True
             elif val[0] == "False":
                 val[0] = False
-            self.dict[key] = val
+            self.from_function(key, val)
 
     def from_function(self, key, val):
         '''
-        Receives a key and a value pair that can directly be inserted into the dictionary
+        Receives a key and a value pair that can directly be inserted into the dictionary. If the cache is full,
+        an entry is evicted first.
         
         :param key: key
         :param val: value
         '''
-        self.dict[key] = val
+        if self.capacity is None:
+            self.dict[key] = val
+        elif key in self.dict:
+            self.dict[key] = val
+            self._touch(key)
+        else:
+            if len(self.dict) >= self.capacity:
+                self._evict()
+            self.dict[key] = val
+            if self.policy == "lfu":
+                self.counts[key] = 1
+                self.buckets.setdefault(1, OrderedDict())[key] = None
+                self.min_count = 1
+
+    def _touch(self, key):
+        '''
+        Records a use of a key of a bounded cache.
+
+        :param key: key
+        '''
+        if self.capacity is None:
+            return
+        if self.policy == "lru":
+            self.dict[key] = self.dict.pop(key)
+            return
+        count = self._unlink(key)
+        if count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def _unlink(self, key):
+        '''
+        Removes a key from the lfu use counts.
+
+        :param key: key
+        :return: the key's use count
+        '''
+        count = self.counts.pop(key)
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+        return count
+
+    def _evict(self):
+        '''
+        Removes the entry chosen by the eviction policy.
+        '''
+        if self.policy == "lru":
+            key = next(iter(self.dict))
+        else:
+            key = next(iter(self.buckets[self.min_count]))
+            self._unlink(key)
+        del self.dict[key]
+        self.evictions += 1
+
+    def pop(self, key):
+        '''
+        Deletes a given key from the dictionary.
+
+        :param key: Key to be deleted.
+        '''
+        self.dict.pop(key)
+        if key in self.counts:
+            count = self._unlink(key)
+            if count == self.min_count and count not in self.buckets:
+                self.min_count = min(self.buckets) if self.buckets else 0
+
+    def clear(self):
+        '''
+        Empties the whole dictionary.
+        '''
+        self.dict.clear()
+        self.counts.clear()
+        self.buckets.clear()
+        self.min_count = 0
 
     def from_file(self, in_file, sep=" |||  ", value_is_tuple=False):
         '''
@@ -53,7 +210,7 @@ class Cache(AbstractSparseVector):
                 val[0] = True
             elif val[0] == "False":
                 val[0] = False
-            self.dict[key] = val
+            self.from_function(key, val)
         f.close()
 
     def from_gz_file(self, in_file, sep=" ||| ", value_is_tuple=False):
@@ -75,9 +232,41 @@ class Cache(AbstractSparseVector):
                 elif val_0 == "False":
                     val_0 = False
                 val = (val_0, val_1[1:-1], val_2[1:-1])  # strip gets rid of surrounding " here
-            self.dict[key] = val
+            self.from_function(key, val)
         f.close()
 
+    def bulk_load(self, in_file, sep=" ||| ", value_is_tuple=True, jobs=1, progress=None):
+        '''
+        Read key-value pairs from a plain or .gz file like from_gz_file, but in large blocks, with optionally
+        parallel decompression and a parser specialised to the (bool, "mrl", "answer") format written by
+        to_gz_file, which is much faster for files with millions of lines.
+
+        :param in_file: input file to be parsed
+        :param sep: the symbol that separates key and value
+        :param value_is_tuple: if True, values are parsed as (bool, "mrl", "answer") tuples
+        :param jobs: the number of threads decompressing a .gz file with several members
+        :param progress: a function called with the number of bytes read so far and the file size
+        '''
+        flags = {"True": True, "False": False}
+        with _gc_paused():
+            for lines in _read_lines(in_file, jobs, progress=progress):
+                entries = []
+                for line in lines:
+                    # lines starting with the separator had no translation, as in from_gz_file
+                    if not line or line.startswith(sep):
+                        continue
+                    (key, val) = line.strip().split(sep, 1)
+                    if value_is_tuple:
+                        (val_0, rest) = val[1:-1].split(", ", 1)
+                        (val_1, val_2) = rest[1:-1].split('", "', 1)
+                        val = (flags.get(val_0, val_0), val_1, val_2)
+                    entries.append((key, val))
+                if self.capacity is None and type(self.dict) is dict:
+                    self.dict.update(entries)
+                else:
+                    for key, val in entries:
+                        self.from_function(key, val)
+
     def to_file(self, out_file, sep=" ||| "):
         '''
         Writes the dictionar's key-value pairs to a file.
@@ -90,18 +279,32 @@ class Cache(AbstractSparseVector):
             f.write("%s%s%s\n" % (key, sep, self.dict[key]))
         f.close()
 
-    def to_gz_file(self, out_file, sep=" ||| "):
+    def to_gz_file(self, out_file, sep=" ||| ", level=9, jobs=1, background=False):
         '''
         Writes the dictionar's key-value pairs to a .gz file.
 
         :param out_file: file to be written to
         :param sep: the symbol that separates key and value
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param jobs: the number of threads compressing blocks of the file as separate gz members
+        :param background: if True, a copy of the entries is written by a BackgroundWrite while the caller goes on;
+        a persistent cache is committed and read by the thread with a connection of its own, which sees the entries
+        as they were committed
+        :return: the BackgroundWrite if background is True
         '''
-        f = gzip.open(out_file, "wb")
-        for key in self.dict:
-            t1, t2, t3 = self.dict[key]
-            f.write("%s%s(%s, \"%s\", \"%s\")\n" % (key, sep, t1, t2, t3))
-        f.close()
+        if background:
+            if isinstance(self.dict, DiskStore):
+                self.sync()
+                return BackgroundWrite(_store_to_gz_file, self.dict.path, out_file, sep, level, jobs)
+            snapshot = Cache()
+            snapshot.dict = self.dict.copy()
+            return BackgroundWrite(snapshot.to_gz_file, out_file, sep, level, jobs)
+
+        def format(entries):
+            return "".join(["%s%s(%s, \"%s\", \"%s\")\n" % (key, sep, t1, t2, t3) for key, (t1, t2, t3) in entries])
+
+        with _gc_paused():
+            _write_gz(out_file, _formatted_blocks(self.dict.items(), format), level, jobs)
 
     # need to explicitly iterate over dictionary and tuple to get the correct encoding..
     def __repr__(self):
@@ -114,4 +317,164 @@ class Cache(AbstractSparseVector):
             print_dict += "'%s': (%s, \"%s\", \"%s\"), " % (key, t1, t2, t3)
         print_dict = print_dict[:-2]
         print_dict += "}"
-        return print_dict
\ No newline at end of file
+        return print_dict
+
+
+class DiskStore(object):
+    '''
+    A dictionary-like store of cache entries in a sqlite file with the key as primary key, so that a lookup reads
+    a single entry from disk. Writes go to sqlite's append-only write-ahead log and are committed every
+    sync_every writes; sync also compacts the file once more than half of it is unused.
+    '''
+
+    def __init__(self, path, sync_every=100):
+        '''
+        Opens or creates the store.
+
+        :param path: the sqlite file
+        :param sync_every: the number of writes after which they are committed to disk
+        '''
+        self.path = path
+        self.sync_every = sync_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        # keep keys and values as the byte strings they were added as
+        self.conn.text_factory = str
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, val TEXT)")
+        self.conn.commit()
+
+    def __getitem__(self, key):
+        '''
+        :param key: key
+        :return: the key's value
+        '''
+        row = self.conn.execute("SELECT val FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return make_tuple(row[0])
+
+    def __setitem__(self, key, val):
+        '''
+        :param key: key
+        :param val: value, anything whose repr can be read back by literal_eval
+        '''
+        self.conn.execute("INSERT OR REPLACE INTO cache (key, val) VALUES (?, ?)", (key, repr(val)))
+        self._written()
+
+    def __delitem__(self, key):
+        '''
+        :param key: key to be deleted
+        '''
+        if self.conn.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount == 0:
+            raise KeyError(key)
+        self._written()
+
+    def __contains__(self, key):
+        '''
+        :param key: key
+        :return: True if the key is in the store
+        '''
+        return self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        '''
+        Provides an iterator over the store's keys, read from disk while iterating
+        '''
+        for (key,) in self.conn.execute("SELECT key FROM cache"):
+            yield key
+
+    def items(self):
+        '''
+        :return: an iterator over the store's (key, value) pairs, read from disk with a single query while iterating
+        '''
+        for (key, val) in self.conn.execute("SELECT key, val FROM cache"):
+            yield key, make_tuple(val)
+
+    def __len__(self):
+        '''
+        :return: the number of entries
+        '''
+        return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def pop(self, key):
+        '''
+        Deletes a given key from the store.
+
+        :param key: Key to be deleted.
+        :return: the key's value
+        '''
+        val = self[key]
+        del self[key]
+        return val
+
+    def pop_prefix(self, prefix):
+        '''
+        Deletes all keys starting with a given prefix. The keys are compared bytewise, so the range from the prefix up
+        to the prefix with its last character incremented holds exactly these keys and is found in the key index.
+
+        :param prefix: a non-empty key prefix
+        :return: the number of deleted keys
+        '''
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        count = self.conn.execute("DELETE FROM cache WHERE key >= ? AND key < ?", (prefix, end)).rowcount
+        if count:
+            self._written()
+        return count
+
+    def clear(self):
+        '''
+        Empties the whole store.
+        '''
+        self.conn.execute("DELETE FROM cache")
+        self.sync()
+
+    def _written(self):
+        '''
+        Counts a write and commits once sync_every writes are pending.
+        '''
+        self.pending += 1
+        if self.pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        '''
+        Commits all pending writes and compacts the file if more than half of its pages are unused.
+        '''
+        self.conn.commit()
+        self.pending = 0
+        free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free * 2 > self.conn.execute("PRAGMA page_count").fetchone()[0]:
+            self.compact()
+
+    def compact(self):
+        '''
+        Moves the write-ahead log into the database file and rewrites the file without unused pages.
+        '''
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        '''
+        Commits all pending writes and closes the file.
+        '''
+        self.conn.commit()
+        self.conn.close()
+
+
+def _store_to_gz_file(path, out_file, sep, level, jobs):
+    '''
+    Writes the entries of a persistent cache to a .gz file, with a connection of the calling thread.
+
+    :param path: the sqlite file
+    :param out_file: file to be written to
+    :param sep: the symbol that separates key and value
+    :param level: the compression level
+    :param jobs: the number of compression threads
+    '''
+    cache = Cache(path=path)
+    try:
+        cache.to_gz_file(out_file, sep, level, jobs)
+    finally:
+        cache.close()
\ No newline at end of file
@@ -1,40 +1,201 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys
+import os
+import re
+import atexit
 import subprocess
 import math
+import threading
+import tempfile
+import hashlib
+import select
+import time
+try:
+    import Queue
+except ImportError:  # Python 3, where only async_decoder is used
+    import queue as Queue
+import numpy as np
 from collections import Counter  # multiset represented by dictionary
+from translation import read_kbest
+from feature_vector import IndexedFeatureVector, _format
+from abstract_sparse_vector import _gc_paused
+from cache import Cache
+import instrumentation
 
 
-def translate(decoder_bin, ini, weights, nl_file, kbest=0):
+def translate(decoder_bin, ini, weights, nl_file, kbest=0, jobs=1):
     '''Given a file of input sentence, a cdec configuration, some weights and the location of the decoder bin,
     sends a call to cdec and returns cdec'c translation as a string. Optionally returns a unique k-best list whose
-    size can be set via kbest
+    size can be set via kbest. If jobs is larger than 1, the file is split into shards of similar source length
+    that are decoded by parallel cdec processes; the output is identical to the single-process output.
 
     :param decoder_bin: the location of the cdec script
     :param ini: the cdec configuration file
-    :param weights: a weights file
+    :param weights: a weights file or WeightsFile
     :param nl: the file containing sentences to be translated
     :param kbest: the size of the kbest list
+    :param jobs: the number of cdec processes
     :return: the translation string as returned by cdec
     '''
+    if jobs > 1:
+        return _translate_sharded(decoder_bin, ini, weights, nl_file, kbest, jobs)
     args = [decoder_bin,
             '-c', ini,
-            '-w', weights,
+            '-w', _weights_path(weights),
             '-i', nl_file]
     if kbest != 0:
         args += ['-k', '%s' % kbest, '-r']
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (out, err) = proc.communicate()
+    with instrumentation.timer("decoder.translate"):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
     proc.stdout.close()
     proc.stderr.close()
     try:
         proc.kill()
     except OSError:
         pass
+    if instrumentation.enabled:
+        instrumentation.count("decoder.processes")
+        instrumentation.count("decoder.bytes_read", len(out))
     return out
 
 
+def translate_kbest(decoder_bin, ini, weights, nl_file, kbest, group=False):
+    '''Given a file of input sentence, a cdec configuration, some weights and the location of the decoder bin,
+    sends a call to cdec and yields the unique k-best list as Translation objects while cdec is still decoding.
+
+    :param decoder_bin: the location of the cdec script
+    :param ini: the cdec configuration file
+    :param weights: a weights file or WeightsFile
+    :param nl_file: the file containing sentences to be translated
+    :param kbest: the size of the kbest list
+    :param group: if True, yields a list with all Translations of a sentence instead of single Translations
+    :return: a generator of Translation objects or lists of Translation objects
+    '''
+    args = [decoder_bin,
+            '-c', ini,
+            '-w', _weights_path(weights),
+            '-i', nl_file,
+            '-k', '%s' % kbest, '-r']
+    devnull = open(os.devnull, "w")
+    start = instrumentation.default_timer()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=devnull)
+    instrumentation.count("decoder.processes")
+    try:
+        for translation in read_kbest(proc.stdout, group):
+            yield translation
+    finally:
+        proc.stdout.close()
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+        devnull.close()
+        # the time the k-best list was being consumed, including the caller's work between two Translations
+        instrumentation.add_time("decoder.translate_kbest", instrumentation.default_timer() - start)
+
+
+def _translate_sharded(decoder_bin, ini, weights, nl_file, kbest, jobs):
+    '''
+    Splits a file of input sentences into contiguous shards, translates each shard with its own cdec process and
+    concatenates the outputs in the original order. Sentences without an id get their line number as id, which
+    is what a single cdec process would have assigned them, so that k-best ids are preserved across shards.
+
+    :param decoder_bin: the location of the cdec script
+    :param ini: the cdec configuration file
+    :param weights: a weights file or WeightsFile
+    :param nl_file: the file containing sentences to be translated
+    :param kbest: the size of the kbest list
+    :param jobs: the number of cdec processes
+    :return: the translation string as returned by cdec
+    :raises: the exception of the first shard whose translation failed, e.g. OSError if cdec can not be started
+    '''
+    f = open(nl_file, "r")
+    lines = [_with_id(line, i) for i, line in enumerate(f)]
+    f.close()
+    shards = _shard([_source_length(line) for line in lines], jobs)
+    out = [None] * len(shards)
+    errors = [None] * len(shards)
+    shard_files = []
+    for start, end in shards:
+        (fd, shard_file) = tempfile.mkstemp(prefix="nlpminion-shard-")
+        f = os.fdopen(fd, "w")
+        f.writelines(lines[start:end])
+        f.close()
+        shard_files.append(shard_file)
+
+    def work(i):
+        try:
+            out[i] = translate(decoder_bin, ini, weights, shard_files[i], kbest)
+        except Exception as e:
+            errors[i] = e
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(len(shards))]
+    try:
+        with instrumentation.timer("decoder.translate_sharded"):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+    for error in errors:
+        if error is not None:
+            raise error
+    return "".join(out)
+
+
+def _with_id(line, i):
+    '''
+    Makes sure an input line carries an explicit sentence id.
+
+    :param line: a line of cdec input, either plain text or a <seg> element
+    :param i: the line number, used as id if the line has none
+    :return: the line with an id
+    '''
+    match = re.match(r'(\s*<seg)([^>]*>.*)$', line, re.DOTALL)
+    if match is None:
+        return '<seg id="%s"> %s </seg>\n' % (i, line.strip())
+    if re.search(r'\sid="', match.group(2).split(">", 1)[0]):
+        return line
+    return '%s id="%s"%s' % (match.group(1), i, match.group(2))
+
+
+def _source_length(line):
+    '''
+    :param line: a line of cdec input, either plain text or a <seg> element
+    :return: the number of source words, used as estimate of the decoding cost
+    '''
+    return len(re.sub(r'<[^>]*>', ' ', line).split())
+
+
+def _shard(costs, jobs):
+    '''
+    Splits a sequence into at most jobs contiguous shards of roughly equal total cost.
+
+    :param costs: the estimated cost of each item
+    :param jobs: the number of shards
+    :return: a list of (start, end) index pairs
+    '''
+    total = float(sum(costs)) or 1.0
+    shards = []
+    start = 0
+    accum = 0.0
+    for i, cost in enumerate(costs):
+        accum += cost
+        # cut as soon as this shard reaches its share of the total cost, but leave one item per remaining shard
+        remaining = jobs - len(shards) - 1
+        if remaining > 0 and (accum >= total * (len(shards) + 1) / jobs or len(costs) - i - 1 == remaining):
+            shards.append((start, i + 1))
+            start = i + 1
+    if start < len(costs):
+        shards.append((start, len(costs)))
+    return shards
+
+
 def translate_sentence(decoder_bin, ini, weights, nl, kbest=0):
     '''Given a string, a cdec configuration, some weights and the location of the decoder bin,
     sends a call to cdec and returns cdec'c translation as a string. Optionally returns a unique k-best list whose
@@ -42,19 +203,23 @@ def translate_sentence(decoder_bin, ini, weights, nl, kbest=0):
 
     :param decoder_bin: the location of the cdec script
     :param ini: the cdec configuration file
-    :param weights: a weights file
+    :param weights: a weights file or WeightsFile
     :param nl: the natural language string to be translated
     :param kbest: the size of the kbest list
     :return: the translation string as returned by cdec
     '''
     args = [decoder_bin,
             '-c', ini,
-            '-w', weights]
+            '-w', _weights_path(weights)]
     if kbest != 0:
         args += ['-k', '%s' % kbest, '-r']
-    echo = subprocess.Popen(('echo', '%s' % nl), stdout=subprocess.PIPE)
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=echo.stdout)
-    (out, err) = proc.communicate()
+    with instrumentation.timer("decoder.translate_sentence"):
+        echo = subprocess.Popen(('echo', '%s' % nl), stdout=subprocess.PIPE)
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=echo.stdout)
+        (out, err) = proc.communicate()
+    if instrumentation.enabled:
+        instrumentation.count("decoder.processes", 2)
+        instrumentation.count("decoder.bytes_read", len(out))
     echo.stdout.close()
     proc.stdout.close()
     proc.stderr.close()
@@ -69,6 +234,664 @@ def translate_sentence(decoder_bin, ini, weights, nl, kbest=0):
     return out
 
 
+class WeightsFile(object):
+    '''
+    A weights file for cdec that follows weights in memory, so that the decoder functions can be handed the current
+    weights without writing the whole vector with to_file after every update. update only formats the weights that
+    changed since the previous version, in no particular order, and only writes a new version if any did. The file
+    lives on tmpfs where available and each version replaces the previous one by renaming, so cdec processes still
+    reading an older version are not disturbed. A WeightsFile can be passed wherever the decoder functions take a
+    weights file; a DecoderSession restarts its cdec process when the version changes.
+
+        weights_file = WeightsFile(weights)
+        for nl in sentences:
+            out = translate_sentence(decoder_bin, ini, weights_file, nl, kbest)
+            ...
+            weights += adadelta.update(gradient)
+            weights_file.update(weights)
+    '''
+
+    def __init__(self, weights=None, directory=None, sep=" "):
+        '''
+        Creates the file, empty unless weights are given.
+
+        :param weights: the initial weights as FeatureVector or IndexedFeatureVector
+        :param directory: the directory of the file, /dev/shm if it exists or else the default temporary directory
+        :param sep: the symbol that separates key and value
+        '''
+        if directory is None and os.path.isdir("/dev/shm"):
+            directory = "/dev/shm"
+        (fd, self.path) = tempfile.mkstemp(prefix="nlpminion-weights.", dir=directory)
+        os.close(fd)
+        self.sep = sep
+        # the number of versions written so far
+        self.version = 0
+        # name -> value and name -> line of the non-zero weights in the file
+        self.values = {}
+        self.lines = {}
+        # the vocabulary and the values per id of the IndexedFeatureVector the file was last updated from, and for a
+        # HashedFeatureVocabulary id -> the names of cdec's output sharing the id with its first name
+        self.vocab = None
+        self.previous = np.zeros(0)
+        self.aliases = {}
+        if weights is not None:
+            self.update(weights)
+
+    def update(self, weights, changed=None, names=None):
+        '''
+        Brings the file up to date with the weights. Changes of an IndexedFeatureVector are found by comparing
+        arrays, those of a FeatureVector by comparing its dictionary with the weights in the file, unless the
+        changed names are given.
+
+        A HashedFeatureVocabulary only keeps the first name of every id, so names cdec outputs that share an id with
+        another name are only written once they are given, e.g. those of the k-best lists decoded since the last
+        update. Each gets its id's weight with its own sign, the weight the model scores it with.
+
+        :param weights: a FeatureVector or IndexedFeatureVector
+        :param changed: the names of the only features of a FeatureVector that may have changed since the last
+        update, e.g. the keys of the update added to it
+        :param names: feature names of cdec's output, for an IndexedFeatureVector over a HashedFeatureVocabulary
+        :return: the number of weights that changed
+        '''
+        with instrumentation.timer("weights_file.update"), _gc_paused():
+            if isinstance(weights, IndexedFeatureVector):
+                pairs = self._indexed_changes(weights, names)
+            else:
+                self.vocab = None
+                values = weights.dict
+                if changed is None:
+                    known = self.values
+                    get = known.get
+                    # Python 2's items would build a list of all items
+                    items = values.iteritems() if hasattr(values, "iteritems") else values.items()
+                    pairs = [(key, val) for key, val in items if get(key) != val]
+                    # names of the file missing in the weights, only searched for if there can be any
+                    added = sum(1 for key, val in pairs if key not in known)
+                    if len(values) - added < len(known):
+                        pairs += [(key, 0.0) for key in known if key not in values]
+                else:
+                    pairs = [(key, values.get(key, 0.0)) for key in changed]
+            n = self._apply(pairs)
+        instrumentation.count("weights_file.changed", n)
+        return n
+
+    def close(self):
+        '''
+        Removes the file.
+        '''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _indexed_changes(self, weights, names=None):
+        '''
+        :param weights: an IndexedFeatureVector
+        :param names: feature names of cdec's output
+        :return: a list of (name, value) pairs of the ids whose value changed since the last update; ids of a
+        HashedFeatureVocabulary without a name are skipped until they have one, the further names of an id are
+        written with it and ids that got a further name are written again
+        '''
+        vocab = weights.vocab
+        if weights.dense:
+            values = weights.values
+        else:
+            values = np.bincount(weights.ids, weights=weights.values, minlength=len(vocab))
+        stale = []
+        if vocab is not self.vocab:
+            # the file was written from another vocabulary or a FeatureVector, names only known to it are dropped
+            stale = list(self.values)
+            self.vocab = vocab
+            self.previous = np.zeros(0)
+            self.aliases = {}
+        size = max(len(values), len(self.previous))
+        previous = np.zeros(size)
+        previous[:len(self.previous)] = self.previous
+        current = np.zeros(size)
+        current[:len(values)] = values
+        ids = np.nonzero(current != previous)[0]
+        if vocab.hashed:
+            named = set(self._add_aliases(vocab, names))
+            ids = np.array(sorted(named.union(i for i in ids.tolist() if i in vocab.names)), dtype=np.int64)
+        previous[ids] = current[ids]
+        self.previous = previous
+        pairs = vocab.decode(ids, current[ids])
+        if self.aliases:
+            aliases = self.aliases
+            for i, val in zip(ids.tolist(), current[ids].tolist()):
+                for name in aliases.get(i, ()):
+                    pairs.append((name, vocab.hash(name)[1] * val))
+        if stale:
+            named = set(key for key, val in pairs)
+            pairs += [(key, 0.0) for key in stale if key not in named]
+        return pairs
+
+    def _add_aliases(self, vocab, names):
+        '''
+        Remembers the names of cdec's output that share an id with its first name, and names ids without one.
+
+        :param vocab: a HashedFeatureVocabulary
+        :param names: feature names of cdec's output, may be None
+        :return: a list of the ids that got a name
+        '''
+        added = []
+        aliases = self.aliases
+        for name in names or ():
+            i = vocab.lookup(name)
+            first = vocab.names.get(i)
+            if first is None:
+                vocab.record(i, name)
+            elif first == name or name in aliases.get(i, ()):
+                continue
+            else:
+                aliases.setdefault(i, set()).add(name)
+            added.append(i)
+        return added
+
+    def _apply(self, pairs):
+        '''
+        Formats the changed weights and writes a new version if any changed.
+
+        :param pairs: a list of (name, value) pairs, a value of 0 removes the name from the file
+        :return: the number of weights that changed
+        '''
+        values = self.values
+        lines = self.lines
+        n = 0
+        for key, val in pairs:
+            if val == 0.0:
+                if key in values:
+                    del values[key]
+                    del lines[key]
+                    n += 1
+            elif values.get(key) != val:
+                values[key] = val
+                lines[key] = "%s%s%s\n" % (key, self.sep, _format(val))
+                n += 1
+        if n:
+            tmp = "%s.tmp" % self.path
+            f = open(tmp, "w")
+            f.write("".join(lines.values()))
+            f.close()
+            os.rename(tmp, self.path)
+            self.version += 1
+        return n
+
+
+def _weights_path(weights):
+    '''
+    :param weights: a weights file or WeightsFile
+    :return: the path of the weights file
+    '''
+    return weights.path if isinstance(weights, WeightsFile) else weights
+
+
+def _weights_version(weights):
+    '''
+    :param weights: a weights file or WeightsFile
+    :return: the WeightsFile's version, None for a weights file
+    '''
+    return weights.version if isinstance(weights, WeightsFile) else None
+
+
+class DecoderSession:
+    '''
+    A long-lived cdec process that translates one sentence at a time via stdin/stdout. Unlike translate_sentence,
+    the grammar configuration and the language model named in the cdec configuration are only loaded once.
+    A crashed cdec process is restarted automatically, and so is the process of a WeightsFile that got a new
+    version, as cdec only reads its weights at start.
+
+    In k-best mode every sentence is followed by a synchronisation sentence with a grammar of one [X] rule, see
+    _communicate. The cdec configuration must let that rule reach the goal, i.e. keep the hiero glue grammar (no
+    scfg_no_hiero_glue_grammar) or set goal=X. Otherwise the synchronisation sentence has no parse, so start
+    decodes one and raises a RuntimeError if its output does not appear within start_timeout seconds.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights, kbest=0, retries=1, start_timeout=600):
+        '''
+        Starts the cdec process.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param kbest: the size of the kbest list
+        :param retries: how often a sentence is retried on a restarted cdec process if cdec crashes
+        :param start_timeout: in k-best mode, the seconds cdec may take from its start to the output of the first
+        synchronisation sentence, including loading the grammars and the language model
+        '''
+        self.args = [decoder_bin,
+                     '-c', ini,
+                     '-w', _weights_path(weights)]
+        if kbest != 0:
+            self.args += ['-k', '%s' % kbest, '-r']
+        self.ini = ini
+        self.weights = weights
+        self.kbest = kbest
+        self.retries = retries
+        self.start_timeout = start_timeout
+        self.proc = None
+        self.devnull = None
+        self.sync_count = 0
+        # the version of the WeightsFile the running process has read
+        self.version = None
+        self.start()
+
+    def start(self):
+        '''
+        (Re)starts the cdec process. cdec's stderr is discarded so that a full pipe can never block the decoder.
+        In k-best mode a synchronisation sentence is decoded to check that it parses.
+        '''
+        self.close()
+        self.devnull = open(os.devnull, "w")
+        self.version = _weights_version(self.weights)
+        self.proc = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.devnull)
+        instrumentation.count("decoder.processes")
+        if self.kbest != 0:
+            self._check_sync()
+
+    def _check_sync(self):
+        '''
+        Decodes a synchronisation sentence and waits at most start_timeout seconds for its first line, so that a
+        configuration in which it has no parse fails here instead of blocking the first translation forever.
+        '''
+        self.sync_count += 1
+        (sync_id, segment) = _sync_segment(self.sync_count)
+        self.proc.stdin.write("%s\n" % segment)
+        self.proc.stdin.flush()
+        deadline = time.time() + self.start_timeout
+        while True:
+            # stdout is unbuffered, so select sees every line readline has not read yet
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.proc.stdout], [], [], remaining)[0]:
+                self.close()
+                raise RuntimeError(_SYNC_ERROR % (self.start_timeout, self.ini))
+            line = self.proc.stdout.readline()
+            if line == "":
+                raise EOFError("cdec terminated")
+            if line.split(" ||| ", 1)[0] == sync_id:
+                return
+
+    def alive(self):
+        '''
+        :return: True if the cdec process is running
+        '''
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        '''
+        Terminates the cdec process.
+        '''
+        if self.proc is not None:
+            for pipe in (self.proc.stdin, self.proc.stdout):
+                try:
+                    pipe.close()
+                except (IOError, OSError):
+                    pass
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+            self.proc.wait()
+            self.proc = None
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
+
+    def translate_sentence(self, nl):
+        '''
+        Sends a string to the running cdec process and returns cdec's translation as a string, i.e. the same
+        output translate_sentence returns for this sentence.
+
+        :param nl: the natural language string to be translated
+        :return: the translation string as returned by cdec
+        '''
+        for attempt in range(self.retries + 1):
+            if not self.alive() or self.version != _weights_version(self.weights):
+                self.start()
+            try:
+                with instrumentation.timer("decoder.session"):
+                    out = self._communicate(nl)
+                if instrumentation.enabled:
+                    instrumentation.count("decoder.bytes_read", len(out))
+                return out
+            except (IOError, OSError, EOFError):
+                if attempt == self.retries:
+                    raise
+                instrumentation.count("decoder.session_restarts")
+                self.start()
+
+    def _communicate(self, nl):
+        '''
+        Writes a sentence to cdec and reads its output. In 1-best mode cdec writes exactly one line per sentence.
+        In k-best mode the number of lines is unknown, and none are written for a sentence without a parse, so a
+        synchronisation sentence that always parses is decoded after each sentence and the output is read until
+        the first line of that sentence appears. Left-over lines of earlier synchronisation sentences are skipped.
+        As the synchronisation sentences count for cdec's sentence ids, a sentence without an id gets the id 0
+        translate_sentence gives it.
+
+        :param nl: the natural language string to be translated
+        :return: the translation string as returned by cdec
+        '''
+        if self.kbest != 0:
+            nl = _with_id(nl, 0).rstrip("\n")
+        self.proc.stdin.write("%s\n" % nl)
+        if self.kbest == 0:
+            self.proc.stdin.flush()
+            out = self.proc.stdout.readline()
+            if out == "":
+                raise EOFError("cdec terminated")
+            return out
+        self.sync_count += 1
+        (sync_id, segment) = _sync_segment(self.sync_count)
+        self.proc.stdin.write("%s\n" % segment)
+        self.proc.stdin.flush()
+        out = []
+        while True:
+            line = self.proc.stdout.readline()
+            if line == "":
+                raise EOFError("cdec terminated")
+            idval = line.split(" ||| ", 1)[0]
+            if idval == sync_id:
+                return "".join(out)
+            if not _is_sync_id(idval):
+                out.append(line)
+
+
+class DecoderPool:
+    '''
+    A fixed number of DecoderSessions that can be shared between threads.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights, kbest=0, size=2):
+        '''
+        Starts size cdec processes.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param kbest: the size of the kbest list
+        :param size: the number of cdec processes
+        '''
+        self.sessions = [DecoderSession(decoder_bin, ini, weights, kbest) for _ in range(size)]
+        self.idle = Queue.Queue()
+        for session in self.sessions:
+            self.idle.put(session)
+
+    def translate_sentence(self, nl):
+        '''
+        Translates a string on the next idle cdec process. Blocks while all processes are busy.
+
+        :param nl: the natural language string to be translated
+        :return: the translation string as returned by cdec
+        '''
+        session = self.idle.get()
+        try:
+            return session.translate_sentence(nl)
+        finally:
+            self.idle.put(session)
+
+    def translate_sentences(self, sentences):
+        '''
+        Translates a list of strings using all cdec processes at once.
+
+        :param sentences: list of natural language strings to be translated
+        :return: list of translation strings as returned by cdec, in the order of sentences
+        '''
+        out = [None] * len(sentences)
+        errors = []
+        todo = Queue.Queue()
+        for i, nl in enumerate(sentences):
+            todo.put((i, nl))
+
+        def work():
+            while True:
+                try:
+                    i, nl = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    out[i] = self.translate_sentence(nl)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=work) for _ in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return out
+
+    def close(self):
+        '''
+        Terminates all cdec processes.
+        '''
+        for session in self.sessions:
+            session.close()
+
+
+class TranslationCache:
+    '''
+    Memoizes cdec's output, so that translating the same input again with the same cdec configuration and weights
+    skips cdec. The key combines a fingerprint of the content of the configuration and weights files, kbest and the
+    input. The most recently used entries are kept in memory; given a path, all entries are also written to a
+    persistent Cache on disk. When the content of a weights file changes, the entries of its old weights are
+    dropped.
+    '''
+
+    def __init__(self, capacity=10000, path=None):
+        '''
+        Initialises the memory and, optionally, the disk cache.
+
+        :param capacity: the number of entries kept in memory
+        :param path: the file of the persistent cache, None to keep entries in memory only
+        '''
+        self.memory = Cache(capacity)
+        self.disk = None if path is None else Cache(path=path)
+        # the fingerprint last seen for each (ini, weights) pair and the content hash of each file with its
+        # size and modification time, so that unchanged files are not read again
+        self.fingerprints = {}
+        self.files = {}
+        # the keys put in memory for each fingerprint, some of which may since have been evicted
+        self.keys = {}
+
+    def translate_sentence(self, decoder_bin, ini, weights, nl, kbest=0):
+        '''
+        Memoized translate_sentence.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param nl: the natural language string to be translated
+        :param kbest: the size of the kbest list
+        :return: the translation string as returned by cdec
+        '''
+        key = self.key(ini, weights, nl, kbest)
+        out = self.get(key)
+        if out is None:
+            out = translate_sentence(decoder_bin, ini, weights, nl, kbest)
+            self.put(key, out)
+        return out
+
+    def translate(self, decoder_bin, ini, weights, nl_file, kbest=0, jobs=1):
+        '''
+        Memoized translate, keyed by the content of the input file.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param nl_file: the file containing sentences to be translated
+        :param kbest: the size of the kbest list
+        :param jobs: the number of cdec processes
+        :return: the translation string as returned by cdec
+        '''
+        key = self.key(ini, weights, "file:%s" % self._file_hash(nl_file), kbest)
+        out = self.get(key)
+        if out is None:
+            out = translate(decoder_bin, ini, weights, nl_file, kbest, jobs)
+            self.put(key, out)
+        return out
+
+    def key(self, ini, weights, nl, kbest=0):
+        '''
+        :param ini: the cdec configuration file
+        :param weights: a weights file or WeightsFile
+        :param nl: the natural language string to be translated
+        :param kbest: the size of the kbest list
+        :return: the cache key of the translation
+        '''
+        weights = _weights_path(weights)
+        fingerprint = hashlib.sha1("%s %s" % (self._file_hash(ini), self._file_hash(weights))).hexdigest()
+        old = self.fingerprints.get((ini, weights))
+        if old is not None and old != fingerprint:
+            self._drop(old)
+        self.fingerprints[(ini, weights)] = fingerprint
+        return "%s %s %s" % (fingerprint, kbest, nl)
+
+    def get(self, key):
+        '''
+        :param key: a key as returned by key
+        :return: the memoized output or None
+        '''
+        out = self.memory.get(key)
+        if out is None and self.disk is not None:
+            out = self.disk.get(key)
+            if out is not None:
+                self._remember(key, out)
+        instrumentation.count("translation_cache.misses" if out is None else "translation_cache.hits")
+        return out
+
+    def put(self, key, out):
+        '''
+        Memoizes an output. Empty output, e.g. of a crashed cdec, is not memoized.
+
+        :param key: a key as returned by key
+        :param out: the translation string as returned by cdec
+        '''
+        if not out:
+            return
+        self._remember(key, out)
+        if self.disk is not None:
+            self.disk.from_function(key, out)
+
+    def invalidate(self):
+        '''
+        Drops all memoized outputs.
+        '''
+        self.memory.clear()
+        self.keys.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def close(self):
+        '''
+        Writes all entries of the persistent cache to disk and closes its file.
+        '''
+        if self.disk is not None:
+            self.disk.close()
+
+    def _drop(self, fingerprint):
+        '''
+        Drops the memoized outputs of a configuration and weights fingerprint.
+
+        :param fingerprint: the fingerprint
+        '''
+        for key in self.keys.pop(fingerprint, ()):
+            if key in self.memory.dict:
+                self.memory.pop(key)
+        if self.disk is not None:
+            self.disk.dict.pop_prefix(fingerprint + " ")
+
+    def _remember(self, key, out):
+        '''
+        Puts an output in memory and indexes its key by fingerprint. Once the index of a fingerprint holds twice as
+        many keys as fit in a bounded memory, the evicted ones are removed from it.
+
+        :param key: a key as returned by key
+        :param out: the translation string as returned by cdec
+        '''
+        self.memory.from_function(key, out)
+        keys = self.keys.setdefault(key[:key.index(" ")], set())
+        keys.add(key)
+        if self.memory.capacity is not None and len(keys) > 2 * self.memory.capacity:
+            keys.intersection_update(self.memory.dict)
+
+    def _file_hash(self, path):
+        '''
+        :param path: a file
+        :return: the SHA-1 hash of the file's content, only read again if its size, modification time or inode
+        changed
+        '''
+        stat = os.stat(path)
+        # a file replaced by renaming, like a WeightsFile, gets a new inode even within the mtime's resolution
+        signature = (stat.st_size, stat.st_mtime, stat.st_ino)
+        known = self.files.get(path)
+        if known is not None and known[0] == signature:
+            return known[1]
+        digest = hashlib.sha1()
+        f = open(path, "rb")
+        for block in iter(lambda: f.read(1 << 20), ""):
+            digest.update(block)
+        f.close()
+        self.files[path] = (signature, digest.hexdigest())
+        return self.files[path][1]
+
+
+# cdec reads <seg> ids with atoi, so synchronisation sentences get numeric ids, counting down from the largest int
+# in a range far above any corpus position
+_SYNC_ID = 2 ** 31 - 1
+_SYNC_IDS = 1 << 20
+_SYNC_WORD = "nlpminionsync"
+_SYNC_ERROR = ("cdec printed no k-best list for the synchronisation sentence within %s seconds. Its [X] rule only "
+               "reaches the goal if %s keeps the hiero glue grammar (no scfg_no_hiero_glue_grammar) or sets goal=X.")
+_sync_grammar = None
+_sync_lock = threading.Lock()
+
+
+def _sync_segment(count):
+    '''
+    Builds the synchronisation sentence for a k-best DecoderSession: a word of its own with a per-sentence grammar
+    that translates it, which parses whatever the sentences and grammars of the session are.
+
+    :param count: the number of synchronisation sentences of the session so far
+    :return: the id cdec prints for the synchronisation sentence and the sentence
+    '''
+    sync_id = _SYNC_ID - count % _SYNC_IDS
+    return str(sync_id), '<seg id="%d" grammar="%s"> %s </seg>' % (sync_id, _sync_grammar_file(), _SYNC_WORD)
+
+
+def _is_sync_id(idval):
+    '''
+    :param idval: the id of a line of cdec's k-best output
+    :return: True if the line belongs to a synchronisation sentence
+    '''
+    return idval.isdigit() and _SYNC_ID - _SYNC_IDS < int(idval) <= _SYNC_ID
+
+
+def _sync_grammar_file():
+    '''
+    :return: the grammar of the synchronisation sentences, written once per process and removed at exit
+    '''
+    global _sync_grammar
+    with _sync_lock:
+        if _sync_grammar is None:
+            (fd, path) = tempfile.mkstemp(prefix="nlpminion-sync.", suffix=".grammar")
+            os.close(fd)
+            f = open(path, "w")
+            f.write("[X] ||| %s ||| %s ||| PassThrough=1\n" % (_SYNC_WORD, _SYNC_WORD))
+            f.close()
+            atexit.register(_remove_file, path)
+            _sync_grammar = path
+    return _sync_grammar
+
+
+def _remove_file(path):
+    '''
+    :param path: a file that may have been removed already
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+
+
 def bleu(script_path, references, input):
     '''
     Given a file to be scores and its true references, calls cdec's corpus-wide BLEU script
@@ -77,13 +900,15 @@ def bleu(script_path, references, input):
     :param script_path: the path where cdec's bleu script lies
     :param references: a file containing translation options for
     :param input: a file containg the sentence to be scored
-    :return: a corpus-wide BLEU score
+    :return: a corpus-wide BLEU score; file_bleu computes the same score in-process
     '''
     args = [script_path,
             '-r', references,
             '-i', input]
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    (out, err) = proc.communicate()
+    with instrumentation.timer("decoder.bleu"):
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+    instrumentation.count("decoder.processes")
     proc.stdout.close()
     proc.stderr.close()
     try:
@@ -93,6 +918,172 @@ def bleu(script_path, references, input):
     return out
 
 
+class BleuStats:
+    '''
+    The sufficient statistics of one hypothesis for corpus-wide BLEU: clipped n-gram matches and n-gram totals of
+    every order, the hypothesis length and the length of the closest reference.
+    '''
+
+    def __init__(self, nl, references, n=4):
+        '''
+        Counts the statistics of a hypothesis. Like cdec's fast_score, the reference length is the length of the
+        closest reference, and on a draw the shorter one.
+
+        :param nl: a natural language string to be investigated
+        :param references: the nl's true translation option(s), either as list of strings or as ReferenceIndex
+        :param n: order of n-gram
+        '''
+        if not isinstance(references, ReferenceIndex):
+            references = ReferenceIndex([" ".join(ref.split()) for ref in references], n)
+        words = nl.split()
+        self.hyp_len = len(words)
+        self.ref_len = min(references.lengths, key=lambda length: (abs(self.hyp_len - length), length))
+        self.matches = []
+        self.totals = []
+        for i in range(1, n + 1):
+            input_ngrams = Counter(zip(*[words[j:] for j in range(i)]))
+            self.matches.append(sum(min(count, references.ngrams[i][ngram]) for ngram, count in input_ngrams.items()))
+            self.totals.append(max(self.hyp_len - i + 1, 0))
+
+
+class CorpusBleu:
+    '''
+    Corpus-wide BLEU computed in-process from the sum of the BleuStats of all sentences. Sentences can be added
+    and removed individually, so replacing one hypothesis updates the corpus score in constant time.
+    '''
+
+    def __init__(self, n=4):
+        '''
+        Initialises empty statistics.
+
+        :param n: order of n-gram
+        '''
+        self.n = n
+        self.matches = [0] * n
+        self.totals = [0] * n
+        self.hyp_len = 0
+        self.ref_len = 0
+
+    def add(self, stats):
+        '''
+        Adds a sentence's statistics to the corpus.
+
+        :param stats: BleuStats of the sentence
+        '''
+        self._update(stats, 1)
+
+    def remove(self, stats):
+        '''
+        Removes a sentence's statistics, which have been added before, from the corpus.
+
+        :param stats: BleuStats of the sentence
+        '''
+        self._update(stats, -1)
+
+    def replace(self, old, new):
+        '''
+        Swaps the hypothesis of one sentence.
+
+        :param old: BleuStats of the hypothesis currently in the corpus
+        :param new: BleuStats of the hypothesis replacing it
+        '''
+        self._update(old, -1)
+        self._update(new, 1)
+
+    def _update(self, stats, sign):
+        '''
+        Adds sign times a sentence's statistics to the corpus statistics.
+
+        :param stats: BleuStats of the sentence
+        :param sign: 1 for adding, -1 for removing
+        '''
+        for i in range(self.n):
+            self.matches[i] += sign * stats.matches[i]
+            self.totals[i] += sign * stats.totals[i]
+        self.hyp_len += sign * stats.hyp_len
+        self.ref_len += sign * stats.ref_len
+
+    def score(self):
+        '''
+        :return: the corpus-wide BLEU score
+        '''
+        if self.hyp_len == 0 or 0 in self.matches:
+            return 0.0
+        log_bleu = sum(math.log(float(self.matches[i]) / self.totals[i]) for i in range(self.n)) / self.n
+        log_bleu += min(0.0, 1.0 - float(self.ref_len) / self.hyp_len)
+        return math.exp(log_bleu)
+
+    def __str__(self):
+        '''
+        :return: the corpus-wide BLEU score formatted like the output of cdec's fast_score
+        '''
+        return "%g" % self.score()
+
+
+def corpus_bleu(references, hypotheses, n=4):
+    '''
+    In-process replacement for bleu that needs no files: computes corpus-wide BLEU for a list of hypotheses.
+
+    :param references: list with the true translation option(s) of each sentence, each a list of strings or a
+    ReferenceIndex
+    :param hypotheses: list of natural language strings to be scored
+    :param n: order of n-gram
+    :return: a CorpusBleu object, str() of it gives fast_score's output
+    '''
+    corpus = CorpusBleu(n)
+    for nl, refs in zip(hypotheses, references):
+        corpus.add(BleuStats(nl, refs, n))
+    return corpus
+
+
+def file_bleu(references, input, n=4):
+    '''
+    In-process drop-in for bleu that takes the same files: computes corpus-wide BLEU with corpus_bleu instead of
+    calling cdec's fast_score.
+
+    :param references: a file with the true translation option(s) of one sentence per line, separated by |||
+    :param input: a file containing the sentences to be scored, one per line
+    :param n: order of n-gram
+    :return: a corpus-wide BLEU score as string, formatted like the output of cdec's fast_score
+    '''
+    with instrumentation.timer("decoder.file_bleu"):
+        f = open(references, "r")
+        refs = [[ref.strip() for ref in line.split(" ||| ")] for line in f]
+        f.close()
+        f = open(input, "r")
+        hyps = [line.strip() for line in f]
+        f.close()
+        return "%s\n" % corpus_bleu(refs, hyps, n)
+
+
+class ReferenceIndex:
+    '''
+    The n-gram counts and lengths of a sentence's reference(s). Building it once per source sentence allows
+    scoring many hypotheses, e.g. a k-best list, with per_sentence_bleu without tokenizing the references again.
+    '''
+
+    def __init__(self, references, n=4):
+        '''
+        Counts the n-grams of all orders 1 to n in the references. For each n-gram the maximum count over all
+        references is kept, which is the count a hypothesis n-gram is clipped to.
+
+        :param references: a sentence's true translation option(s)
+        :param n: highest order of n-gram
+        '''
+        self.n = n
+        self.lengths = [len(ref.split()) for ref in references]
+        self.longest = max(self.lengths)
+        # length used for the brevity penalty, tokenized as per_sentence_bleu always did
+        self.match_lengths = [len(ref.strip().split(" ")) for ref in references]
+        self.ngrams = [None]
+        for i in range(1, n + 1):
+            counts = Counter()
+            for ref in references:
+                counts |= Counter(zip(*[ref.split(" ")[j:] for j in range(i)]))
+            self.ngrams.append(counts)
+
+
+@instrumentation.timed("bleu.per_sentence_bleu")
 def per_sentence_bleu(nl, references, n=4, smooth=0.0):
     '''
     Implementation of per-sentence BLEU as defined by (Nakov et al., 2012).
@@ -102,16 +1093,18 @@ def per_sentence_bleu(nl, references, n=4, smooth=0.0):
     Optionally changed the n-gram size via n and a smoothing parameter via smooth.
 
     :param nl: a natural language string to be investigated
-    :param references: the nl's true translation option(s)
+    :param references: the nl's true translation option(s), either as list of strings or as ReferenceIndex
     :param n: order of n-gram
     :param smooth: smoothing value
     :return: per-sentence BLEU score
     '''
     if nl.strip() == "":
         return 0.0  # no translation
+    if not isinstance(references, ReferenceIndex):
+        references = ReferenceIndex(references, n)
     log_bleu = 0.0
     # get longest ref
-    longest_ref = max(len(ref.split()) for ref in references)
+    longest_ref = references.longest
     for i in range(1, n + 1):  # 1 to n-gram
         try:
             log_bleu += ngram(nl, references, i)
@@ -121,27 +1114,109 @@ def per_sentence_bleu(nl, references, n=4, smooth=0.0):
     # word penalty calculations
     input_len = len(nl.strip().split(" "))
     # adding the ref len outside the abs again allows us to pick the smaller ref when there is a draw
-    diff = [math.fabs(input_len - len(ref.split())) + len(ref.split()) for enum, ref in enumerate(references)]
-    best_match_length = len(references[diff.index(min(diff))].strip().split(" "))
+    diff = [math.fabs(input_len - length) + length for length in references.lengths]
+    best_match_length = references.match_lengths[diff.index(min(diff))]
     brevity_penalty = min(0.0, 1.0 - ((best_match_length + smooth) / input_len))
     log_bleu += brevity_penalty
     return math.exp(log_bleu)
 
 
+@instrumentation.timed("bleu.per_sentence_bleu_batch")
+def per_sentence_bleu_batch(nls, references, n=4, smooth=0.0):
+    '''
+    Computes per_sentence_bleu for many hypotheses of the same sentence at once, e.g. a whole k-best list.
+    The n-gram matching is done with array operations over all hypotheses; the scores are identical to calling
+    per_sentence_bleu on each hypothesis.
+
+    :param nls: list of natural language strings or Translation objects to be investigated
+    :param references: the true translation option(s), either as list of strings or as ReferenceIndex
+    :param n: order of n-gram
+    :param smooth: smoothing value
+    :return: numpy array with the per-sentence BLEU score of each hypothesis
+    '''
+    nls = [getattr(nl, "string", nl) for nl in nls]
+    instrumentation.count("bleu.hypotheses", len(nls))
+    if not isinstance(references, ReferenceIndex):
+        references = ReferenceIndex(references, n)
+    if n > references.n:
+        raise IndexError("reference index holds n-grams up to order %s only" % references.n)
+    vocab = dict((unigram[0], i) for i, unigram in enumerate(references.ngrams[1]))
+    size = len(vocab)
+    tokens = [nl.split(" ") for nl in nls]
+    lengths = np.array([len(toks) for toks in tokens], dtype=np.int64)
+    hyps = np.repeat(np.arange(len(nls)), lengths)
+    # position of each token within its hypothesis
+    positions = np.arange(len(hyps)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    # tokens that are not in any reference cannot be part of a matching n-gram and are marked with -1
+    ids = np.array([vocab.get(tok, -1) for toks in tokens for tok in toks] + [-1] * n, dtype=np.int64)
+    # log of every count that can occur, computed with math.log to give exactly per_sentence_bleu's values
+    log = np.array([0.0] + [math.log(i) for i in range(1, int(lengths.max(initial=0)) + 2)])
+
+    log_bleu = np.zeros(len(nls))
+    zero = np.array([nl.strip() == "" for nl in nls], dtype=bool)
+    for i in range(1, n + 1):
+        add = 1 if i >= 2 else 0
+        ref_items = sorted((_ngram_code(ngram, vocab, size), count) for ngram, count in references.ngrams[i].items())
+        ref_codes = np.array([code for code, count in ref_items], dtype=np.int64)
+        ref_counts = np.array([count for code, count in ref_items], dtype=np.int64)
+        starts = np.nonzero(positions <= lengths[hyps] - i)[0]
+        codes = np.zeros(len(starts), dtype=np.int64)
+        valid = np.ones(len(starts), dtype=bool)
+        for j in range(i):
+            word = ids[starts + j]
+            valid &= word >= 0
+            codes = codes * size + word
+        codes = codes[valid]
+        matched = np.searchsorted(ref_codes, codes)
+        found = matched < len(ref_codes)
+        found[found] = ref_codes[matched[found]] == codes[found]
+        keys = hyps[starts[valid][found]] * len(ref_codes) + matched[found]
+        keys, counts = np.unique(keys, return_counts=True)
+        clipped = np.minimum(counts, ref_counts[keys % max(len(ref_codes), 1)])
+        count_clipped = np.bincount(keys // max(len(ref_codes), 1), weights=clipped,
+                                    minlength=len(nls)).astype(np.int64)
+        count_input = np.maximum(lengths - i + 1, 0)
+        zero |= count_clipped + add == 0
+        log_bleu = log_bleu + (log[count_clipped + add] - log[count_input + add])
+    log_bleu = log_bleu / min(n, references.longest)
+    input_len = np.array([len(nl.strip().split(" ")) for nl in nls], dtype=np.float64)
+    ref_lengths = np.array(references.lengths, dtype=np.float64)
+    diff = np.fabs(input_len[:, None] - ref_lengths[None, :]) + ref_lengths[None, :]
+    best_match_length = np.array(references.match_lengths, dtype=np.float64)[np.argmin(diff, axis=1)]
+    brevity_penalty = np.minimum(0.0, 1.0 - ((best_match_length + smooth) / input_len))
+    log_bleu = log_bleu + brevity_penalty
+    return np.array([0.0 if zero[h] else math.exp(log_bleu[h]) for h in range(len(nls))])
+
+
+def _ngram_code(ngram, vocab, size):
+    '''
+    :param ngram: tuple of words that all are in vocab
+    :param vocab: dictionary from word to id
+    :param size: size of vocab
+    :return: a unique integer code for the n-gram
+    '''
+    code = 0
+    for word in ngram:
+        code = code * size + vocab[word]
+    return code
+
+
 def ngram(nl, references, n):
     '''
     Given a sentence to be scored and its reference, counts how many (clipped) n-gram in the sentence
-    are also in the reference.
+    are also in the reference. Each n-gram is clipped to its maximum count in any of the references.
 
     :param nl: a natural language string to be investigated
-    :param references: the nl's true translation option(s)
+    :param references: the nl's true translation option(s), either as list of strings or as ReferenceIndex
     :param n: order of n-gram
     :return: the n-gram based precision of this n-gram order
     '''
+    if not isinstance(references, ReferenceIndex):
+        references = ReferenceIndex(references, n)
+    if n > references.n:
+        raise IndexError("reference index holds n-grams up to order %s only" % references.n)
     input_ngrams = Counter(zip(*[nl.split(" ")[i:] for i in range(n)]))
-    references_ngrams = []
-    for ref in references:
-        references_ngrams = Counter(zip(*[ref.split(" ")[i:] for i in range(n)]))
+    references_ngrams = references.ngrams[n]
     count_input_ngrams = 0
     count_clipped = 0
     if n >= 2:
@@ -1,14 +1,47 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import gzip
-from abstract_sparse_vector import AbstractSparseVector
+import struct
+import zlib
+import numpy as np
+from math import sqrt
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+from abstract_sparse_vector import AbstractSparseVector, BackgroundWrite, _read_lines, _gc_paused, _formatted_blocks
+from abstract_sparse_vector import _write_gz
+import instrumentation
 from decimal import Decimal
 
 class FeatureVector(AbstractSparseVector):
     '''
     A sparse vector holding the information of features from cdec's translation system
+
+    Multiplying with a scalar in place only changes a global scale factor, which is applied to the stored values
+    the next time the dictionary is accessed. The kernels axpy, dot, the norms and the in place operators work on
+    the stored values and the scale factor directly.
     '''
 
+    @property
+    def dict(self):
+        '''
+        :return: the dictionary from feature name to value
+        '''
+        if self.scale != 1.0:
+            scale = self.scale
+            self._dict = dict((key, val * scale) for key, val in self._dict.items())
+            self.scale = 1.0
+        return self._dict
+
+    @dict.setter
+    def dict(self, values):
+        '''
+        :param values: a dictionary from feature name to value replacing the vector's content
+        '''
+        self._dict = values
+        self.scale = 1.0
+
     def from_string(self, string, item_sep=" ", key_val_sep="="):
         '''
         Takes a string and adds it to the dictionary.
@@ -17,9 +50,12 @@ class FeatureVector(AbstractSparseVector):
         :param item_sep: the symbol that separates different entries
         :param key_val_sep: the symbol that separates key and value
         '''
-        for feature in string.split(item_sep):
+        values = self.dict
+        features = string.split(item_sep)
+        for feature in features:
             (key, val) = feature.split(key_val_sep)
-            self.dict[key] = float(val)
+            values[key] = float(val)
+        instrumentation.count("feature_vector.features_parsed", len(features))
 
     def from_function(self, key, val):
         '''
@@ -37,10 +73,11 @@ class FeatureVector(AbstractSparseVector):
         :param in_file: input file to be parsed
         :param sep: the symbol that separates key and value
         '''
+        values = self.dict
         f = open(in_file, "r")
         for line in f:
             (key, val) = tuple(line.strip().split(sep, 1))
-            self.dict[key] = float(val)
+            values[key] = float(val)
         f.close()
 
     def from_gz_file(self, in_file, sep=" "):
@@ -50,12 +87,29 @@ class FeatureVector(AbstractSparseVector):
         :param in_file: input file to be parsed
         :param sep: the symbol that separates key and value
         '''
+        values = self.dict
         f = gzip.open(in_file, "rb")
         for line in f:
             (key, val) = tuple(line.strip().split(sep, 1))
-            self.dict[key] = float(val)
+            values[key] = float(val)
         f.close()
 
+    def bulk_load(self, in_file, sep=" ", jobs=1, progress=None):
+        '''
+        Read key-value pairs from a plain or .gz file like from_file and from_gz_file, but in large blocks and with
+        optionally parallel decompression, which is much faster for files with millions of lines.
+
+        :param in_file: input file to be parsed
+        :param sep: the symbol that separates key and value
+        :param jobs: the number of threads decompressing a .gz file with several members
+        :param progress: a function called with the number of bytes read so far and the file size
+        '''
+        with _gc_paused():
+            for lines in _read_lines(in_file, jobs, progress=progress):
+                pairs = [line.split(sep, 1) for line in lines if line]
+                self.dict.update(zip([key.strip() for key, val in pairs], map(float, [val for key, val in pairs])))
+                instrumentation.count("feature_vector.features_parsed", len(pairs))
+
     def to_file(self, out_file, sep=" "):
         '''
         Writes the dictionar's key-value pairs to a file.
@@ -63,9 +117,10 @@ class FeatureVector(AbstractSparseVector):
         :param out_file: file to be written to
         :param sep: the symbol that separates key and value
         '''
+        values = self.dict
         f = open(out_file, "w")
-        for key in sorted(self.dict):
-            format = ("%.16f" % self.dict[key]).rstrip("0")
+        for key in sorted(values):
+            format = ("%.16f" % values[key]).rstrip("0")
             if format.endswith("."):
                 format = format+"0"
             print >> f, "%s%s%s" % (key, sep, format)
@@ -73,59 +128,181 @@ class FeatureVector(AbstractSparseVector):
             #print >> f, "%s%s%s" % (key, sep, Decimal(self.dict[key]))
         f.close()
 
-    def to_gz_file(self, out_file, sep=" "):
+    def from_binary_file(self, in_file):
+        '''
+        Read key-value pairs from a file written by to_binary_file.
+
+        :param in_file: input file to be read
+        '''
+        (names, values) = _read_binary(in_file)
+        self.dict.update(zip(names, values.tolist()))
+
+    def to_binary_file(self, out_file):
+        '''
+        Writes the dictionar's key-value pairs to a binary file: a table of the sorted keys followed by their values
+        as a float64 array, which map_binary_file can map into memory without parsing.
+
+        :param out_file: file to be written to
+        '''
+        names = sorted(self.dict)
+        _write_binary(out_file, names, np.array([self.dict[key] for key in names], dtype=np.float64))
+
+    def to_gz_file(self, out_file, sep=" ", level=9, jobs=1, background=False):
         '''
         Writes the dictionar's key-value pairs to a .gz file.
 
         :param out_file: file to be written to
         :param sep: the symbol that separates key and value
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param jobs: the number of threads compressing blocks of the file as separate gz members
+        :param background: if True, a copy of the vector is written by a BackgroundWrite while the caller goes on
+        :return: the BackgroundWrite if background is True
         '''
-        f = gzip.open(out_file, "wb")
-        for key in self.dict:
-            format = ("%.16f" % self.dict[key]).rstrip("0") #16f
-            if format.endswith("."): #16f ensure .0
-                format = format+"0"
-            print >> f, "%s%s%s" % (key, sep, format)
-            #f.write("%s%s%s\n" % (key, sep, self.dict[key])) #ori
-            #f.write("%s%s%s\n" % (key, sep, Decimal(self.dict[key]))) #decimal
-        f.close()
+        if background:
+            return BackgroundWrite(self.copy().to_gz_file, out_file, sep, level, jobs)
+        values = self.dict
 
-    def __add__(self, x):
+        def format(keys):
+            return "".join(["%s%s%s\n" % (key, sep, _format(values[key])) for key in keys])
+
+        _write_gz(out_file, _formatted_blocks(values, format), level, jobs)
+
+    def copy(self):
+        '''
+        :return: a new FeatureVector with the same values
         '''
-        Performs an in place element wise summation given a second FeatureVector
+        vector = FeatureVector()
+        vector.dict = dict(self.dict)
+        return vector
 
-        :param x: the second FeatureVector
+    def axpy(self, alpha, x):
         '''
-        for key in x.dict:
-            if key in self.dict:
-                self.dict[key] = self.dict[key] + x.dict[key]
-            else:
-                self.dict[key] = x.dict[key]
+        Performs an in place element wise summation with alpha times a second vector, without allocating alpha * x.
+
+        :param alpha: a scalar
+        :param x: the second FeatureVector or IndexedFeatureVector
+        '''
+        values = self._dict
+        factor = alpha / self.scale
+        if isinstance(x, FeatureVector):
+            factor *= x.scale
+            x = x._dict.items()
+        for key, val in x:
+            values[key] = values.get(key, 0.0) + factor * val
         return self
 
-    def __sub__(self, x):
+    def dot(self, x):
+        '''
+        :param x: the second FeatureVector or IndexedFeatureVector
+        :return: the dot product of both vectors
         '''
-        Performs an in place element wise substraction given a second FeatureVector
+        values = self._dict
+        if isinstance(x, FeatureVector):
+            (small, large) = (values, x._dict) if len(values) < len(x._dict) else (x._dict, values)
+            return self.scale * x.scale * sum(val * large.get(key, 0.0) for key, val in small.items())
+        return self.scale * sum(val * values.get(key, 0.0) for key, val in x)
 
-        :param x: the second FeatureVector
+    def l1_norm(self):
         '''
-        for key in x.dict:
-            if key in self.dict:
-                self.dict[key] = self.dict[key] - x.dict[key]
-            else:
-                self.dict[key] = 0 - x.dict[key]
+        :return: the sum of the absolute values
+        '''
+        return abs(self.scale) * sum(abs(val) for val in self._dict.values())
+
+    def l2_norm(self):
+        '''
+        :return: the euclidean length of the vector
+        '''
+        return abs(self.scale) * sqrt(sum(val * val for val in self._dict.values()))
+
+    def clip(self, threshold):
+        '''
+        Limits all values in place to the range from -threshold to threshold.
+
+        :param threshold: the largest absolute value
+        '''
+        values = self.dict
+        for key, val in values.items():
+            if val > threshold:
+                values[key] = threshold
+            elif val < -threshold:
+                values[key] = -threshold
         return self
 
-    def __mul__(self, x):
+    def prune(self, threshold=0.0):
         '''
-        Performs an in place element wise multiplication given a scalar
+        Deletes all entries whose absolute value is not larger than threshold.
 
-        :param x: the second FeatureVector
+        :param threshold: the largest absolute value that is deleted
         '''
-        for key in self.dict:
-            self.dict[key] = self.dict[key] * x
+        self.dict = dict((key, val) for key, val in self.dict.items() if abs(val) > threshold)
         return self
 
+    def __iadd__(self, x):
+        '''
+        Performs an in place element wise summation given a second vector
+
+        :param x: the second FeatureVector or IndexedFeatureVector
+        '''
+        return self.axpy(1.0, x)
+
+    def __isub__(self, x):
+        '''
+        Performs an in place element wise substraction given a second vector
+
+        :param x: the second FeatureVector or IndexedFeatureVector
+        '''
+        return self.axpy(-1.0, x)
+
+    def __imul__(self, x):
+        '''
+        Performs an in place element wise multiplication given a scalar, in constant time by changing the scale
+        factor
+
+        :param x: the scalar
+        '''
+        self.scale *= x
+        if abs(self.scale) < 1e-50:
+            # a zero or vanishing scale could not be divided by in axpy
+            self.dict
+        return self
+
+    def __add__(self, x):
+        '''
+        Performs an element wise summation given a second vector
+
+        :param x: the second FeatureVector or IndexedFeatureVector
+        :return: a new FeatureVector
+        '''
+        return self.copy().axpy(1.0, x)
+
+    def __sub__(self, x):
+        '''
+        Performs an element wise substraction given a second vector
+
+        :param x: the second FeatureVector or IndexedFeatureVector
+        :return: a new FeatureVector
+        '''
+        return self.copy().axpy(-1.0, x)
+
+    def __mul__(self, x):
+        '''
+        Performs an element wise multiplication given a scalar
+
+        :param x: the scalar
+        :return: a new FeatureVector
+        '''
+        vector = self.copy()
+        vector *= x
+        return vector
+
+    __rmul__ = __mul__
+
+    def __iter__(self):
+        '''
+        Provides an iterator over the dictionaries keys
+        '''
+        return iter(self.dict.items())
+
     def __repr__(self):
         '''
         Returns a representation of this class
@@ -135,4 +312,891 @@ class FeatureVector(AbstractSparseVector):
             print_dict += "'%s': %s, " % (key, str(self.dict[key]))
         print_dict = print_dict[:-2]
         print_dict += "}"
-        return print_dict
\ No newline at end of file
+        return print_dict
+
+
+class FeatureVocabulary(object):
+    '''
+    Maps feature names to consecutive integer ids, so that vectors sharing the vocabulary store every name only once.
+    '''
+
+    hashed = False
+
+    def __init__(self, names=()):
+        '''
+        Initialises a vocabulary
+
+        :param names: feature names that get the ids 0, 1, ...
+        '''
+        self.names = list(names)
+        self.ids = dict(zip(self.names, range(len(self.names))))
+
+    def id(self, name):
+        '''
+        :param name: a feature name
+        :return: the name's id, a new id is assigned to names that have not been seen before
+        '''
+        i = self.ids.get(name)
+        if i is None:
+            i = len(self.names)
+            self.ids[name] = i
+            self.names.append(name)
+        return i
+
+    def lookup(self, name):
+        '''
+        :param name: a feature name
+        :return: the name's id or None if the name has not been seen before
+        '''
+        return self.ids.get(name)
+
+    def encode(self, pairs, add=True):
+        '''
+        :param pairs: a list of (name, value) pairs, values may still be strings
+        :param add: if False, pairs whose name has not been seen before are left out instead of getting a new id
+        :return: the ids and values as two arrays
+        '''
+        (keys, values) = _columns(pairs)
+        return self.encode_columns(keys, values, add)
+
+    def encode_columns(self, keys, values, add=True):
+        '''
+        :param keys: a list of feature names
+        :param values: a list of their values, which may still be strings
+        :param add: if False, names that have not been seen before are left out instead of getting a new id
+        :return: the ids and values as two arrays
+        '''
+        known = self.ids
+        ids = list(map(known.get, keys))
+        # only names that have not been seen before need the method call
+        if None in ids:
+            if add:
+                ids = [self.id(key) if i is None else i for key, i in zip(keys, ids)]
+            else:
+                values = [val for i, val in zip(ids, values) if i is not None]
+                ids = [i for i in ids if i is not None]
+        return np.array(ids, dtype=np.int32), np.array(list(map(float, values)), dtype=np.float64)
+
+    def decode(self, ids, values, every=False):
+        '''
+        :param ids: an array of ids
+        :param values: an array of the ids' values
+        :param every: ignored, every id has one name
+        :return: a list of (name, value) pairs
+        '''
+        names = self.names
+        return [(names[i], val) for i, val in zip(ids.tolist(), values.tolist())]
+
+    def __len__(self):
+        '''
+        :return: the number of feature names in the vocabulary
+        '''
+        return len(self.names)
+
+
+class HashedFeatureVocabulary(FeatureVocabulary):
+    '''
+    Maps feature names to a fixed number of 2^bits ids by hashing (Weinberger et al., 2009), so that vectors and
+    optimizer state over the vocabulary take constant memory however many features, e.g. RuleIdentityFeatures,
+    the grammar produces. A second part of the hash gives every name a sign its values are multiplied with, so
+    that the values of names sharing an id cancel out in expectation instead of adding up.
+
+    Only the first name seen for each id is kept, so that the vocabulary stays bounded, to write weights files and to
+    name the entries of vectors. With collisions set, the other names of every id are recorded as well for
+    collision_report. The further names cdec needs weights for are taken from its output by decoder.WeightsFile.
+    '''
+
+    hashed = True
+
+    def __init__(self, bits=20, collisions=False):
+        '''
+        Initialises a vocabulary
+
+        :param bits: the number of ids is 2^bits, at most 2^30
+        :param collisions: if True, records all names sharing an id
+        '''
+        if not 1 <= bits <= 30:
+            raise ValueError("bits must be between 1 and 30")
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        # id -> the first name hashed to it, id -> the set of further names if collisions are recorded, and the
+        # (id, name) pairs of the ids named since take_recorded was last called, at most one per id
+        self.names = {}
+        self.collisions = {} if collisions else None
+        self.recorded = []
+
+    def hash(self, name):
+        '''
+        :param name: a feature name
+        :return: the name's id and sign
+        '''
+        h = zlib.crc32(name if isinstance(name, bytes) else name.encode("utf-8")) & 0xffffffff
+        return h & self.mask, -1.0 if h >> 31 else 1.0
+
+    def id(self, name):
+        '''
+        :param name: a feature name
+        :return: the name's id
+        '''
+        (i, sign) = self.hash(name)
+        self.record(i, name)
+        return i
+
+    def lookup(self, name):
+        '''
+        :param name: a feature name
+        :return: the name's id
+        '''
+        return self.hash(name)[0]
+
+    def encode(self, pairs, add=True):
+        '''
+        :param pairs: a list of (name, value) pairs, values may still be strings
+        :param add: ignored, every name has an id
+        :return: the ids and the values multiplied with their names' signs as two arrays; names sharing an id are
+        not combined
+        '''
+        (keys, values) = _columns(pairs)
+        return self.encode_columns(keys, values, add)
+
+    def encode_columns(self, keys, values, add=True):
+        '''
+        :param keys: a list of feature names
+        :param values: a list of their values, which may still be strings
+        :param add: ignored, every name has an id
+        :return: the ids and the values multiplied with their names' signs as two arrays; names sharing an id are
+        not combined
+        '''
+        ids = []
+        signs = []
+        for key in keys:
+            (i, sign) = self.hash(key)
+            self.record(i, key)
+            ids.append(i)
+            signs.append(sign)
+        return np.array(ids, dtype=np.int32), np.array(signs) * np.array(list(map(float, values)), dtype=np.float64)
+
+    def decode(self, ids, values, every=False):
+        '''
+        :param ids: an array of ids
+        :param values: an array of the ids' values
+        :param every: if True and collisions are recorded, pairs follow for the further names of an id as well
+        :return: a list of (name, value) pairs with the first name seen for each id and its value, i.e. the id's
+        value multiplied with the name's sign; ids without a name are called hash_<id>
+        '''
+        pairs = []
+        collisions = self.collisions
+        for i, val in zip(ids.tolist(), values.tolist()):
+            name = self.names.get(i)
+            if name is None:
+                pairs.append(("hash_%d" % i, val))
+                continue
+            pairs.append((name, self.hash(name)[1] * val))
+            if every and collisions is not None and i in collisions:
+                pairs.extend((other, self.hash(other)[1] * val) for other in sorted(collisions[i]))
+        return pairs
+
+    def collision_report(self):
+        '''
+        :return: a dictionary with the number of ids in use, the number of ids shared by several names and, if
+        collisions are recorded, the sorted names of every shared id
+        '''
+        if self.collisions is None:
+            raise ValueError("collisions are not recorded")
+        return {"ids": len(self.names),
+                "shared": len(self.collisions),
+                "collisions": dict((i, sorted(names | set([self.names[i]])))
+                                   for i, names in self.collisions.items())}
+
+    def record(self, i, name):
+        '''
+        Remembers the first name of an id and, if collisions are recorded, any further one.
+
+        :param i: the name's id
+        :param name: a feature name
+        '''
+        known = self.names.get(i)
+        if known is None:
+            self.names[i] = name
+            self.recorded.append((i, name))
+        elif known != name and self.collisions is not None:
+            self.collisions.setdefault(i, set()).add(name)
+
+    def take_recorded(self):
+        '''
+        :return: a list of the (id, name) pairs of the ids named since the last call, e.g. to hand them to other
+        processes
+        '''
+        (recorded, self.recorded) = (self.recorded, [])
+        return recorded
+
+    def __len__(self):
+        '''
+        :return: the number of ids, 2^bits
+        '''
+        return self.mask + 1
+
+
+# the vocabulary IndexedFeatureVectors share unless given their own
+vocabulary = FeatureVocabulary()
+
+# the hashed vocabulary HashedFeatureVectors share unless given their own, 2^20 ids
+hashed_vocabulary = HashedFeatureVocabulary()
+
+
+class IndexedFeatureVector(AbstractSparseVector):
+    '''
+    A FeatureVector that holds feature ids from a shared FeatureVocabulary and their values in NumPy arrays, either
+    as sorted id/value pairs (sparse) or as one value per vocabulary entry (dense). The dict attribute is a view
+    whose reads and writes go to the arrays; dense vectors omit zero entries from it. Entries set one at a time with
+    from_function or through the dict view are buffered by sparse vectors and merged into the arrays the next time
+    these are used.
+
+    Over a HashedFeatureVocabulary, names sharing an id can not be told apart: the values of different names of an
+    id in one input, e.g. one string, file or batch of buffered entries, add up, and the sum replaces the id's value.
+    '''
+
+    def __init__(self, vocab=None, dense=False):
+        '''
+        Initialises an empty vector.
+
+        :param vocab: the FeatureVocabulary to use, the module's shared vocabulary by default
+        :param dense: if True, stores a value for every feature in the vocabulary
+        '''
+        self.vocab = vocabulary if vocab is None else vocab
+        self.dense = dense
+        # (name, value) pairs of from_function not yet merged into the arrays
+        self._pending = []
+        if dense:
+            self.ids = None
+            self.values = np.zeros(len(self.vocab))
+        else:
+            self.ids = np.zeros(0, dtype=np.int32)
+            self.values = np.zeros(0)
+
+    @property
+    def ids(self):
+        '''
+        :return: the sorted ids of a sparse vector's entries, None for a dense vector
+        '''
+        if self._pending:
+            self._merge()
+        return self._ids
+
+    @ids.setter
+    def ids(self, ids):
+        '''
+        :param ids: the sorted ids of a sparse vector's entries, None for a dense vector
+        '''
+        if self._pending:
+            self._merge()
+        self._ids = ids
+
+    @property
+    def values(self):
+        '''
+        :return: the values of a sparse vector's entries or one value per id of a dense vector
+        '''
+        if self._pending:
+            self._merge()
+        return self._values
+
+    @values.setter
+    def values(self, values):
+        '''
+        :param values: the values of a sparse vector's entries or one value per id of a dense vector
+        '''
+        if self._pending:
+            self._merge()
+        self._values = values
+
+    @property
+    def dict(self):
+        '''
+        :return: a mapping from feature name to value that reads and writes the vector
+        '''
+        return _VectorDict(self)
+
+    def from_string(self, string, item_sep=" ", key_val_sep="="):
+        '''
+        Takes a string and adds it to the vector.
+
+        :param string: string to be parsed
+        :param item_sep: the symbol that separates different entries
+        :param key_val_sep: the symbol that separates key and value
+        '''
+        # splitting at both separators at once saves a list per feature
+        keys = string.replace(key_val_sep, item_sep).split(item_sep)
+        if len(keys) != 2 * (string.count(item_sep) + 1):
+            raise ValueError("every feature needs a key and a value separated by %r" % key_val_sep)
+        self._assign(keys[0::2], keys[1::2])
+
+    def from_function(self, key, val):
+        '''
+        Receives a key and a value pair that can directly be inserted into the vector
+
+        :param key: key
+        :param val: value
+        '''
+        if self.dense:
+            self._assign([key], [val])
+        else:
+            self._pending.append((key, val))
+
+    def from_file(self, in_file, sep=" "):
+        '''
+        Read key-value pairs from a file. Assumes one entry per line.
+
+        :param in_file: input file to be parsed
+        :param sep: the symbol that separates key and value
+        '''
+        f = open(in_file, "r")
+        self._assign(*_columns([line.strip().split(sep, 1) for line in f]))
+        f.close()
+
+    def from_gz_file(self, in_file, sep=" "):
+        '''
+        Read key-value pairs from a .gz file. Assumes one entry per line.
+
+        :param in_file: input file to be parsed
+        :param sep: the symbol that separates key and value
+        '''
+        f = gzip.open(in_file, "rb")
+        self._assign(*_columns([line.strip().split(sep, 1) for line in f]))
+        f.close()
+
+    def to_file(self, out_file, sep=" "):
+        '''
+        Writes the vector's key-value pairs to a file, in the same format as FeatureVector.to_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        '''
+        f = open(out_file, "w")
+        for key, val in sorted(self):
+            f.write("%s%s%s\n" % (key, sep, _format(val)))
+        f.close()
+
+    def from_binary_file(self, in_file):
+        '''
+        Read key-value pairs from a file written by to_binary_file into this vector's vocabulary.
+
+        :param in_file: input file to be read
+        '''
+        (names, values) = _read_binary(in_file)
+        self._assign(names, values.tolist())
+
+    def to_binary_file(self, out_file):
+        '''
+        Writes the vector's key-value pairs to a binary file, in the same format as FeatureVector.to_binary_file.
+
+        :param out_file: file to be written to
+        '''
+        pairs = sorted(self.vocab.decode(*self._items()))
+        _write_binary(out_file, [key for key, val in pairs], np.array([val for key, val in pairs], dtype=np.float64))
+
+    def to_gz_file(self, out_file, sep=" ", level=9, jobs=1, background=False):
+        '''
+        Writes the vector's key-value pairs to a .gz file, in the same format as FeatureVector.to_gz_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param jobs: the number of threads compressing blocks of the file as separate gz members
+        :param background: if True, a copy of the vector is written by a BackgroundWrite while the caller goes on
+        :return: the BackgroundWrite if background is True
+        '''
+        if background:
+            return BackgroundWrite(self.copy().to_gz_file, out_file, sep, level, jobs)
+
+        def format(pairs):
+            return "".join(["%s%s%s\n" % (key, sep, _format(val)) for key, val in pairs])
+
+        with _gc_paused():
+            _write_gz(out_file, _formatted_blocks(self.vocab.decode(*self._items()), format), level, jobs)
+
+    def _assign(self, keys, values):
+        '''
+        Sets the values of a list of features; like for a dictionary, a later value of a name overrides an earlier
+        one and the values of other features are kept. Over a HashedFeatureVocabulary the values of different names
+        sharing an id add up.
+
+        :param keys: a list of feature names
+        :param values: a list of their values, which may still be strings
+        '''
+        if self.vocab.hashed:
+            # only the last value of a name counts, at the position of its last occurrence
+            last = dict(zip(keys, range(len(keys))))
+            if len(last) < len(keys):
+                keep = [n for n, key in enumerate(keys) if last[key] == n]
+                (keys, values) = ([keys[n] for n in keep], [values[n] for n in keep])
+        (ids, values) = self.vocab.encode_columns(keys, values)
+        if self.vocab.hashed:
+            (ids, inverse) = np.unique(ids, return_inverse=True)
+            values = np.bincount(inverse, weights=values, minlength=len(ids))
+        if self.dense:
+            self._grow()
+            self.values[ids] = values
+            return
+        if not self.vocab.hashed:
+            # np.unique returns the first occurrence, so searching the reversed arrays keeps the last value of each id
+            ids, last = np.unique(ids[::-1], return_index=True)
+            values = values[::-1][last]
+        known = self.ids
+        j = np.searchsorted(known, ids)
+        found = j < len(known)
+        found[found] = known[j[found]] == ids[found]
+        self.values[j[found]] = values[found]
+        # the new ids are inserted in one pass, np.insert places them before the entries at their positions
+        new = ~found
+        (self.ids, self.values) = (np.insert(known, j[new], ids[new]), np.insert(self.values, j[new], values[new]))
+
+    def _merge(self):
+        '''
+        Assigns the pairs buffered by from_function in one go.
+        '''
+        (pairs, self._pending) = (self._pending, [])
+        self._assign(*_columns(pairs))
+
+    def _find(self, key):
+        '''
+        :param key: a feature name
+        :return: the index of the name's value in values, None if the vector has no entry for it
+        '''
+        i = self.vocab.lookup(key)
+        if i is None:
+            return None
+        if self.dense:
+            return i if i < len(self.values) and self.values[i] != 0.0 else None
+        ids = self.ids
+        j = int(np.searchsorted(ids, i))
+        return j if j < len(ids) and ids[j] == i else None
+
+    def _sign(self, key):
+        '''
+        :param key: a feature name
+        :return: the factor between the name's value and the value stored for its id
+        '''
+        return self.vocab.hash(key)[1] if self.vocab.hashed else 1.0
+
+    def _get(self, key):
+        '''
+        :param key: a feature name
+        :return: the name's value, KeyError if the vector has no entry for it
+        '''
+        j = self._find(key)
+        if j is None:
+            raise KeyError(key)
+        return self._sign(key) * float(self.values[j])
+
+    def _cmpkey(self):
+        '''
+        :return: a dictionary from feature name to value for comparison
+        '''
+        return dict(self)
+
+    def _grow(self):
+        '''
+        Extends a dense vector with zeros for the features added to the vocabulary since it was created.
+        '''
+        if len(self.values) < len(self.vocab):
+            self.values = np.concatenate((self.values, np.zeros(len(self.vocab) - len(self.values))))
+
+    def _items(self):
+        '''
+        :return: the ids and values of the vector's entries as two arrays
+        '''
+        if self.dense:
+            ids = np.nonzero(self.values)[0]
+            return ids, self.values[ids]
+        return self.ids, self.values
+
+    def axpy(self, alpha, x):
+        '''
+        Performs an in place element wise summation with alpha times a second vector.
+
+        :param alpha: a scalar
+        :param x: an IndexedFeatureVector or FeatureVector
+        '''
+        if isinstance(x, IndexedFeatureVector) and x.vocab is self.vocab:
+            if self.dense and x.dense:
+                x._grow()
+                self._grow()
+                self.values[:len(x.values)] += alpha * x.values
+                return self
+            ids, values = x._items()
+        else:
+            ids, values = self.vocab.encode(list(x))
+        return self._add(ids, alpha * values)
+
+    def _add(self, ids, values):
+        '''
+        Adds values to the entries of ids in place.
+
+        :param ids: an array of ids, which may repeat over a HashedFeatureVocabulary
+        :param values: an array of the values to be added
+        '''
+        if self.dense:
+            self._grow()
+            if self.vocab.hashed:
+                np.add.at(self.values, ids, values)
+            else:
+                self.values[ids] += values
+            return self
+        self.ids, inverse = np.unique(np.concatenate((self.ids, ids)), return_inverse=True)
+        self.values = np.bincount(inverse, weights=np.concatenate((self.values, values)), minlength=len(self.ids))
+        return self
+
+    def pop(self, key, *default):
+        '''
+        Deletes a given key from the vector like dict.pop.
+
+        :param key: Key to be deleted.
+        :param default: the value returned if the vector has no entry for the key, else KeyError is raised
+        :return: the key's value
+        '''
+        j = self._find(key)
+        if j is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        val = self._sign(key) * float(self.values[j])
+        if self.dense:
+            self.values[j] = 0.0
+        else:
+            (self.ids, self.values) = (np.delete(self.ids, j), np.delete(self.values, j))
+        return val
+
+    def clear(self):
+        '''
+        Empties the whole vector.
+        '''
+        self._pending = []
+        if self.dense:
+            self.values = np.zeros(len(self.vocab))
+        else:
+            self.ids = np.zeros(0, dtype=np.int32)
+            self.values = np.zeros(0)
+
+    def __iter__(self):
+        '''
+        Provides an iterator over the vector's (name, value) pairs
+        '''
+        for pair in self.vocab.decode(*self._items()):
+            yield pair
+
+    def __len__(self):
+        '''
+        :return: the number of entries of the vector
+        '''
+        return len(self._items()[0])
+
+    def copy(self):
+        '''
+        :return: a new IndexedFeatureVector with the same vocabulary, mode and values
+        '''
+        vector = self.__class__(self.vocab, self.dense)
+        vector.ids = None if self.dense else self.ids.copy()
+        vector.values = np.array(self.values)
+        return vector
+
+    def dot(self, x):
+        '''
+        :param x: the second IndexedFeatureVector or FeatureVector
+        :return: the dot product of both vectors
+        '''
+        if not isinstance(x, IndexedFeatureVector) or x.vocab is not self.vocab:
+            values = x.dict
+            return sum(val * values.get(key, 0.0) for key, val in self)
+        if self.dense and x.dense:
+            n = min(len(self.values), len(x.values))
+            return float(np.dot(self.values[:n], x.values[:n]))
+        if x.dense:
+            return x.dot(self)
+        if self.dense:
+            known = x.ids < len(self.values)
+            return float(np.dot(self.values[x.ids[known]], x.values[known]))
+        (common, i, j) = np.intersect1d(self.ids, x.ids, assume_unique=True, return_indices=True)
+        return float(np.dot(self.values[i], x.values[j]))
+
+    def top(self, n=10):
+        '''
+        :param n: the number of entries
+        :return: a list of the (name, value) pairs of the n entries with the largest absolute values, largest first
+        '''
+        (ids, values) = self._items()
+        order = np.argsort(-np.abs(values), kind="mergesort")[:n]
+        return self.vocab.decode(ids[order], values[order])
+
+    def l1_norm(self):
+        '''
+        :return: the sum of the absolute values
+        '''
+        return float(np.abs(self.values).sum())
+
+    def l2_norm(self):
+        '''
+        :return: the euclidean length of the vector
+        '''
+        return float(np.sqrt(np.dot(self.values, self.values)))
+
+    def clip(self, threshold):
+        '''
+        Limits all values in place to the range from -threshold to threshold.
+
+        :param threshold: the largest absolute value
+        '''
+        np.clip(self.values, -threshold, threshold, out=self.values)
+        return self
+
+    def prune(self, threshold=0.0):
+        '''
+        Deletes all entries whose absolute value is not larger than threshold.
+
+        :param threshold: the largest absolute value that is deleted
+        '''
+        keep = np.abs(self.values) > threshold
+        if self.dense:
+            self.values[~keep] = 0.0
+        else:
+            self.ids = self.ids[keep]
+            self.values = self.values[keep]
+        return self
+
+    def __iadd__(self, x):
+        '''
+        Performs an in place element wise summation given a second vector
+
+        :param x: the second IndexedFeatureVector or FeatureVector
+        '''
+        return self.axpy(1.0, x)
+
+    def __isub__(self, x):
+        '''
+        Performs an in place element wise substraction given a second vector
+
+        :param x: the second IndexedFeatureVector or FeatureVector
+        '''
+        return self.axpy(-1.0, x)
+
+    def __imul__(self, x):
+        '''
+        Performs an in place element wise multiplication given a scalar
+
+        :param x: the scalar
+        '''
+        self.values *= x
+        return self
+
+    def __add__(self, x):
+        '''
+        Performs an element wise summation given a second vector
+
+        :param x: the second IndexedFeatureVector or FeatureVector
+        :return: a new IndexedFeatureVector
+        '''
+        return self.copy().axpy(1.0, x)
+
+    def __sub__(self, x):
+        '''
+        Performs an element wise substraction given a second vector
+
+        :param x: the second IndexedFeatureVector or FeatureVector
+        :return: a new IndexedFeatureVector
+        '''
+        return self.copy().axpy(-1.0, x)
+
+    def __mul__(self, x):
+        '''
+        Performs an element wise multiplication given a scalar
+
+        :param x: the scalar
+        :return: a new IndexedFeatureVector
+        '''
+        vector = self.copy()
+        vector.values *= x
+        return vector
+
+    __rmul__ = __mul__
+
+    def __repr__(self):
+        '''
+        Returns a representation of this class
+        '''
+        return "{%s}" % ", ".join("'%s': %s" % (key, str(val)) for key, val in self)
+
+
+class _VectorDict(MutableMapping):
+    '''
+    The dict attribute of an IndexedFeatureVector: a mapping from feature name to value that reads and writes the
+    vector's arrays, so that code written for FeatureVector.dict works on either.
+    '''
+
+    def __init__(self, vector):
+        '''
+        :param vector: the IndexedFeatureVector
+        '''
+        self.vector = vector
+
+    def __getitem__(self, key):
+        '''
+        :param key: a feature name
+        :return: the name's value
+        '''
+        return self.vector._get(key)
+
+    def __setitem__(self, key, val):
+        '''
+        :param key: a feature name
+        :param val: the name's new value
+        '''
+        self.vector.from_function(key, val)
+
+    def __delitem__(self, key):
+        '''
+        :param key: a feature name
+        '''
+        self.vector.pop(key)
+
+    def __iter__(self):
+        '''
+        :return: an iterator over the feature names of the vector's entries
+        '''
+        return iter([key for key, val in self.vector])
+
+    def __len__(self):
+        '''
+        :return: the number of entries of the vector
+        '''
+        return len(self.vector)
+
+    def __repr__(self):
+        '''
+        Returns a representation of the mapping
+        '''
+        return repr(dict(self.vector))
+
+
+class HashedFeatureVector(IndexedFeatureVector):
+    '''
+    An IndexedFeatureVector over the shared HashedFeatureVocabulary unless given its own, e.g. as
+    Translation.vector_class to parse k-best features into the hashed feature space.
+    '''
+
+    def __init__(self, vocab=None, dense=False):
+        '''
+        Initialises an empty vector.
+
+        :param vocab: the HashedFeatureVocabulary to use, the module's shared hashed vocabulary by default
+        :param dense: if True, stores a value for every id of the vocabulary
+        '''
+        IndexedFeatureVector.__init__(self, hashed_vocabulary if vocab is None else vocab, dense)
+
+
+def _columns(pairs):
+    '''
+    :param pairs: a list of (name, value) pairs
+    :return: a list of the names and a list of the values
+    '''
+    if not pairs:
+        return [], []
+    (keys, values) = zip(*pairs)
+    return list(keys), list(values)
+
+
+def _format(val):
+    '''
+    :param val: a feature value
+    :return: the value with 16 decimal places and trailing zeros removed, as written to weights files
+    '''
+    format = ("%.16f" % val).rstrip("0")
+    if format.endswith("."):
+        format = format+"0"
+    return format
+
+
+# the binary format: magic, number of features, size of the key table, the keys separated by newlines, padding
+# to a multiple of 8 bytes and the values as little-endian float64
+_BINARY_MAGIC = "NLPMFV1\x00"
+_BINARY_HEADER = struct.Struct("<8sQQ")
+
+
+def _write_binary(out_file, names, values):
+    '''
+    :param out_file: file to be written to
+    :param names: list of feature names
+    :param values: array of the features' values
+    '''
+    keys = "\n".join(names)
+    f = open(out_file, "wb")
+    f.write(_BINARY_HEADER.pack(_BINARY_MAGIC, len(names), len(keys)))
+    f.write(keys)
+    f.write("\x00" * (-(_BINARY_HEADER.size + len(keys)) % 8))
+    f.write(np.asarray(values, dtype="<f8").tobytes())
+    f.close()
+
+
+def _read_binary(in_file, mmap=False):
+    '''
+    :param in_file: a file written by _write_binary
+    :param mmap: if True, the values are mapped read-only into memory instead of read
+    :return: the list of feature names and the array of their values
+    '''
+    f = open(in_file, "rb")
+    (magic, n, size) = _BINARY_HEADER.unpack(f.read(_BINARY_HEADER.size))
+    if magic != _BINARY_MAGIC:
+        f.close()
+        raise ValueError("%s is not a binary feature vector file" % in_file)
+    keys = f.read(size)
+    names = keys.split("\n") if n > 0 else []
+    offset = _BINARY_HEADER.size + size + (-(_BINARY_HEADER.size + size) % 8)
+    if mmap and n > 0:
+        values = np.memmap(f, dtype="<f8", mode="r", offset=offset, shape=(n,))
+    else:
+        f.seek(offset)
+        values = np.fromfile(f, dtype="<f8", count=n)
+    f.close()
+    return names, values
+
+
+def map_binary_file(in_file):
+    '''
+    Maps a file written by to_binary_file read-only into memory, so that processes reading the same weights share
+    one copy of the values and no value is parsed.
+
+    :param in_file: input file to be mapped
+    :return: a dense IndexedFeatureVector with its own vocabulary, whose values must not be changed in place
+    '''
+    (names, values) = _read_binary(in_file, mmap=True)
+    vector = IndexedFeatureVector(FeatureVocabulary(names), dense=True)
+    vector.values = values
+    return vector
+
+
+def text_to_binary(in_file, out_file, sep=" "):
+    '''
+    Converts a weights file written by to_file or to_gz_file into the binary format.
+
+    :param in_file: a plain or .gz text file
+    :param out_file: the binary file to be written
+    :param sep: the symbol that separates key and value
+    '''
+    vector = FeatureVector()
+    vector.bulk_load(in_file, sep)
+    vector.to_binary_file(out_file)
+
+
+def binary_to_text(in_file, out_file, sep=" "):
+    '''
+    Converts a binary weights file into the text format of to_file, or of to_gz_file if out_file ends with .gz.
+
+    :param in_file: the binary file
+    :param out_file: the text file to be written
+    :param sep: the symbol that separates key and value
+    '''
+    vector = FeatureVector()
+    vector.from_binary_file(in_file)
+    if out_file.endswith(".gz"):
+        vector.to_gz_file(out_file, sep)
+    else:
+        vector.to_file(out_file, sep)
\ No newline at end of file
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Optional named timers and counters for the hot paths: cdec and fast_score processes, k-best and feature parsing,
+BLEU, the caches and the optimizers. Instrumentation is disabled by default, and then every hook costs one check of
+the module's enabled flag. The figures are aggregated per process; snapshots of several processes can be combined
+with merge.
+
+    import instrumentation
+    instrumentation.enable()
+    reporter = instrumentation.report_every(60)  # a log line on stderr every minute
+    ...
+    print(instrumentation.to_json())
+
+Timers record the number of calls and the wall time in seconds, counters any number, e.g. bytes read, lines or
+features parsed, cache hits and misses or update sizes.
+'''
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from timeit import default_timer
+
+enabled = False
+
+# name -> [calls, seconds] and name -> count, guarded by _lock as hooks are called from decoder threads
+timers = {}
+counters = {}
+_lock = threading.Lock()
+
+
+def enable():
+    '''
+    Starts recording.
+    '''
+    global enabled
+    enabled = True
+
+
+def disable():
+    '''
+    Stops recording, the figures recorded so far are kept.
+    '''
+    global enabled
+    enabled = False
+
+
+def reset():
+    '''
+    Discards all figures recorded so far.
+    '''
+    with _lock:
+        timers.clear()
+        counters.clear()
+
+
+def count(name, n=1):
+    '''
+    Adds n to a counter.
+
+    :param name: the counter's name
+    :param n: the amount to be added
+    '''
+    if not enabled:
+        return
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def add_time(name, seconds, calls=1):
+    '''
+    Adds time measured elsewhere to a timer.
+
+    :param name: the timer's name
+    :param seconds: the wall time in seconds
+    :param calls: the number of calls the time was spent on
+    '''
+    if not enabled:
+        return
+    with _lock:
+        entry = timers.get(name)
+        if entry is None:
+            timers[name] = [calls, seconds]
+        else:
+            entry[0] += calls
+            entry[1] += seconds
+
+
+class _Timer(object):
+    '''
+    The context manager returned by timer while instrumentation is enabled.
+    '''
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, default_timer() - self.start)
+        return False
+
+
+class _NullTimer(object):
+    '''
+    The context manager returned by timer while instrumentation is disabled.
+    '''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    '''
+    Times a block, e.g.
+
+        with instrumentation.timer("decoder.translate"):
+            ...
+
+    :param name: the timer's name
+    :return: a context manager
+    '''
+    if not enabled:
+        return _null_timer
+    return _Timer(name)
+
+
+def timed(name):
+    '''
+    Decorator that times every call of a function. Generator functions are only timed until they return the
+    generator, so they use timer or add_time instead.
+
+    :param name: the timer's name
+    :return: the decorator
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, default_timer() - start)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    '''
+    :return: a dictionary with the process id, the current time, the timers as {"calls", "seconds"} dictionaries and
+    the counters
+    '''
+    with _lock:
+        return {"pid": os.getpid(),
+                "time": time.time(),
+                "timers": dict((name, {"calls": calls, "seconds": seconds})
+                               for name, (calls, seconds) in timers.items()),
+                "counters": dict(counters)}
+
+
+def merge(snapshots):
+    '''
+    Adds up the snapshots of several processes, e.g. of parallel workers.
+
+    :param snapshots: an iterable of dictionaries as returned by snapshot
+    :return: a dictionary like snapshot's with the sums of all timers and counters and the list of process ids
+    '''
+    merged = {"pid": [], "time": time.time(), "timers": {}, "counters": {}}
+    for s in snapshots:
+        merged["pid"].append(s["pid"])
+        for name, entry in s["timers"].items():
+            total = merged["timers"].setdefault(name, {"calls": 0, "seconds": 0.0})
+            total["calls"] += entry["calls"]
+            total["seconds"] += entry["seconds"]
+        for name, n in s["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + n
+    return merged
+
+
+def to_json(s=None):
+    '''
+    :param s: a dictionary as returned by snapshot or merge, the current snapshot by default
+    :return: the snapshot as JSON string
+    '''
+    return json.dumps(snapshot() if s is None else s, sort_keys=True)
+
+
+def log_line(s=None):
+    '''
+    :param s: a dictionary as returned by snapshot or merge, the current snapshot by default
+    :return: the snapshot as one line of name=value pairs, timers as name=seconds/calls
+    '''
+    if s is None:
+        s = snapshot()
+    items = ["%s=%.3fs/%s" % (name, s["timers"][name]["seconds"], s["timers"][name]["calls"])
+             for name in sorted(s["timers"])]
+    items += ["%s=%s" % (name, s["counters"][name]) for name in sorted(s["counters"])]
+    return " ".join(items)
+
+
+class Reporter(threading.Thread):
+    '''
+    A daemon thread writing the current snapshot to a stream at a fixed interval.
+    '''
+
+    def __init__(self, interval=60.0, stream=None, as_json=False):
+        '''
+        :param interval: the number of seconds between two reports
+        :param stream: the file object to write to, stderr by default
+        :param as_json: if True, reports are written as JSON instead of log lines
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.stream = sys.stderr if stream is None else stream
+        self.as_json = as_json
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        '''
+        Writes the current snapshot.
+        '''
+        line = to_json() if self.as_json else "[instrumentation] %s" % log_line()
+        self.stream.write("%s\n" % line)
+        self.stream.flush()
+
+    def stop(self):
+        '''
+        Stops reporting and waits for the thread.
+        '''
+        self.stopped.set()
+        self.join()
+
+
+def report_every(interval, stream=None, as_json=False):
+    '''
+    Starts a Reporter.
+
+    :param interval: the number of seconds between two reports
+    :param stream: the file object to write to, stderr by default
+    :param as_json: if True, reports are written as JSON instead of log lines
+    :return: the running Reporter, to be stopped with stop
+    '''
+    reporter = Reporter(interval, stream, as_json)
+    reporter.start()
+    return reporter
\ No newline at end of file
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmarks for nlpminion's hot paths. Every result is written as one JSON object per line with the benchmark name,
+the problem size, the best time of the repetitions in seconds and the resulting rate in items per second, and for
+the parsed k-best lists their size in bytes, e.g.
+
+    python nlpminion_benchmark.py --max-exponent 6 --output results.jsonl
+    python nlpminion_benchmark.py --baseline results.jsonl --tolerance 0.25
+
+With --baseline, benchmarks that got slower than the baseline by more than the tolerance are reported on stderr
+and the exit status is 1. Decoder benchmarks run against the fake cdec and fast_score in decoder_test unless
+--decoder-path points to a cdec checkout.
+'''
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import types
+from timeit import default_timer as timer
+
+import decoder
+from adadelta import Adadelta, IndexedAdadelta, RegularizedAdadelta, RegularizedIndexedAdadelta
+from cache import Cache
+from feature_vector import FeatureVector, IndexedFeatureVector
+from trainer import ParallelTrainer, PipelinedTrainer
+from translation import KBestList, read_kbest
+
+FAKE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "decoder_test")
+
+WORDS = ("how many where is the of in a restaurants smoking allowed not are which can i go climbing "
+         "paris edinburgh heidelberg works art look at different places spots city river state").split()
+
+
+def measure(name, size, function, repeat):
+    '''
+    Runs a function repeat times and reports the fastest run.
+
+    :param name: the benchmark name
+    :param size: the number of items the function processes
+    :param function: the function to be timed, called without arguments
+    :param repeat: the number of runs
+    :return: the result as dictionary
+    '''
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        function()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"benchmark": name, "size": size, "seconds": best, "rate": size / best if best > 0 else None}
+
+
+def footprint(obj):
+    '''
+    :return: the bytes sys.getsizeof reports for an object and everything it references through containers,
+    instance dictionaries and slots, counting shared objects once; classes and modules are not followed
+    '''
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, types.ModuleType)):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        if hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+        stack.extend(getattr(o, slot) for slot in getattr(type(o), "__slots__", ()) if hasattr(o, slot))
+    return total
+
+
+class EagerTranslation:
+    '''
+    Translation as it was before its features were parsed lazily: an instance dictionary per object and the
+    feature string parsed into a FeatureVector right away. Only a baseline for bench_kbest.
+    '''
+
+    def __init__(self, kbest_entry):
+        '''
+        :param kbest_entry: one line of cdec output in k-best format
+        '''
+        self.bleu_score = None
+        self.decoder_rank = None
+        self.bleu_rank = None
+        self.decoder_ori = None
+        self.features = FeatureVector()
+        (self.idval, self.string, features_raw, self.decoder_score) = tuple(kbest_entry.strip().split(" ||| "))
+        self.decoder_score = float(self.decoder_score)
+        self.features.from_string(features_raw)
+
+
+def sentence(rng, length):
+    '''
+    :return: a random sentence of length words
+    '''
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def features_string(rng, n, space):
+    '''
+    :return: a cdec feature string with n features drawn from a space of feature names
+    '''
+    names = rng.sample(range(space), n) if n < space else range(n)
+    return " ".join("RuleIdentity_%d=%s" % (i, rng.random()) for i in names)
+
+
+def bench_bleu(args, rng):
+    '''
+    per_sentence_bleu, per_sentence_bleu_batch and ngram on k-best lists of 100 sentences.
+    '''
+    kbest = 100 if args.quick else 1000
+    refs = [[sentence(rng, rng.randint(8, 20))] for _ in range(100)]
+    lists = [[sentence(rng, rng.randint(6, 22)) for _ in range(kbest)] for _ in range(100)]
+    size = 100 * kbest
+
+    def loop():
+        for ref, hyps in zip(refs, lists):
+            for hyp in hyps:
+                decoder.per_sentence_bleu(hyp, ref)
+
+    def indexed():
+        for ref, hyps in zip(refs, lists):
+            index = decoder.ReferenceIndex(ref)
+            for hyp in hyps:
+                decoder.per_sentence_bleu(hyp, index)
+
+    def batch():
+        for ref, hyps in zip(refs, lists):
+            decoder.per_sentence_bleu_batch(hyps, decoder.ReferenceIndex(ref))
+
+    def ngram():
+        for ref, hyps in zip(refs, lists):
+            for hyp in hyps:
+                decoder.ngram(hyp, ref, 4)
+
+    yield measure("per_sentence_bleu", size, loop, args.repeat)
+    yield measure("per_sentence_bleu.reference_index", size, indexed, args.repeat)
+    yield measure("per_sentence_bleu_batch", size, batch, args.repeat)
+    yield measure("ngram", size, ngram, args.repeat)
+
+
+def bench_feature_vector(args, rng):
+    '''
+    FeatureVector parsing and serialization at 10^4 up to 10^max_exponent features.
+    '''
+    for exponent in range(4, args.max_exponent + 1):
+        size = 10 ** exponent
+        string = features_string(rng, size, size)
+        vector = FeatureVector()
+        vector.from_string(string)
+        path = os.path.join(args.tmp, "weights.gz")
+        binary = os.path.join(args.tmp, "weights.bin")
+        vector.to_gz_file(path)
+
+        def from_string():
+            FeatureVector().from_string(string)
+
+        def indexed_from_string():
+            IndexedFeatureVector().from_string(string)
+
+        def from_gz_file():
+            FeatureVector().from_gz_file(path)
+
+        def bulk_load():
+            FeatureVector().bulk_load(path)
+
+        def from_binary_file():
+            FeatureVector().from_binary_file(binary)
+
+        yield measure("FeatureVector.from_string", size, from_string, args.repeat)
+        yield measure("IndexedFeatureVector.from_string", size, indexed_from_string, args.repeat)
+        yield measure("FeatureVector.to_gz_file", size, lambda: vector.to_gz_file(path), args.repeat)
+        for result in bench_gz_writer("FeatureVector", vector, path, size, args):
+            yield result
+        yield measure("FeatureVector.from_gz_file", size, from_gz_file, args.repeat)
+        yield measure("FeatureVector.bulk_load", size, bulk_load, args.repeat)
+        yield measure("FeatureVector.to_binary_file", size, lambda: vector.to_binary_file(binary), args.repeat)
+        yield measure("FeatureVector.from_binary_file", size, from_binary_file, args.repeat)
+
+
+def bench_gz_writer(name, vector, path, size, args):
+    '''
+    The options of to_gz_file: the fastest compression level, members compressed by one thread per core and the
+    time until a background write returns to the caller.
+    '''
+    jobs = max(multiprocessing.cpu_count(), 2)
+    writers = []
+
+    def background():
+        writers.append(vector.to_gz_file("%s.%d" % (path, len(writers)), background=True))
+
+    yield measure("%s.to_gz_file(level=1)" % name, size, lambda: vector.to_gz_file(path, level=1), args.repeat)
+    yield measure("%s.to_gz_file(jobs=%d)" % (name, jobs), size, lambda: vector.to_gz_file(path, jobs=jobs),
+                  args.repeat)
+    yield measure("%s.to_gz_file(background)" % name, size, background, args.repeat)
+    for writer in writers:
+        writer.wait()
+
+
+def bench_kbest(args, rng):
+    '''
+    Parsing cdec k-best output into Translations and rescoring it under new weights. read_kbest.eager parses every
+    feature string right away like Translation used to; the bytes of both parsed lists are reported as well.
+    '''
+    size = 10000 if args.quick else 100000
+    lines = ["%d ||| %s ||| %s ||| %s" % (i // 100, sentence(rng, 10), features_string(rng, 20, 10000), -i)
+             for i in range(size)]
+    weights = FeatureVector()
+    weights.from_string(features_string(rng, 10000, 10000))
+    kbest = KBestList(read_kbest(lines))
+    for name, parse in (("read_kbest", lambda: list(read_kbest(lines))),
+                        ("read_kbest.eager", lambda: [EagerTranslation(line) for line in lines])):
+        result = measure(name, size, parse, args.repeat)
+        result["bytes"] = footprint(parse())
+        yield result
+    yield measure("KBestList", size, lambda: KBestList(read_kbest(lines)), args.repeat)
+    yield measure("KBestList.rescore", size, lambda: kbest.rescore(weights), args.repeat)
+
+
+def bench_adadelta(args, rng):
+    '''
+    Adadelta updates with sparse gradients of 1000 features from a space of 10^5 features, one at a time and for
+    IndexedAdadelta also in minibatches of 10 FeatureVector or IndexedFeatureVector gradients.
+    '''
+    updates = 100 if args.quick else 1000
+    gradients = []
+    for _ in range(updates):
+        gradient = FeatureVector()
+        gradient.from_string(features_string(rng, 1000, 100000))
+        gradients.append(gradient)
+
+    def update(optimizer, batches=gradients):
+        def run():
+            for gradient in batches:
+                optimizer.update(gradient)
+        return run
+
+    yield measure("Adadelta.update", updates, update(Adadelta()), args.repeat)
+    yield measure("IndexedAdadelta.update", updates, update(IndexedAdadelta()), args.repeat)
+    minibatches = [gradients[i:i + 10] for i in range(0, updates, 10)]
+    indexed = [[IndexedFeatureVector() + gradient for gradient in minibatch] for minibatch in minibatches]
+    yield measure("IndexedAdadelta.update.minibatch", updates, update(IndexedAdadelta(), minibatches), args.repeat)
+    yield measure("IndexedAdadelta.update.minibatch_indexed", updates, update(IndexedAdadelta(), indexed),
+                  args.repeat)
+    yield measure("RegularizedAdadelta.update", updates, update(RegularizedAdadelta(l1=1e-6, l2=1e-4)), args.repeat)
+    yield measure("RegularizedIndexedAdadelta.update", updates,
+                  update(RegularizedIndexedAdadelta(l1=1e-6, l2=1e-4)), args.repeat)
+
+
+def bench_weights(args, rng):
+    '''
+    Handing the weights to cdec after an update of 1% of 10^4 up to 10^max_exponent features: writing the whole vector
+    with to_file against a WeightsFile that only formats the changed weights. Every run includes the update.
+    '''
+    for exponent in range(4, args.max_exponent + 1):
+        size = 10 ** exponent
+        vector = FeatureVector()
+        vector.from_string(features_string(rng, size, size))
+        indexed = IndexedFeatureVector(dense=True)
+        indexed += vector
+        update = FeatureVector()
+        update.dict = dict((key, rng.random()) for key in rng.sample(sorted(vector.dict), size // 100))
+        path = os.path.join(args.tmp, "weights")
+        weights_file = decoder.WeightsFile(vector, args.tmp)
+        indexed_file = decoder.WeightsFile(indexed, args.tmp)
+
+        def to_file():
+            vector.axpy(1.0, update)
+            vector.to_file(path)
+
+        def update_file():
+            vector.axpy(1.0, update)
+            weights_file.update(vector)
+
+        def update_changed():
+            vector.axpy(1.0, update)
+            weights_file.update(vector, changed=update.dict)
+
+        def indexed_to_file():
+            indexed.axpy(1.0, update)
+            indexed.to_file(path)
+
+        def indexed_update_file():
+            indexed.axpy(1.0, update)
+            indexed_file.update(indexed)
+
+        yield measure("FeatureVector.to_file", size, to_file, args.repeat)
+        yield measure("WeightsFile.update", size, update_file, args.repeat)
+        yield measure("WeightsFile.update(changed)", size, update_changed, args.repeat)
+        yield measure("IndexedFeatureVector.to_file", size, indexed_to_file, args.repeat)
+        yield measure("WeightsFile.update(indexed)", size, indexed_update_file, args.repeat)
+        weights_file.close()
+        indexed_file.close()
+
+
+def bench_cache(args, rng):
+    '''
+    Saving and loading a Cache of 10^4 up to 10^max_exponent parsed sentences.
+    '''
+    for exponent in range(4, args.max_exponent + 1):
+        size = 10 ** exponent
+        cache = Cache()
+        for i in range(size):
+            cache.from_function("%s %d" % (sentence(rng, 8), i), (i % 2 == 0, "query(%d)" % i, "answer %d" % i))
+        path = os.path.join(args.tmp, "cache.gz")
+        cache.to_gz_file(path)
+
+        def from_gz_file():
+            Cache().from_gz_file(path, value_is_tuple=True)
+
+        def bulk_load():
+            Cache().bulk_load(path)
+
+        yield measure("Cache.to_gz_file", size, lambda: cache.to_gz_file(path), args.repeat)
+        for result in bench_gz_writer("Cache", cache, path, size, args):
+            yield result
+        yield measure("Cache.from_gz_file", size, from_gz_file, args.repeat)
+        yield measure("Cache.bulk_load", size, bulk_load, args.repeat)
+
+
+def bench_decoder(args, rng):
+    '''
+    End-to-end decoder calls, with the fake cdec unless a real one is given.
+    '''
+    if args.decoder_path is None:
+        cdec = os.path.join(FAKE_DIR, "fake_cdec")
+        fast_score = os.path.join(FAKE_DIR, "fake_fast_score")
+    else:
+        cdec = os.path.join(args.decoder_path, "decoder", "cdec")
+        fast_score = os.path.join(args.decoder_path, "mteval", "fast_score")
+    ini = os.path.join(FAKE_DIR, "cdec.ini")
+    weights = os.path.join(FAKE_DIR, "weights.init")
+    size = 20 if args.quick else 100
+    sentences = ['<seg id="%d"> %s </seg>' % (i, sentence(rng, rng.randint(8, 20))) for i in range(size)]
+    nl_file = os.path.join(args.tmp, "set.in")
+    ref_file = os.path.join(args.tmp, "set.ref")
+    out_file = os.path.join(args.tmp, "set.out")
+    f = open(nl_file, "w")
+    f.write("".join("%s\n" % nl for nl in sentences))
+    f.close()
+    f = open(ref_file, "w")
+    f.write("".join("%s\n" % sentence(rng, 12) for _ in sentences))
+    f.close()
+    f = open(out_file, "w")
+    f.write(decoder.translate(cdec, ini, weights, nl_file))
+    f.close()
+
+    def per_sentence(kbest):
+        def run():
+            for nl in sentences:
+                decoder.translate_sentence(cdec, ini, weights, nl, kbest)
+        return run
+
+    def session(kbest):
+        def run():
+            s = decoder.DecoderSession(cdec, ini, weights, kbest)
+            for nl in sentences:
+                s.translate_sentence(nl)
+            s.close()
+        return run
+
+    def pool():
+        p = decoder.DecoderPool(cdec, ini, weights, 100, 2)
+        p.translate_sentences(sentences)
+        p.close()
+
+    def kbest_stream():
+        for _ in decoder.translate_kbest(cdec, ini, weights, nl_file, 100):
+            pass
+
+    yield measure("translate", size, lambda: decoder.translate(cdec, ini, weights, nl_file), args.repeat)
+    yield measure("translate.kbest100", size, lambda: decoder.translate(cdec, ini, weights, nl_file, 100),
+                  args.repeat)
+    yield measure("translate.kbest100.jobs2", size,
+                  lambda: decoder.translate(cdec, ini, weights, nl_file, 100, jobs=2), args.repeat)
+    yield measure("translate_kbest.kbest100", size, kbest_stream, args.repeat)
+    yield measure("translate_sentence", size, per_sentence(0), args.repeat)
+    yield measure("translate_sentence.kbest100", size, per_sentence(100), args.repeat)
+    yield measure("DecoderSession", size, session(0), args.repeat)
+    yield measure("DecoderSession.kbest100", size, session(100), args.repeat)
+    yield measure("DecoderPool.kbest100.size2", size, pool, args.repeat)
+    yield measure("bleu", size, lambda: decoder.bleu(fast_score, ref_file, out_file), args.repeat)
+
+
+def bench_trainer(args, rng):
+    '''
+    ParallelTrainer with both mixing strategies on 1 up to the number of cores workers and PipelinedTrainer with
+    and without prefetching, with the fake cdec unless a real one is given. With --work the fake cdec is CPU-bound,
+    so the workers only scale with the number of cores.
+    '''
+    cdec = os.path.join(FAKE_DIR, "fake_cdec") if args.decoder_path is None else \
+        os.path.join(args.decoder_path, "decoder", "cdec")
+    ini = os.path.join(FAKE_DIR, "cdec.ini")
+    size = 16 if args.quick else 64
+    references = [[sentence(rng, rng.randint(8, 20))] for _ in range(size)]
+    sentences = [" ".join(reversed(refs[0].split())) for refs in references]
+    weights = FeatureVector()
+    weights.from_file(os.path.join(FAKE_DIR, "weights.init"))
+    workers = 1
+    while workers <= max(multiprocessing.cpu_count(), 2):
+        for mixing in ("ipm", "minibatch"):
+            def train():
+                trainer = ParallelTrainer(cdec, ini, weights, workers, 100, 4, mixing)
+                trainer.train(sentences, references)
+                trainer.close()
+            yield measure("ParallelTrainer.%s.workers%d" % (mixing, workers), size, train, args.repeat)
+        workers *= 2
+    for staleness, decoders in ((0, 1), (1, 1), (2, 2)):
+        def pipeline():
+            PipelinedTrainer(cdec, ini, weights, 100, staleness, decoders).train(sentences, references)
+        yield measure("PipelinedTrainer.staleness%d.decoders%d" % (staleness, decoders), size, pipeline, args.repeat)
+
+
+BENCHMARKS = [("bleu", bench_bleu), ("feature_vector", bench_feature_vector), ("kbest", bench_kbest),
+              ("adadelta", bench_adadelta), ("weights", bench_weights), ("cache", bench_cache),
+              ("decoder", bench_decoder), ("trainer", bench_trainer)]
+
+
+def compare(results, baseline_file, tolerance):
+    '''
+    :param results: list of result dictionaries
+    :param baseline_file: a file with results of an earlier run
+    :param tolerance: the allowed relative slowdown
+    :return: list of (result, baseline result) pairs that got slower than the tolerance allows
+    '''
+    baseline = {}
+    for line in open(baseline_file):
+        if line.strip():
+            result = json.loads(line)
+            baseline[(result["benchmark"], result["size"])] = result
+    slower = []
+    for result in results:
+        old = baseline.get((result["benchmark"], result["size"]))
+        if old is not None and result["seconds"] > old["seconds"] * (1 + tolerance):
+            slower.append((result, old))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs nlpminion's benchmarks and prints JSON lines.")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS],
+                        help="the benchmarks to run, all by default")
+    parser.add_argument("--max-exponent", type=int, default=6,
+                        help="feature vectors and caches are benchmarked at 10^4 up to 10^max-exponent entries")
+    parser.add_argument("--repeat", type=int, default=3, help="the number of runs, the fastest is reported")
+    parser.add_argument("--quick", action="store_true", help="smaller problem sizes, e.g. for a smoke test")
+    parser.add_argument("--decoder-path", help="the top level directory of cdec, the fake cdec by default")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake cdec sleeps per sentence")
+    parser.add_argument("--startup", type=float, default=0.0, help="seconds the fake cdec sleeps at start")
+    parser.add_argument("--work", type=float, default=0.0,
+                        help="CPU seconds the fake cdec spends per sentence, to measure CPU-bound scaling")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="a file the results are written to in addition to stdout")
+    parser.add_argument("--baseline", help="a file with results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="the allowed relative slowdown")
+    args = parser.parse_args()
+    os.environ["FAKE_CDEC_LATENCY"] = str(args.latency)
+    os.environ["FAKE_CDEC_STARTUP"] = str(args.startup)
+    os.environ["FAKE_CDEC_WORK"] = str(args.work)
+    args.tmp = tempfile.mkdtemp(prefix="nlpminion-benchmark-")
+    out = open(args.output, "w") if args.output else None
+    results = []
+    try:
+        for name, benchmark in BENCHMARKS:
+            if args.only and name not in args.only:
+                continue
+            for result in benchmark(args, random.Random(args.seed)):
+                result["python"] = "%s.%s.%s" % sys.version_info[:3]
+                line = json.dumps(result, sort_keys=True)
+                print(line)
+                sys.stdout.flush()
+                if out is not None:
+                    out.write(line + "\n")
+                results.append(result)
+    finally:
+        shutil.rmtree(args.tmp)
+        if out is not None:
+            out.close()
+    if args.baseline:
+        slower = compare(results, args.baseline, args.tolerance)
+        for result, old in slower:
+            sys.stderr.write("%s at size %s: %.4fs, baseline %.4fs\n" % (
+                result["benchmark"], result["size"], result["seconds"], old["seconds"]))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -1,9 +1,75 @@
 import unittest
-from feature_vector import FeatureVector
-from adadelta import Adadelta
+import sys
+import gzip
+import json
+import pickle
+import subprocess
+from distutils.spawn import find_executable
+from feature_vector import FeatureVector, IndexedFeatureVector, map_binary_file, text_to_binary, binary_to_text
+from feature_vector import HashedFeatureVector, HashedFeatureVocabulary
+from adadelta import Adadelta, IndexedAdadelta, RegularizedAdadelta, RegularizedIndexedAdadelta
+from cache import Cache
+import abstract_sparse_vector
+from abstract_sparse_vector import _formatted_blocks, _write_gz
 import decoder
 import os
-from translation import Translation
+import tempfile
+import shutil
+from translation import Translation, KBestList, read_kbest
+import instrumentation
+from trainer import ParallelTrainer, PipelinedTrainer, _named
+
+# run by test_async_decoder_stub with a Python 3 interpreter, exits with status 3 if a module can not be imported
+ASYNC_SCRIPT = '''
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+try:
+    import decoder
+    import async_decoder
+except ImportError as e:
+    sys.stderr.write("%s\\n" % e)
+    sys.exit(3)
+cdec, ini, weights = "decoder_test/fake_cdec", "decoder_test/cdec.ini", "decoder_test/weights.init"
+sentences = ['<seg id="1"> where are restaurants </seg>', '<seg id="2"> how many rivers </seg>']
+
+
+async def main():
+    single = [await async_decoder.translate_sentence(cdec, ini, weights, nl, 3, asyncio.Semaphore(2))
+              for nl in sentences]
+    pool = async_decoder.AsyncDecoderPool(cdec, ini, weights, 3)
+    pooled = await pool.translate_sentences(sentences * 2)
+    try:
+        await pool.translate_sentence(sentences[0], timeout=0)
+        timed_out = False
+    except asyncio.TimeoutError:
+        timed_out = True
+    pooled.append(await pool.translate_sentence(sentences[1]))
+    await pool.close()
+    directory = tempfile.mkdtemp()
+    try:
+        without_glue = os.path.join(directory, "cdec.ini")
+        with open(without_glue, "w") as f:
+            f.write(open(ini).read() + "\\nscfg_no_hiero_glue_grammar=true\\n")
+        session = async_decoder.AsyncDecoderSession(cdec, without_glue, weights, 3, start_timeout=1)
+        try:
+            await session.translate_sentence(sentences[0])
+            sync_error = None
+        except RuntimeError as e:
+            sync_error = str(e)
+        await session.close()
+    finally:
+        shutil.rmtree(directory)
+    return {"single": single, "pooled": pooled, "timed_out": timed_out, "sync_error": sync_error}
+
+
+result = asyncio.run(main())
+result["expected"] = [decoder.translate_sentence(cdec, ini, weights, nl, 3).decode("utf-8") for nl in sentences]
+print(json.dumps(result))
+'''
 
 
 class TestNLPminion(unittest.TestCase):
@@ -27,6 +93,388 @@ class TestNLPminion(unittest.TestCase):
         gradient.from_string("test1=-3.9722 test2=2.5")
         test_delta = adadelta.update(gradient)
         self.assertEqual(true_delta, test_delta)
+        # the same update with the indexed parameter arrays, once for a minibatch averaging to the same gradient
+        indexed_adadelta = IndexedAdadelta()
+        self.assertEqual(true_delta, indexed_adadelta.update(gradient))
+        indexed_adadelta = IndexedAdadelta()
+        double = FeatureVector()
+        double.from_string("test1=-7.9444 test2=5.0")
+        zero = FeatureVector()
+        zero.from_string("test1=0.0 test2=0.0")
+        self.assertEqual(true_delta, indexed_adadelta.update([double, zero]))
+
+    def test_regularized_adadelta(self):
+        '''Checks that lazily regularized Adadelta gives the same weights as regularizing every weight after every
+        update, also for features that are only seen once.'''
+        l1, l2 = 0.0005, 0.1
+        gradients = []
+        for string in ("test1=-3.9722 test2=2.5 test3=-0.5", "test1=1.0", "test2=-1.0", "test1=0.5 test4=2.0",
+                       "test1=-0.25", "test1=1.0", "test2=0.5"):
+            gradient = FeatureVector()
+            gradient.from_string(string)
+            gradients.append(gradient)
+        adadelta = Adadelta()
+        eager = FeatureVector()
+        eager.from_string("test5=0.001")
+        initial = eager.copy()
+        for gradient in gradients:
+            eager += adadelta.update(gradient)
+            for key, val in eager.dict.items():
+                magnitude = max(0.0, abs(val) * (1.0 - l2) - l1)
+                eager.dict[key] = magnitude if val > 0 else -magnitude
+        for lazy in (RegularizedAdadelta(l1=l1, l2=l2, weights=initial),
+                     RegularizedIndexedAdadelta(l1=l1, l2=l2, weights=initial)):
+            for gradient in gradients:
+                lazy.update(gradient)
+            weights = dict(lazy.weights)
+            self.assertEqual(sorted(key for key, val in weights.items() if val != 0.0),
+                             sorted(key for key, val in eager.dict.items() if val != 0.0))
+            for key, val in eager.dict.items():
+                self.assertAlmostEqual(weights.get(key, 0.0), val, places=12)
+            self.assertEqual(weights.get("test5", 0.0), 0.0)
+        self.assertEqual(initial.dict, {"test5": 0.001})
+
+    def test_indexed_feature_vector(self):
+        '''Checks that sparse and dense IndexedFeatureVectors parse and compute the same values as FeatureVector.'''
+        true_vector = FeatureVector()
+        true_vector.from_string("test1=-1.0 test2=7.0 test3=-2.0")
+        for dense in (False, True):
+            vector = IndexedFeatureVector(dense=dense)
+            vector.from_string("test1=1.0 test2=2.0 test1=0.5")
+            other = FeatureVector()
+            other.from_string("test1=1.0 test3=1.0")
+            sparse = IndexedFeatureVector()
+            sparse.from_string("test2=1.5")
+            self.assertEqual((vector - other + sparse) * 2, true_vector)
+            self.assertEqual(vector.dict, {"test1": 0.5, "test2": 2.0})
+            vector -= other
+            vector += sparse
+            vector *= 2
+            self.assertEqual(vector, true_vector)
+            self.assertEqual(sorted(vector), sorted(true_vector))
+            # the dict view writes to the vector and pop behaves like dict.pop
+            vector.dict["test4"] = 3.0
+            vector.dict["test1"] += 2.0
+            del vector.dict["test3"]
+            self.assertEqual(dict(vector), {"test1": 1.0, "test2": 7.0, "test4": 3.0})
+            self.assertEqual(vector.pop("test4"), 3.0)
+            self.assertRaises(KeyError, vector.pop, "test4")
+            self.assertRaises(KeyError, vector.pop, "test_unknown")
+            self.assertEqual((vector.pop("test4", 0.0), vector.dict.pop("test3", None)), (0.0, None))
+            # entries set one at a time replace earlier ones like in a dictionary
+            for i in range(100):
+                vector.from_function("test%d" % (i % 10), i)
+            self.assertEqual(vector.dict, dict(("test%d" % i, 90.0 + i) for i in range(10)))
+        hashed = HashedFeatureVector()
+        for i in range(2):
+            hashed.dict["test1"] = -2.0
+        self.assertEqual(hashed.dict, {"test1": -2.0})
+        # loading replaces the values of the loaded names instead of adding to them
+        hashed.from_string("test1=1.0 test2=3.0")
+        self.assertEqual(hashed.dict, {"test1": 1.0, "test2": 3.0})
+
+    def test_cache_eviction(self):
+        '''Checks that a bounded cache evicts the least recently or least frequently used entry and counts lookups.'''
+        for policy, kept in (("lru", ["b", "c", "d"]), ("lfu", ["a", "b", "d"])):
+            cache = Cache(3, policy)
+            for key in ("a", "b", "c"):
+                cache.from_function(key, (True, "mrl", "answer"))
+            self.assertEqual(cache.get("a"), (True, "mrl", "answer"))
+            cache.get("a")
+            cache.get("c")
+            cache.get("b")
+            cache.from_function("d", (False, "mrl", "answer"))
+            self.assertEqual(sorted(cache.dict), kept)
+            self.assertEqual(cache.get("e"), None)
+            self.assertEqual(cache.stats(), {"size": 3, "hits": 4, "misses": 1, "evictions": 1,
+                                             "hit_ratio": 0.8})
+
+    def test_cache_persistent(self):
+        '''Checks that a persistent cache keeps its entries across instances and converts to and from gz files.'''
+        directory = tempfile.mkdtemp()
+        try:
+            cache = Cache(path=os.path.join(directory, "cache.db"))
+            cache.from_function("where is paris ?", (True, "query(paris)", "france"))
+            cache.from_function("what is edinburgh ?", (False, "query(edinburgh)", ""))
+            cache.pop("what is edinburgh ?")
+            cache.close()
+            cache = Cache(path=os.path.join(directory, "cache.db"))
+            self.assertEqual(cache.get("where is paris ?"), (True, "query(paris)", "france"))
+            self.assertEqual(cache.get("what is edinburgh ?"), None)
+            cache.to_gz_file(os.path.join(directory, "cache.gz"))
+            cache.close()
+            cache = Cache(path=os.path.join(directory, "copy.db"))
+            cache.from_gz_file(os.path.join(directory, "cache.gz"), value_is_tuple=True)
+            self.assertEqual(list(cache), [("where is paris ?", (True, "query(paris)", "france"))])
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bulk_load(self):
+        '''Checks that the bulk loaders read the same entries as the line by line loaders, also for gz files with
+        several members decompressed in parallel.'''
+        directory = tempfile.mkdtemp()
+        try:
+            weights = FeatureVector()
+            weights.from_file("decoder_test/weights.init")
+            cache = Cache()
+            cache.from_function("where is paris ?", (True, "query(city(paris), answer(A))", "france"))
+            cache.from_function("what is edinburgh ?", (False, "query(edinburgh)", ""))
+            for vector, loaded in ((weights, FeatureVector()), (cache, Cache())):
+                vector.to_gz_file(os.path.join(directory, "part.gz"))
+                part = open(os.path.join(directory, "part.gz"), "rb").read()
+                members = open(os.path.join(directory, "members.gz"), "wb")
+                members.write(part * 3)
+                members.close()
+                for jobs in (1, 2):
+                    loaded.clear()
+                    loaded.bulk_load(os.path.join(directory, "members.gz"), jobs=jobs)
+                    self.assertEqual(loaded.dict, vector.dict)
+                # regions of a few bytes are searched for headers and decompressed one after the other
+                blocks = [list(abstract_sparse_vector._read_lines(os.path.join(directory, "members.gz"), jobs, 16))
+                          for jobs in (1, 3)]
+                self.assertEqual(sum(blocks[1], []), sum(blocks[0], []))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_bulk_load_fake_header(self):
+        '''Checks that the parallel bulk loader falls back to sequential decompression when a gz member header pattern
+        occurs inside a member: stored at level 0, a feature name containing it appears verbatim in the file.'''
+        directory = tempfile.mkdtemp()
+        gunzip = abstract_sparse_vector._gunzip
+        starts = []
+
+        def sequential(f, block_size, start=0):
+            starts.append(start)
+            return gunzip(f, block_size, start)
+
+        try:
+            path = os.path.join(directory, "members.gz")
+            expected = {}
+            f = open(path, "wb")
+            for member in range(3):
+                lines = ["Feature%d_%d %d.5" % (member, i, i) for i in range(50)]
+                lines.insert(25, "Fake\x1f\x8b\x08Header%d -1.0" % member)
+                gz = gzip.GzipFile(fileobj=f, mode="wb", compresslevel=0)
+                gz.write("\n".join(lines) + "\n")
+                gz.close()
+                for line in lines:
+                    (key, val) = line.split(" ")
+                    expected[key] = float(val)
+            f.close()
+            self.assertIn("Fake\x1f\x8b\x08Header0", open(path, "rb").read())
+            abstract_sparse_vector._gunzip = sequential
+            for jobs in (1, 2):
+                loaded = FeatureVector()
+                loaded.bulk_load(path, jobs=jobs)
+                self.assertEqual(loaded.dict, expected)
+            # jobs=1 decompresses sequentially from the start, jobs=2 only after rejecting a region
+            self.assertEqual(len(starts), 2)
+        finally:
+            abstract_sparse_vector._gunzip = gunzip
+            shutil.rmtree(directory)
+
+    def test_gz_writer(self):
+        '''Checks that gz files written at any compression level, as one member or as members compressed in parallel,
+        and in the background are read back by the line by line and the bulk loaders.'''
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "out.gz")
+            weights = FeatureVector()
+            weights.from_file("decoder_test/weights.init")
+            indexed = IndexedFeatureVector()
+            indexed += weights
+            cache = Cache()
+            cache.from_function("where is paris ?", (True, "query(city(paris))", "france"))
+            cache.from_function("what is edinburgh ?", (False, "query(edinburgh)", ""))
+            for vector, loaded in ((weights, FeatureVector()), (indexed, IndexedFeatureVector()), (cache, Cache())):
+                for level, jobs in ((1, 1), (9, 3)):
+                    vector.to_gz_file(path, level=level, jobs=jobs)
+                    loaded.clear()
+                    loaded.from_gz_file(path, **({"value_is_tuple": True} if isinstance(loaded, Cache) else {}))
+                    self.assertEqual(loaded.dict, vector.dict)
+            # with one block per two lines, the file has a member per block
+            lines = ["line %d\n" % i for i in range(7)]
+            _write_gz(path, _formatted_blocks(lines, "".join, size=2), level=6, jobs=3)
+            self.assertEqual(open(path, "rb").read().count("\x1f\x8b\x08"), 4)
+            self.assertEqual(gzip.open(path, "rb").read(), "".join(lines))
+            # a single block is compressed without a thread pool
+            pool = abstract_sparse_vector.ThreadPool
+            abstract_sparse_vector.ThreadPool = None
+            try:
+                _write_gz(path, _formatted_blocks(lines, "".join, size=10), level=6, jobs=3)
+            finally:
+                abstract_sparse_vector.ThreadPool = pool
+            self.assertEqual(gzip.open(path, "rb").read(), "".join(lines))
+            loaded = Cache()
+            for jobs in (1, 2):
+                loaded.clear()
+                cache.to_gz_file(path, jobs=jobs)
+                loaded.bulk_load(path, jobs=jobs)
+                self.assertEqual(loaded.dict, cache.dict)
+            # a background write sees the entries at the time of the call
+            expected = weights.copy()
+            writer = weights.to_gz_file(path, background=True)
+            weights.dict["NewFeature"] = 1.0
+            writer.wait()
+            loaded = FeatureVector()
+            loaded.from_gz_file(path)
+            self.assertEqual(loaded, expected)
+            persistent = Cache(path=os.path.join(directory, "cache.db"))
+            persistent.from_function("where is paris ?", (True, "query(paris)", "france"))
+            writer = persistent.to_gz_file(path, background=True)
+            persistent.from_function("what is edinburgh ?", (False, "query(edinburgh)", ""))
+            writer.wait()
+            persistent.close()
+            loaded = Cache()
+            loaded.from_gz_file(path, value_is_tuple=True)
+            self.assertEqual(loaded.dict, {"where is paris ?": (True, "query(paris)", "france")})
+            writer = weights.to_gz_file(os.path.join(directory, "missing", "out.gz"), background=True)
+            self.assertRaises(RuntimeError, writer.wait)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_binary_file(self):
+        '''Checks that weights survive the conversion to the binary format and back, and that the mapped binary
+        file holds the same weights.'''
+        directory = tempfile.mkdtemp()
+        try:
+            weights = FeatureVector()
+            weights.from_file("decoder_test/weights.init")
+            text_to_binary("decoder_test/weights.init", os.path.join(directory, "weights.bin"))
+            mapped = map_binary_file(os.path.join(directory, "weights.bin"))
+            self.assertEqual(mapped, weights)
+            binary_to_text(os.path.join(directory, "weights.bin"), os.path.join(directory, "weights.txt"))
+            converted = FeatureVector()
+            converted.from_file(os.path.join(directory, "weights.txt"))
+            self.assertEqual(converted, weights)
+            indexed = IndexedFeatureVector()
+            indexed.from_binary_file(os.path.join(directory, "weights.bin"))
+            indexed.to_binary_file(os.path.join(directory, "indexed.bin"))
+            self.assertEqual(open(os.path.join(directory, "indexed.bin"), "rb").read(),
+                             open(os.path.join(directory, "weights.bin"), "rb").read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_vector_kernels(self):
+        '''Checks the non-mutating and in place operators, axpy, dot, the norms, clip and prune with the lazy scale
+        factor of FeatureVector and with IndexedFeatureVector.'''
+        for vector_class in (FeatureVector, IndexedFeatureVector, HashedFeatureVector):
+            w = vector_class()
+            w.from_string("test1=1.0 test2=-2.0")
+            delta = FeatureVector()
+            delta.from_string("test2=1.0 test3=4.0")
+            self.assertEqual(sorted(w + 0.5 * delta), [("test1", 1.0), ("test2", -1.5), ("test3", 2.0)])
+            self.assertEqual(sorted(delta), [("test2", 1.0), ("test3", 4.0)])
+            w *= 0.5
+            w.axpy(2.0, delta)
+            self.assertEqual(sorted(w), [("test1", 0.5), ("test2", 1.0), ("test3", 8.0)])
+            self.assertEqual(w.dot(delta), 33.0)
+            self.assertEqual(delta.dot(w), 33.0)
+            self.assertEqual(w.l1_norm(), 9.5)
+            self.assertEqual(w.l2_norm(), 65.25 ** 0.5)
+            w.clip(4.0).prune(0.5)
+            self.assertEqual(sorted(w), [("test2", 1.0), ("test3", 4.0)])
+
+    def test_hashed_feature_vector(self):
+        '''Checks that the hashed feature space keeps its size and that parsing, arithmetic, rescoring and Adadelta
+        give the same values as without hashing while no names collide.'''
+        vocab = HashedFeatureVocabulary(4, collisions=True)
+        vector = HashedFeatureVector(vocab)
+        for i in range(2):
+            vector.from_string(" ".join("RuleIdentity_%d=1.0" % i for i in range(100)))
+        self.assertEqual(len(vocab), 16)
+        self.assertTrue(len(vector) <= 16 and len(vocab.names) <= 16)
+        report = vocab.collision_report()
+        self.assertEqual(sum(len(names) - 1 for names in report["collisions"].values()) + report["ids"], 100)
+        # every value is the sum of the signed values of the names sharing its id
+        self.assertEqual(vector.l1_norm(), sum(abs(sum(vocab.hash(name)[1] for name in names))
+                                               for names in report["collisions"].values()) +
+                         report["ids"] - report["shared"])
+
+        vocab = HashedFeatureVocabulary(20)
+        gradient = FeatureVector()
+        gradient.from_string("test1=-3.9722 test2=2.5")
+        hashed = HashedFeatureVector(vocab)
+        hashed.from_string("test1=-3.9722 test2=2.5")
+        self.assertEqual(hashed.dict, gradient.dict)
+        self.assertEqual((hashed + gradient).dict, (gradient + gradient).dict)
+        self.assertEqual(hashed.top(1), [("test1", -3.9722)])
+        adadelta = IndexedAdadelta(vocab=vocab)
+        self.assertEqual(adadelta.update(hashed).dict, Adadelta().update(gradient).dict)
+        self.assertEqual(len(adadelta.accum_grad), 1 << 20)
+        lines = ["0 ||| a b ||| test1=1.0 test2=1.0 ||| -1.0", "0 ||| a c ||| test1=2.0 ||| -2.0"]
+        self.assertEqual(list(KBestList(read_kbest(lines), vocab).scores(gradient)),
+                         list(KBestList(read_kbest(lines)).scores(gradient)))
+
+    def test_hashed_collisions(self):
+        '''Checks that weights files written from hashed weights give every name of cdec's output sharing an id the
+        weight the model scores it with, also for names seen after the id's value was written, while the vocabulary
+        only keeps the first name of every id.'''
+        vocab = HashedFeatureVocabulary(2)
+        names = {}
+        for name in ("F%d" % i for i in range(10)):
+            names.setdefault(vocab.hash(name)[0], []).append(name)
+        (first, second) = max(names.values(), key=len)[:2]
+        weights = HashedFeatureVector(vocab, dense=True)
+        weights.from_string("%s=0.5" % first)
+        directory = tempfile.mkdtemp()
+        try:
+            weights_file = decoder.WeightsFile(weights, directory)
+            features = FeatureVector()
+            features.from_string("%s=1.0 %s=1.0" % (first, second))
+            encoded = HashedFeatureVector(vocab)
+            encoded += features
+            self.assertEqual(weights_file.update(weights), 0)
+            self.assertEqual(weights_file.update(weights, names=[first, second]), 1)
+            self.assertEqual(weights_file.update(weights, names=[first, second]), 0)
+            i = vocab.hash(first)[0]
+            for value in (0.5, -0.25):
+                weights.values[i] = value
+                weights_file.update(weights)
+                written = FeatureVector()
+                written.from_file(weights_file.path)
+                expected = dict((name, vocab.hash(name)[1] * value) for name in (first, second))
+                self.assertEqual(written.dict, expected)
+                self.assertAlmostEqual(written.dot(features), weights.dot(encoded))
+            self.assertEqual((vocab.names[i], vocab.collisions, len(vocab.take_recorded()), vocab.recorded),
+                             (first, None, 1, []))
+            self.assertEqual(dict(_named(vocab, weights.values)), {first: expected[first]})
+            recording = HashedFeatureVocabulary(2, collisions=True)
+            recording.encode(list(features))
+            self.assertEqual(dict(_named(recording, weights.values)), expected)
+            weights_file.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_instrumentation(self):
+        '''Checks that the hooks record timers and counters only while instrumentation is enabled.'''
+        gradient = FeatureVector()
+        gradient.from_string("test1=-3.9722 test2=2.5")
+        cache = Cache()
+        instrumentation.reset()
+        try:
+            instrumentation.enable()
+            Adadelta().update(gradient)
+            cache.get("where is paris ?")
+            decoder.per_sentence_bleu("the river", ["the river"])
+            list(read_kbest(["0 ||| the river ||| LanguageModel=-2.5 WordPenalty=-0.86 ||| -2.1"]))[0].features
+            instrumentation.disable()
+            Adadelta().update(gradient)
+            snapshot = instrumentation.snapshot()
+            self.assertEqual(snapshot["timers"]["adadelta.update"]["calls"], 1)
+            self.assertEqual(snapshot["timers"]["bleu.per_sentence_bleu"]["calls"], 1)
+            self.assertEqual(snapshot["counters"], {"adadelta.features_updated": 2, "cache.misses": 1,
+                                                    "feature_vector.features_parsed": 2,
+                                                    "translation.features_parsed": 1,
+                                                    "translation.lines_parsed": 1})
+            merged = instrumentation.merge([snapshot, snapshot])
+            self.assertEqual(merged["timers"]["adadelta.update"]["calls"], 2)
+            self.assertEqual(merged["counters"]["cache.misses"], 2)
+            self.assertTrue("cache.misses=1" in instrumentation.log_line(snapshot))
+        finally:
+            instrumentation.disable()
+            instrumentation.reset()
 
     def test_persentence_bleu(self):
         '''For a few special cases the per sentence BLEU values (Nakov et al, 2012) are computed and verified.'''
@@ -47,6 +495,195 @@ class TestNLPminion(unittest.TestCase):
         sent = "in in how many places can i go climbing in paris ?"
         ref = "in how many spots can i go climbing in paris ?"
         self.assertEqual(decoder.per_sentence_bleu(sent, [ref], 1), 0.8333333333333335)
+        # test clipping against several references
+        sent = "in in how many places can i go climbing in paris ?"
+        ref = ["in in how many spots can i go climbing in ?", "in how many places can i go climbing in paris ?"]
+        self.assertEqual(decoder.per_sentence_bleu(sent, ref, 1), 1.0)
+        # test a precomputed reference index
+        index = decoder.ReferenceIndex(ref, 4)
+        self.assertEqual(decoder.per_sentence_bleu(sent, index, 4), decoder.per_sentence_bleu(sent, ref, 4))
+
+    def test_persentence_bleu_batch(self):
+        '''Checks that scoring a list of hypotheses at once gives exactly the per sentence BLEU values.'''
+        ref = ["in how many spots can i go climbing in paris ?", "in how many places can i go climbing in paris ?"]
+        sents = ["at how many places can i go climbing in paris ?", "this is a completely different string !",
+                 "in in how many places can i go climbing in paris ?", "paris", ""]
+        for n in (1, 4):
+            expected = [decoder.per_sentence_bleu(sent, ref, n) for sent in sents]
+            self.assertEqual(list(decoder.per_sentence_bleu_batch(sents, ref, n)), expected)
+        translation = Translation("0 ||| %s ||| test1=1.0 ||| -1.0" % sents[0])
+        self.assertEqual(list(decoder.per_sentence_bleu_batch([translation], decoder.ReferenceIndex(ref))),
+                         [decoder.per_sentence_bleu(sents[0], ref)])
+
+    def test_corpus_bleu(self):
+        '''Checks the in-process corpus BLEU and that adding and removing sentences updates it correctly.'''
+        corpus = decoder.corpus_bleu([["a b c d f"]], ["a b c d e"])
+        self.assertAlmostEqual(corpus.score(), (4.0 / 5 * 3.0 / 4 * 2.0 / 3 * 1.0 / 2) ** 0.25)
+        self.assertEqual(str(corpus), "0.66874")
+        score = corpus.score()
+        short = decoder.BleuStats("a b c", ["a b c d e f", "x y z"])
+        self.assertEqual(short.ref_len, 3)
+        corpus.add(short)
+        self.assertAlmostEqual(corpus.score(), (7.0 / 8 * 5.0 / 6 * 3.0 / 4 * 1.0 / 2) ** 0.25)
+        corpus.remove(short)
+        self.assertAlmostEqual(corpus.score(), score)
+        corpus.replace(decoder.BleuStats("a b c d e", ["a b c d f"]), decoder.BleuStats("a b c d f", ["a b c d f"]))
+        self.assertAlmostEqual(corpus.score(), 1.0)
+
+    def test_file_bleu(self):
+        '''Checks the file-based drop-in for cdec's fast_score against hand-computed statistics: clipped n-gram
+        matches 8/9, 5/7, 3/5 and 1/3, and a reference length equal to the hypothesis length of 9.'''
+        directory = tempfile.mkdtemp()
+        try:
+            references = os.path.join(directory, "refs")
+            hypotheses = os.path.join(directory, "hyps")
+            f = open(references, "w")
+            f.write("a b c d f ||| a b c x e g\nx y z v\n")
+            f.close()
+            f = open(hypotheses, "w")
+            f.write("a b c d e\nx y z w\n")
+            f.close()
+            bleu = decoder.file_bleu(references, hypotheses)
+            self.assertEqual(bleu, "0.596949\n")
+            self.assertAlmostEqual(float(bleu), (8.0 / 9 * 5.0 / 7 * 3.0 / 5 * 1.0 / 3) ** 0.25, places=6)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_read_kbest(self):
+        '''Checks that cdec k-best output is parsed lazily into Translation objects, optionally grouped by sentence.'''
+        lines = ["0 ||| a b ||| test1=1.0 ||| -1.0\n", "0 ||| a c ||| test1=2.0 ||| -2.0\n",
+                 "1 ||| d ||| test2=1.0 ||| -0.5\n"]
+        translations = read_kbest(lines)
+        self.assertEqual(next(translations).string, "a b")
+        self.assertEqual([translation.decoder_score for translation in translations], [-2.0, -0.5])
+        kbest = list(read_kbest(lines, group=True))
+        self.assertEqual([[translation.idval for translation in sentence] for sentence in kbest], [["0", "0"], ["1"]])
+        self.assertEqual(kbest[0][1].features.dict, {"test1": 2.0})
+        self.assertFalse(hasattr(kbest[1][0], "__dict__"))
+        # Translations survive pickling with every protocol, with their features parsed or not
+        kbest[0][1].bleu_score = 0.5
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for translation in (kbest[0][0], kbest[0][1]):
+                copy = pickle.loads(pickle.dumps(translation, protocol))
+                self.assertEqual((copy.idval, copy.string, copy.decoder_score, copy.bleu_score),
+                                 (translation.idval, translation.string, translation.decoder_score,
+                                  translation.bleu_score))
+                self.assertEqual(copy.features, translation.features)
+
+    def test_kbest_list(self):
+        '''Checks rescoring a k-best list of two sentences under new weights, the ranks and hope/fear selection.'''
+        lines = ["0 ||| a b ||| test1=1.0 test2=1.0 ||| -1.0", "0 ||| a c ||| test1=2.0 ||| -2.0",
+                 "1 ||| d ||| test2=1.0 ||| -0.5", "1 ||| e ||| test1=1.0 test3=4.0 ||| -0.6"]
+        kbest = KBestList(read_kbest(lines))
+        weights = FeatureVector()
+        weights.from_string("test1=0.5 test2=-1.0")
+        self.assertEqual(list(kbest.rescore(weights)), [-0.5, 1.0, -1.0, 0.5])
+        self.assertEqual([t.decoder_rank for t in kbest.translations], [1, 0, 1, 0])
+        self.assertEqual([t.decoder_ori for t in kbest.translations], [-1.0, -2.0, -0.5, -0.6])
+        for translation, bleu in zip(kbest.translations, [1.0, 0.0, 1.0, 0.0]):
+            translation.bleu_score = bleu
+        kbest.rank()
+        self.assertEqual([t.bleu_rank for t in kbest.translations], [0, 1, 0, 1])
+        self.assertEqual([(hope.string, fear.string) for hope, fear in kbest.hope_fear(2.0)], [("a b", "a c"),
+                                                                                             ("d", "e")])
+
+    def test_translation_cache(self):
+        '''Checks that repeated translations are served from memory or disk and that changing the weights file
+        drops its memoized translations. echo stands in for cdec, it outputs its arguments.'''
+        directory = tempfile.mkdtemp()
+        try:
+            weights = os.path.join(directory, "weights")
+            shutil.copy("decoder_test/weights.init", weights)
+            memo = decoder.TranslationCache(capacity=1, path=os.path.join(directory, "memo.db"))
+            out = memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "a sentence")
+            self.assertEqual(out, "-c decoder_test/cdec.ini -w %s\n" % weights)
+            memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "a sentence")
+            memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "another sentence")
+            self.assertEqual(memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "a sentence"), out)
+            self.assertEqual((memo.memory.hits, memo.disk.hits), (1, 1))
+            f = open(weights, "a")
+            f.write("NewFeature 1.0\n")
+            f.close()
+            os.utime(weights, (0, 0))
+            memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "a sentence")
+            self.assertEqual((memo.memory.hits, memo.disk.hits, len(memo.disk.dict)), (1, 1, 1))
+            # only the entries of the changed weights are dropped, from memory and disk
+            memo.memory.capacity = 10
+            other = os.path.join(directory, "other")
+            shutil.copy("decoder_test/weights.init", other)
+            kept = memo.key("decoder_test/cdec.ini", other, "a sentence")
+            memo.translate_sentence("echo", "decoder_test/cdec.ini", other, "a sentence")
+            memo.translate_sentence("echo", "decoder_test/cdec.ini", weights, "another sentence")
+            f = open(weights, "a")
+            f.write("OtherFeature 1.0\n")
+            f.close()
+            os.utime(weights, (1, 1))
+            key = memo.key("decoder_test/cdec.ini", weights, "a sentence")
+            self.assertEqual((list(memo.memory.dict), sorted(memo.disk.dict)), ([kept], [kept]))
+            self.assertEqual(list(memo.keys), [kept.split()[0]])
+            self.assertNotEqual(key, kept)
+            memo.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_weights_file(self):
+        '''Checks that a WeightsFile holds the same weights as to_file writes, that only changed weights cause a new
+        version and that cached translations and decoder sessions follow its versions, with decoder_test/fake_cdec
+        standing in for cdec.'''
+        directory = tempfile.mkdtemp()
+        try:
+            weights = FeatureVector()
+            weights.from_file("decoder_test/weights.init")
+            weights_file = decoder.WeightsFile(weights, directory)
+            written = FeatureVector()
+            written.from_file(weights_file.path)
+            self.assertEqual((written, weights_file.version), (weights, 1))
+            inode = os.stat(weights_file.path).st_ino
+            self.assertEqual(weights_file.update(weights), 0)
+            self.assertEqual((os.stat(weights_file.path).st_ino, weights_file.version), (inode, 1))
+            (key, other) = sorted(weights.dict)[:2]
+            weights.dict[key] += 1.0
+            del weights.dict[other]
+            self.assertEqual(weights_file.update(weights), 2)
+            weights.dict["NewFeature"] = 0.5
+            self.assertEqual(weights_file.update(weights, changed=["NewFeature"]), 1)
+            written = FeatureVector()
+            written.from_file(weights_file.path)
+            self.assertEqual((written, weights_file.version), (weights, 3))
+            # an indexed vector with the same weights leaves the file as it is, the hashed one lacks the 0.25 the
+            # indexed one added; changes of both are then found by comparing the values of their ids
+            vectors = (IndexedFeatureVector(dense=True), HashedFeatureVector(HashedFeatureVocabulary(bits=8)))
+            for indexed, changes in zip(vectors, (0, 1)):
+                indexed += weights
+                self.assertEqual(weights_file.update(indexed), changes)
+                update = FeatureVector()
+                update.from_string("NewFeature=0.25")
+                indexed += update
+                self.assertEqual(weights_file.update(indexed), 1)
+                written = FeatureVector()
+                written.from_file(weights_file.path)
+                self.assertEqual(sorted(written.dict), sorted(key for key, val in indexed))
+                for key, val in indexed:
+                    self.assertAlmostEqual(written.dict[key], val)
+            sentence = "where are restaurants in edinburgh"
+            memo = decoder.TranslationCache()
+            session = decoder.DecoderSession("decoder_test/fake_cdec", "decoder_test/cdec.ini", weights_file, 2)
+            before = memo.translate_sentence("decoder_test/fake_cdec", "decoder_test/cdec.ini", weights_file,
+                                             sentence, 2)
+            self.assertEqual(session.translate_sentence(sentence), before)
+            weights.dict["LanguageModel"] = 2.0
+            weights_file.update(weights)
+            after = decoder.translate_sentence("decoder_test/fake_cdec", "decoder_test/cdec.ini", weights_file,
+                                               sentence, 2)
+            self.assertNotEqual(after, before)
+            self.assertEqual(memo.translate_sentence("decoder_test/fake_cdec", "decoder_test/cdec.ini",
+                                                     weights_file, sentence, 2), after)
+            self.assertEqual(session.translate_sentence(sentence), after)
+            session.close()
+            weights_file.close()
+            self.assertFalse(os.path.exists(weights_file.path))
+        finally:
+            shutil.rmtree(directory)
 
     def test_decoder_pipeline(self):
         '''Checks if the decoding procedures work without issues.
@@ -60,6 +697,8 @@ class TestNLPminion(unittest.TestCase):
         translation_out.close()
         bleu = decoder.bleu("%s/mteval/fast_score" % self.decoder_path, "decoder_test/set.ref",
                             "decoder_test/output-translation.tmp").strip()
+        self.assertEqual(decoder.file_bleu("decoder_test/set.ref", "decoder_test/output-translation.tmp").strip(),
+                         bleu)
         os.remove("decoder_test/output-translation.tmp")
         self.assertEqual(bleu, '0.296757')
         translation_out = open("decoder_test/output-translation.tmp", 'w')
@@ -69,6 +708,8 @@ class TestNLPminion(unittest.TestCase):
         translation_out.close()
         bleu = decoder.bleu("%s/mteval/fast_score" % self.decoder_path, "decoder_test/sentence.ref",
                             "decoder_test/output-translation.tmp").strip()
+        self.assertEqual(decoder.file_bleu("decoder_test/sentence.ref", "decoder_test/output-translation.tmp").strip(),
+                         bleu)
         os.remove("decoder_test/output-translation.tmp")
         self.assertEqual(bleu, '0.465954')
         translation_raw = decoder.translate_sentence("%s/decoder/cdec" % self.decoder_path,
@@ -78,5 +719,267 @@ class TestNLPminion(unittest.TestCase):
         self.assertEqual(translation.string, "where there are restaurants in edinburgh where smoking is not allowed ?")
         self.assertEqual(translation.decoder_score, -4.73151)
 
+    def test_decoder_session(self):
+        '''Checks that a persistent cdec process returns the same output as a call to translate_sentence and that it
+        recovers from a crashed cdec process.'''
+        sentence = '<seg grammar="decoder_test/grammar.1" id="1"> wo in edinburgh gibt es restaurants in denen das rauchen nicht erlaubt ist ? </seg>'
+        for kbest in (0, 2):
+            expected = decoder.translate_sentence("%s/decoder/cdec" % self.decoder_path, "decoder_test/cdec.ini",
+                                                  "decoder_test/weights.init", sentence, kbest)
+            session = decoder.DecoderSession("%s/decoder/cdec" % self.decoder_path, "decoder_test/cdec.ini",
+                                             "decoder_test/weights.init", kbest)
+            self.assertEqual(session.translate_sentence(sentence), expected)
+            session.proc.kill()
+            self.assertEqual(session.translate_sentence(sentence), expected)
+            session.close()
+            pool = decoder.DecoderPool("%s/decoder/cdec" % self.decoder_path, "decoder_test/cdec.ini",
+                                       "decoder_test/weights.init", kbest, 2)
+            self.assertEqual(pool.translate_sentences([sentence] * 3), [expected] * 3)
+            pool.close()
+
+    def test_decoder_session_sync(self):
+        '''Checks the k-best synchronisation of a persistent cdec process against decoder_test/fake_cdec, which
+        prints numeric ids like cdec and nothing for a sentence without a parse: the synchronisation sentences get
+        ids of their own, always parse and none of their lines end up in the output.'''
+        directory = tempfile.mkdtemp()
+        grammar = os.path.join(directory, "grammar")
+        f = open(grammar, "w")
+        f.write("[X] ||| where ||| where ||| F=1\n[X] ||| [X,1] are ||| [X,1] are ||| F=1\n")
+        f.close()
+        sentences = ['<seg id="3"> where are restaurants </seg>', "how many rivers",
+                     '<seg grammar="%s" id="4"> where are </seg>' % grammar,
+                     '<seg grammar="%s" id="5"> where are restaurants </seg>' % grammar,
+                     '<seg id="five"> where </seg>']
+        session = decoder.DecoderSession("decoder_test/fake_cdec", "decoder_test/cdec.ini", "decoder_test/weights.init",
+                                         3)
+        try:
+            for nl in sentences * 2:
+                out = session.translate_sentence(nl)
+                if nl.startswith("<seg"):
+                    expected = decoder.translate_sentence("decoder_test/fake_cdec", "decoder_test/cdec.ini",
+                                                          "decoder_test/weights.init", nl, 3)
+                    self.assertEqual(out, expected)
+                if 'id="5"' in nl:
+                    # restaurants has no rule in the grammar
+                    self.assertEqual(out, "")
+                    continue
+                ids = set(line.split(" ||| ", 1)[0] for line in out.splitlines())
+                self.assertEqual(len(ids), 1)
+                idval = ids.pop()
+                self.assertFalse(decoder._is_sync_id(idval))
+                if 'id="five"' in nl:
+                    self.assertEqual(idval, "0")
+        finally:
+            session.close()
+            shutil.rmtree(directory)
+        (sync_id, segment) = decoder._sync_segment(session.sync_count)
+        self.assertTrue(decoder._is_sync_id(sync_id))
+        self.assertFalse(decoder._is_sync_id("3"))
+        self.assertTrue(decoder._SYNC_WORD in open(decoder._sync_grammar_file()).read())
+        # without the hiero glue grammar the [X] rule of the synchronisation grammar only reaches goal=X, for another
+        # goal the session fails at start instead of waiting for the output of the first sentence forever
+        directory = tempfile.mkdtemp()
+        try:
+            ini = os.path.join(directory, "cdec.ini")
+            for goal, timeout in (("X", 10), ("S", 1)):
+                f = open(ini, "w")
+                f.write(open("decoder_test/cdec.ini").read() + "\nscfg_no_hiero_glue_grammar=true\ngoal=%s\n" % goal)
+                f.close()
+                if goal == "X":
+                    session = decoder.DecoderSession("decoder_test/fake_cdec", ini, "decoder_test/weights.init", 3,
+                                                     start_timeout=timeout)
+                    self.assertNotEqual(session.translate_sentence("how many rivers"), "")
+                    session.close()
+                else:
+                    self.assertRaises(RuntimeError, decoder.DecoderSession, "decoder_test/fake_cdec", ini,
+                                      "decoder_test/weights.init", 3, start_timeout=timeout)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_decoder_sharded(self):
+        '''Checks that decoding a file with several cdec processes returns the same output as a single cdec process,
+        both for 1-best and k-best output.'''
+        for kbest in (0, 2):
+            expected = decoder.translate("%s/decoder/cdec" % self.decoder_path, "decoder_test/cdec.ini",
+                                         "decoder_test/weights.init", "decoder_test/set.in", kbest)
+            sharded = decoder.translate("%s/decoder/cdec" % self.decoder_path, "decoder_test/cdec.ini",
+                                        "decoder_test/weights.init", "decoder_test/set.in", kbest, jobs=2)
+            self.assertEqual(sharded, expected)
+
+    def test_decoder_sharded_error(self):
+        '''Checks that an error in the thread of a shard is raised in the caller.'''
+        def shard_files():
+            return set(name for name in os.listdir(tempfile.gettempdir()) if name.startswith("nlpminion-shard-"))
+
+        before = shard_files()
+        self.assertRaises(OSError, decoder.translate, "decoder_test/missing_cdec", "decoder_test/cdec.ini",
+                          "decoder_test/weights.init", "decoder_test/set.in", jobs=2)
+        self.assertEqual(shard_files() - before, set())
+
+    def test_parallel_trainer(self):
+        '''Checks iterative parameter mixing and averaged minibatch gradients against single worker runs, with
+        decoder_test/fake_cdec standing in for cdec.'''
+        references = ["how many different works of art can i look at", "where are restaurants in which smoking",
+                      "is not allowed in edinburgh", "which city is the river in", "how many rivers are there",
+                      "where can i go climbing"]
+        sentences = [" ".join(reversed(ref.split())) for ref in references]
+        references = [[ref] for ref in references]
+        initial = FeatureVector()
+        initial.from_file("decoder_test/weights.init")
+
+        def train(sentences, references, **kwargs):
+            trainer = ParallelTrainer("decoder_test/fake_cdec", "decoder_test/cdec.ini", initial, kbest=10,
+                                      scale=20.0, **kwargs)
+            try:
+                return trainer.train(sentences, references).dict
+            finally:
+                trainer.close()
+
+        # one round of mixing averages what each worker learns alone on its shard
+        mixed = train(sentences, references, workers=2, sync=3, mixing="ipm")
+        alone = [train(sentences[w::2], references[w::2], workers=1, sync=3, mixing="ipm") for w in range(2)]
+        self.assertTrue(len(mixed) > len(initial.dict))
+        for key in mixed:
+            self.assertAlmostEqual(mixed[key], (alone[0].get(key, 0.0) + alone[1].get(key, 0.0)) / 2)
+        # the minibatch of two workers with two sentences each is the minibatch of one worker with four
+        parallel = train(sentences, references, workers=2, sync=2, mixing="minibatch")
+        single = train(sentences, references, workers=1, sync=4, mixing="minibatch")
+        self.assertEqual(sorted(parallel), sorted(single))
+        for key in parallel:
+            self.assertAlmostEqual(parallel[key], single[key])
+        self.assertNotEqual(parallel, initial.dict)
+        # the batches of sentences with <seg> markup and ids of their own are decoded like plain ones
+        segments = ['<seg grammar="decoder_test/missing_grammar" id="%d"> %s </seg>' % (100 + i, nl)
+                    for i, nl in enumerate(sentences)]
+        self.assertEqual(train(segments, references, workers=2, sync=2, mixing="minibatch"), parallel)
+        trainer = ParallelTrainer("decoder_test/missing_cdec", "decoder_test/cdec.ini", workers=2, sync=1)
+        self.assertRaises(RuntimeError, trainer.train, sentences, references)
+        trainer.close()
+        # a worker killed by a signal stops the training instead of leaving it waiting
+        directory = tempfile.mkdtemp()
+        try:
+            killer = os.path.join(directory, "cdec")
+            f = open(killer, "w")
+            f.write("#!/bin/sh\nkill -9 $PPID\n")
+            f.close()
+            os.chmod(killer, 0o755)
+            trainer = ParallelTrainer(killer, "decoder_test/cdec.ini", workers=2, sync=1)
+            self.assertRaises(RuntimeError, trainer.train, sentences, references)
+            trainer.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_parallel_trainer_names(self):
+        '''Checks that the workers decode with the weights of features only another worker has seen so far: in
+        minibatch mode all workers of a sync interval decode with the same weights files. A wrapper around
+        decoder_test/fake_cdec keeps a copy of every input and weights file it is called with.'''
+        references = ["how many different works of art can i look at", "which city is the river in",
+                      "where can i go climbing", "how many different works of art can i look at"]
+        sentences = [" ".join(reversed(ref.split())) for ref in references]
+        references = [[ref] for ref in references]
+        initial = FeatureVector()
+        initial.from_file("decoder_test/weights.init")
+        directory = tempfile.mkdtemp()
+        try:
+            cdec = os.path.join(directory, "cdec")
+            f = open(cdec, "w")
+            f.write("#!/usr/bin/env python\nimport os, shutil, sys\n"
+                    "out = os.path.join(%r, 'call.%%d' %% os.getpid())\n"
+                    "shutil.copy(sys.argv[sys.argv.index('-w') + 1], out + '.weights')\n"
+                    "shutil.copy(sys.argv[sys.argv.index('-i') + 1], out + '.in')\n"
+                    "os.execv(%r, sys.argv)\n" % (directory, os.path.abspath("decoder_test/fake_cdec")))
+            f.close()
+            os.chmod(cdec, 0o755)
+            trainer = ParallelTrainer(cdec, "decoder_test/cdec.ini", initial, workers=2, kbest=10, sync=1,
+                                      mixing="minibatch", scale=20.0)
+            trainer.train(sentences, references)
+            trainer.close()
+            calls = []
+            for name in os.listdir(directory):
+                if name.endswith(".in"):
+                    written = FeatureVector()
+                    written.from_file(os.path.join(directory, name[:-3] + ".weights"))
+                    calls.append((open(os.path.join(directory, name)).read(), written))
+            # the first worker decodes the first and third sentence, the second worker the second and the fourth,
+            # which repeats the first
+            third = [written for nl, written in calls if sentences[2] in nl]
+            repeated = [written for nl, written in calls if sentences[0] in nl]
+            self.assertEqual((len(calls), len(third), len(repeated)), (4, 1, 2))
+            self.assertTrue(len(third[0].dict) > min(len(written.dict) for written in repeated))
+            self.assertIn(third[0], repeated)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pipelined_trainer(self):
+        '''Checks that the pipelined trainer learns the same weights as a sequential learner when the weights may
+        not be stale, and that it runs with prefetching decoder threads and reports its stages' times.'''
+        references = ["how many different works of art can i look at", "where are restaurants in which smoking",
+                      "is not allowed in edinburgh", "which city is the river in", "how many rivers are there"]
+        sentences = [" ".join(reversed(ref.split())) for ref in references]
+        references = [[ref] for ref in references]
+        initial = FeatureVector()
+        initial.from_file("decoder_test/weights.init")
+        sequential = ParallelTrainer("decoder_test/fake_cdec", "decoder_test/cdec.ini", initial, workers=1,
+                                     kbest=10, sync=5, scale=20.0)
+        expected = sequential.train(sentences, references, epochs=2).dict
+        sequential.close()
+        for staleness, decoders in ((0, 1), (2, 2)):
+            trainer = PipelinedTrainer("decoder_test/fake_cdec", "decoder_test/cdec.ini", initial, kbest=10,
+                                       staleness=staleness, decoders=decoders, vocab=HashedFeatureVocabulary(20),
+                                       scale=20.0)
+            weights = dict(trainer.train(sentences, references, epochs=2))
+            self.assertEqual(sorted(trainer.stats()), ["decode", "score", "update"])
+            if staleness == 0:
+                self.assertEqual(sorted(weights), sorted(expected))
+                for key in expected:
+                    self.assertAlmostEqual(weights[key], expected[key])
+        trainer = PipelinedTrainer("decoder_test/missing_cdec", "decoder_test/cdec.ini", decoders=2)
+        self.assertRaises(RuntimeError, trainer.train, sentences, references)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "asyncio interface requires Python 3.7")
+    def test_async_decoder(self):
+        '''Checks that the asyncio interface returns the same output as the blocking calls, also through a pool of
+        cdec processes, and that a timed out call raises.'''
+        import asyncio
+        import async_decoder
+        sentence = '<seg grammar="decoder_test/grammar.1" id="1"> wo in edinburgh gibt es restaurants in denen das rauchen nicht erlaubt ist ? </seg>'
+        cdec = "%s/decoder/cdec" % self.decoder_path
+        expected = decoder.translate_sentence(cdec, "decoder_test/cdec.ini", "decoder_test/weights.init", sentence, 2)
+
+        loop = asyncio.new_event_loop()
+        try:
+            out = loop.run_until_complete(async_decoder.translate_sentence(
+                cdec, "decoder_test/cdec.ini", "decoder_test/weights.init", sentence, 2, asyncio.Semaphore(2)))
+            self.assertEqual(out, expected.decode("utf-8"))
+            pool = async_decoder.AsyncDecoderPool(cdec, "decoder_test/cdec.ini", "decoder_test/weights.init", 2)
+            self.assertEqual(loop.run_until_complete(pool.translate_sentences([sentence] * 3)), [out] * 3)
+            with self.assertRaises(asyncio.TimeoutError):
+                loop.run_until_complete(pool.translate_sentence(sentence, timeout=0))
+            loop.run_until_complete(pool.close())
+        finally:
+            loop.close()
+
+    def test_async_decoder_stub(self):
+        '''Checks the asyncio interface against decoder_test/fake_cdec with a Python 3 interpreter, as the tests
+        themselves run on Python 2: the same k-best output as the blocking calls, also through a pool of cdec
+        processes, a timed out call that raises and leaves a working session behind, and a configuration in which
+        the synchronisation sentence has no parse.'''
+        python3 = find_executable("python3")
+        if python3 is None:
+            self.skipTest("python3 not found")
+        proc = subprocess.Popen([python3, "-c", ASYNC_SCRIPT], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode == 3:
+            self.skipTest("python3 lacks a module: %s" % err.strip())
+        self.assertEqual(proc.returncode, 0, err)
+        result = json.loads(out)
+        (first, second) = result["expected"]
+        self.assertTrue(first.startswith("1 ||| ") and second.startswith("2 ||| "))
+        self.assertEqual(result["single"], [first, second])
+        self.assertEqual(result["pooled"], [first, second, first, second, second])
+        self.assertTrue(result["timed_out"])
+        # the synchronisation sentence has no parse without the hiero glue grammar, which start reports
+        self.assertIn("goal=X", result["sync_error"])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Parallel online learning: several worker processes decode their shard of the training data with cdec, score the
+k-best lists with per-sentence BLEU and compute hope/fear gradients, and the trainer merges their work at a fixed
+sync interval, either by iterative parameter mixing (McDonald et al., 2010) or by an Adadelta update with the
+gradient averaged over the minibatch of all workers.
+
+The weights live in a memory-mapped file that all processes map, so workers read them without any pickling. The
+feature space is a HashedFeatureVocabulary, which assigns every process the same ids without coordination. cdec
+reads them from a decoder.WeightsFile, which only formats the weights that changed since the previous sentence.
+
+Within one process, the PipelinedTrainer overlaps decoding the next sentences with scoring and learning from the
+current one.
+'''
+import os
+import re
+import shutil
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from timeit import default_timer
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import numpy as np
+import decoder
+import instrumentation
+from adadelta import IndexedAdadelta
+from feature_vector import FeatureVector, IndexedFeatureVector, FeatureVocabulary, HashedFeatureVocabulary
+from translation import KBestList, read_kbest
+
+MIXING = ("ipm", "minibatch")
+
+# the number of seconds between checks that the workers are still running while the trainer waits for results
+POLL_INTERVAL = 1.0
+
+
+class ParallelTrainer(object):
+    '''
+    Trains weights with hope/fear updates on several worker processes. Each sync interval every worker processes
+    its next sync sentences:
+
+    - "ipm": the worker starts from the shared weights, updates its own copy after every sentence with its own
+      Adadelta and hands back the result; the shared weights become the average of the workers' weights.
+    - "minibatch": the worker decodes all its sentences at once with the shared weights and hands back the summed
+      gradient; the shared weights get one Adadelta update with the gradient averaged over all sentences.
+
+    The workers also hand back the feature names they have seen for the first time, which the trainer passes on to
+    all workers with their next sentences, so that every worker's cdec gets the weights of features only another
+    worker has seen so far.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights=None, workers=2, kbest=100, sync=10, mixing="ipm", bits=20,
+                 scale=1.0, rho=0.95, epsilon=1.0e-6):
+        '''
+        Prepares the shared weights, the workers are started by train.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: the initial weights as FeatureVector, zero by default
+        :param workers: the number of worker processes
+        :param kbest: the size of the kbest lists
+        :param sync: the number of sentences every worker processes between two merges
+        :param mixing: "ipm" for iterative parameter mixing, "minibatch" for averaged minibatch gradients
+        :param bits: the hashed feature space has 2^bits dimensions
+        :param scale: factor the BLEU scores are multiplied with to select hope and fear
+        :param rho: Adadelta's decay constant
+        :param epsilon: Adadelta's constant that ensures non-zero denominator
+        '''
+        if mixing not in MIXING:
+            raise ValueError("unknown mixing %s" % mixing)
+        if workers < 1 or sync < 1:
+            raise ValueError("workers and sync must be at least 1")
+        self.decoder_bin = decoder_bin
+        self.ini = ini
+        self.workers = workers
+        self.kbest = kbest
+        self.sync = sync
+        self.mixing = mixing
+        self.scale = scale
+        self.rho = rho
+        self.epsilon = epsilon
+        self.vocab = HashedFeatureVocabulary(bits)
+        self.adadelta = IndexedAdadelta(rho, epsilon, self.vocab)
+        # on a memory file system if there is one, so that the mapped pages are never written to a disk
+        self.directory = tempfile.mkdtemp(prefix="nlpminion-train-", dir="/dev/shm" if os.path.isdir("/dev/shm")
+                                          else None)
+        self.path = os.path.join(self.directory, "weights")
+        self.weights = np.memmap(self.path, dtype=np.float64, mode="w+", shape=(len(self.vocab),))
+        if weights is not None:
+            initial = IndexedFeatureVector(self.vocab, dense=True)
+            initial += weights
+            self.weights[:] = initial.values
+        self.rounds = 0
+        # the latest instrumentation snapshot of every worker, if instrumentation is enabled
+        self.snapshots = {}
+
+    def train(self, sentences, references, epochs=1):
+        '''
+        Trains on a data set. The sentences are dealt out to the workers in turn.
+
+        :param sentences: list of natural language strings to be translated, optionally with <seg> markup
+        :param references: list of the sentences' true translation options, each a list of strings
+        :param epochs: the number of passes over the data set
+        :return: the weights as FeatureVector
+        '''
+        shards = [[(sentences[i], references[i]) for i in range(w, len(sentences), self.workers)]
+                  for w in range(self.workers)]
+        config = dict((key, getattr(self, key)) for key in ("decoder_bin", "ini", "kbest", "mixing", "scale", "rho",
+                                                            "epsilon", "vocab", "path", "directory"))
+        commands = [multiprocessing.Queue() for _ in range(self.workers)]
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_worker, args=(w, config, shards[w], commands[w], results))
+                     for w in range(self.workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        try:
+            # the names the workers handed back in the last sync interval
+            names = []
+            for epoch in range(epochs):
+                for start in range(0, max(len(shard) for shard in shards), self.sync):
+                    active = [w for w in range(self.workers) if start < len(shards[w])]
+                    for w in active:
+                        commands[w].put((start, start + self.sync, names))
+                    names = self._merge(self._collect(results, processes, len(active)))
+            for command in commands:
+                command.put(None)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        return self.to_feature_vector()
+
+    def _collect(self, results, processes, n):
+        '''
+        Waits for the results of a sync interval. The queue is polled, so that a worker that died without handing
+        back its result, e.g. killed by a signal or for lack of memory, is noticed instead of waited for forever.
+
+        :param results: the queue of (worker, status, payload) tuples
+        :param processes: list of the workers' processes
+        :param n: the number of results
+        :return: list of n (worker, status, payload) tuples
+        '''
+        collected = []
+        while len(collected) < n:
+            try:
+                collected.append(results.get(timeout=POLL_INTERVAL))
+            except Queue.Empty:
+                dead = [(w, process.exitcode) for w, process in enumerate(processes) if not process.is_alive()]
+                if dead:
+                    raise RuntimeError("worker %s terminated with exit code %s" % dead[0])
+        return collected
+
+    def _merge(self, results):
+        '''
+        Combines the workers' results of a sync interval into the shared weights.
+
+        :param results: list of (worker, status, payload) tuples
+        :return: list of the feature names the workers have seen for the first time
+        '''
+        for w, status, payload in results:
+            if status == "error":
+                raise RuntimeError("worker %s failed:\n%s" % (w, payload))
+        self.rounds += 1
+        new = []
+        for w, status, (count, names, snapshot, data) in results:
+            for name in names:
+                self.vocab.record(self.vocab.lookup(name), name)
+            new.extend(names)
+            if snapshot is not None:
+                self.snapshots[w] = snapshot
+        # the names are passed on from the workers' results, a log of the trainer's would only grow
+        self.vocab.take_recorded()
+        if self.mixing == "ipm":
+            mixed = np.zeros(len(self.vocab))
+            for w, status, (count, names, snapshot, data) in results:
+                mixed += np.memmap(data, dtype=np.float64, mode="r", shape=(len(self.vocab),))
+            self.weights[:] = mixed / len(results)
+            return new
+        total = IndexedFeatureVector(self.vocab)
+        sentences = 0
+        for w, status, (count, names, snapshot, (ids, values)) in results:
+            gradient = IndexedFeatureVector(self.vocab)
+            (gradient.ids, gradient.values) = (ids, values)
+            total += gradient
+            sentences += count
+        if sentences == 0 or len(total) == 0:
+            return new
+        total *= 1.0 / sentences
+        delta = self.adadelta.update(total)
+        self.weights[delta.ids] += delta.values
+        return new
+
+    def to_feature_vector(self):
+        '''
+        :return: the current weights as FeatureVector, named by the first name of every hashed feature; weights of
+        hashed features no process has seen a name for are left out
+        '''
+        weights = FeatureVector()
+        weights.dict = dict(_named(self.vocab, self.weights))
+        return weights
+
+    def to_file(self, out_file, sep=" "):
+        '''
+        Writes the current weights to a file like FeatureVector.to_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        '''
+        self.to_feature_vector().to_file(out_file, sep)
+
+    def close(self):
+        '''
+        Deletes the memory-mapped files.
+        '''
+        self.weights = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class PipelinedTrainer(object):
+    '''
+    Online hope/fear learning in one process, with decoding overlapped with learning. Three stages are connected by
+    bounded queues:
+
+    - decode: decoder threads decode the next sentences ahead of time, each with its own cdec call;
+    - score: a thread scores every k-best list with per-sentence BLEU and computes the hope/fear gradient;
+    - update: the calling thread applies Adadelta updates to the weights, in the order of the sentences.
+
+    Sentence i is only decoded with weights that include at least i - staleness updates, so with staleness 0 the
+    result is that of a sequential learner, and with staleness 1 the next sentence is decoded while the current one
+    is being scored and learned from. Each stage's time spent working and stalled, waiting for its input, for room
+    in its output queue or for fresh enough weights, is reported by stats.
+    '''
+
+    def __init__(self, decoder_bin, ini, weights=None, kbest=100, staleness=1, decoders=1, queue_size=2,
+                 vocab=None, scale=1.0, rho=0.95, epsilon=1.0e-6):
+        '''
+        Initialises the weights and Adadelta.
+
+        :param decoder_bin: the location of the cdec script
+        :param ini: the cdec configuration file
+        :param weights: the initial weights as FeatureVector, zero by default
+        :param kbest: the size of the kbest lists
+        :param staleness: the number of updates the weights a sentence is decoded with may lack
+        :param decoders: the number of decoder threads, each running one cdec process at a time
+        :param queue_size: the capacity of the queues between the stages
+        :param vocab: the FeatureVocabulary or HashedFeatureVocabulary of the weights, a new FeatureVocabulary by
+        default
+        :param scale: factor the BLEU scores are multiplied with to select hope and fear
+        :param rho: Adadelta's decay constant
+        :param epsilon: Adadelta's constant that ensures non-zero denominator
+        '''
+        if staleness < 0 or decoders < 1 or queue_size < 1:
+            raise ValueError("staleness must be at least 0, decoders and queue_size at least 1")
+        self.decoder_bin = decoder_bin
+        self.ini = ini
+        self.kbest = kbest
+        self.staleness = staleness
+        self.decoders = decoders
+        self.queue_size = queue_size
+        self.scale = scale
+        self.vocab = FeatureVocabulary() if vocab is None else vocab
+        self.adadelta = IndexedAdadelta(rho, epsilon, self.vocab)
+        self.weights = IndexedFeatureVector(self.vocab, dense=True)
+        if weights is not None:
+            self.weights += weights
+        # the number of updates applied to the weights, guarded by the condition together with the weights
+        self.version = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.times = {}
+        self.times_lock = threading.Lock()
+
+    def train(self, sentences, references, epochs=1):
+        '''
+        Trains on a data set.
+
+        :param sentences: list of natural language strings to be translated, optionally with <seg> markup
+        :param references: list of the sentences' true translation options, each a list of strings
+        :param epochs: the number of passes over the data set
+        :return: the weights as IndexedFeatureVector
+        '''
+        items = [(sentences[i], references[i]) for _ in range(epochs) for i in range(len(sentences))]
+        # the i-th sentence is decoded by decoder thread i % decoders, whose queue the score stage reads in turn
+        decoded = [Queue.Queue(self.queue_size) for _ in range(self.decoders)]
+        scored = Queue.Queue(self.queue_size)
+        directory = tempfile.mkdtemp(prefix="nlpminion-pipeline-", dir="/dev/shm" if os.path.isdir("/dev/shm")
+                                     else None)
+        start = self.version
+        self.stopped.clear()
+        threads = [threading.Thread(target=self._decode, args=(t, items, start, decoded[t], directory))
+                   for t in range(self.decoders)]
+        threads.append(threading.Thread(target=self._score, args=(items, decoded, scored)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            for i in range(len(items)):
+                gradient = self._get("update", scored)
+                if isinstance(gradient, tuple):
+                    raise RuntimeError("pipeline stage failed:\n%s" % gradient[1])
+                began = default_timer()
+                with self.condition:
+                    if gradient is not None:
+                        self.weights += self.adadelta.update(gradient)
+                    self.version += 1
+                    self.condition.notify_all()
+                self._account("update", "busy", default_timer() - began)
+        finally:
+            self._stop(threads, decoded + [scored])
+            shutil.rmtree(directory, ignore_errors=True)
+        return self.weights
+
+    def stats(self):
+        '''
+        :return: a dictionary from stage ("decode", "score" and "update") to a dictionary with its seconds spent
+        "busy" and "stalled"; the decode stage adds up its threads
+        '''
+        with self.times_lock:
+            return dict((stage, dict(times)) for stage, times in self.times.items())
+
+    def to_file(self, out_file, sep=" "):
+        '''
+        Writes the current weights to a file like FeatureVector.to_file.
+
+        :param out_file: file to be written to
+        :param sep: the symbol that separates key and value
+        '''
+        self.weights.to_file(out_file, sep)
+
+    def _decode(self, t, items, start, out, directory):
+        '''
+        The decode stage of decoder thread t.
+
+        :param t: the thread's number
+        :param items: list of all (sentence, references) pairs of the run
+        :param start: the number of updates before the run
+        :param out: the queue the thread's k-best lists are put in
+        :param directory: the directory for the thread's weights file
+        '''
+        weights_file = decoder.WeightsFile(directory=directory)
+        names = None
+        try:
+            for i in range(t, len(items), self.decoders):
+                began = default_timer()
+                with self.condition:
+                    while self.version - start < i - self.staleness and not self.stopped.is_set():
+                        self.condition.wait()
+                    if self.stopped.is_set():
+                        return
+                    weights_file.update(self.weights, names=names)
+                self._account("decode", "stalled", default_timer() - began)
+                began = default_timer()
+                out_string = decoder.translate_sentence(self.decoder_bin, self.ini, weights_file, items[i][0],
+                                                        self.kbest)
+                translations = list(read_kbest(out_string.splitlines()))
+                if self.vocab.hashed:
+                    names = _feature_names(translations)
+                self._account("decode", "busy", default_timer() - began)
+                self._put("decode", out, translations)
+        except Exception:
+            self._put("decode", out, ("error", traceback.format_exc()))
+
+    def _score(self, items, decoded, out):
+        '''
+        The score stage.
+
+        :param items: list of all (sentence, references) pairs of the run
+        :param decoded: the decoder threads' queues
+        :param out: the queue the gradients are put in
+        '''
+        try:
+            for i in range(len(items)):
+                translations = self._get("score", decoded[i % self.decoders])
+                if translations is None:
+                    return
+                if isinstance(translations, tuple):
+                    self._put("score", out, translations)
+                    return
+                began = default_timer()
+                gradient = _gradient(translations, items[i][1], self.vocab, self.scale)
+                self._account("score", "busy", default_timer() - began)
+                self._put("score", out, gradient)
+        except Exception:
+            self._put("score", out, ("error", traceback.format_exc()))
+
+    def _stop(self, threads, queues):
+        '''
+        Stops the stages' threads: wakes the decoder threads waiting for fresh weights, makes room for the threads
+        waiting to put an item and hands None to the threads waiting for one.
+
+        :param threads: the stages' threads
+        :param queues: the queues between the stages
+        '''
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        while any(thread.is_alive() for thread in threads):
+            for queue in queues:
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                try:
+                    queue.put_nowait(None)
+                except Queue.Full:
+                    pass
+            for thread in threads:
+                thread.join(0.01)
+
+    def _get(self, stage, queue):
+        '''
+        Takes the next item from a queue, counting the wait as the stage's stall. Blocking calls without a timeout
+        are used throughout, as Python 2 implements waiting with a timeout by polling.
+
+        :param stage: the stage's name
+        :param queue: the queue
+        :return: the item, None once the pipeline is stopped
+        '''
+        began = default_timer()
+        item = queue.get()
+        self._account(stage, "stalled", default_timer() - began)
+        return None if self.stopped.is_set() else item
+
+    def _put(self, stage, queue, item):
+        '''
+        Puts an item in a queue, counting the wait for room as the stage's stall.
+
+        :param stage: the stage's name
+        :param queue: the queue
+        :param item: the item
+        '''
+        began = default_timer()
+        queue.put(item)
+        self._account(stage, "stalled", default_timer() - began)
+
+    def _account(self, stage, kind, seconds):
+        '''
+        Adds to a stage's busy or stalled time, and to the instrumentation timer pipeline.<stage>.<kind>.
+
+        :param stage: the stage's name
+        :param kind: "busy" or "stalled"
+        :param seconds: the time
+        '''
+        with self.times_lock:
+            times = self.times.setdefault(stage, {"busy": 0.0, "stalled": 0.0})
+            times[kind] += seconds
+        instrumentation.add_time("pipeline.%s.%s" % (stage, kind), seconds)
+
+
+def _named(vocab, values):
+    '''
+    :param vocab: a HashedFeatureVocabulary
+    :param values: an array with one value per id
+    :return: a list of (name, value) pairs of the ids with a non-zero value and a name, with every name if the
+    vocabulary records collisions
+    '''
+    ids = np.array(sorted(i for i in vocab.names if values[i] != 0.0), dtype=np.int64)
+    return vocab.decode(ids, np.asarray(values[ids]), every=True)
+
+
+def _worker(w, config, shard, commands, results):
+    '''
+    A worker process: processes the sentences of its shard that the trainer asks for and hands back its result,
+    until it receives None.
+
+    :param w: the worker's number
+    :param config: a dictionary of the trainer's settings
+    :param shard: list of the worker's (sentence, references) pairs
+    :param commands: the queue of (start, end, names) commands: the range of the shard to process and the feature
+    names the other workers have seen for the first time
+    :param results: the queue of (worker, status, payload) tuples
+    '''
+    vocab = config["vocab"]
+    size = len(vocab)
+    shared = np.memmap(config["path"], dtype=np.float64, mode="r", shape=(size,))
+    weights_file = decoder.WeightsFile(directory=config["directory"])
+    # a vector over the array the weights file is updated from
+    view = IndexedFeatureVector(vocab, dense=True)
+    data = os.path.join(config["directory"], "mixed.%d" % w)
+    adadelta = IndexedAdadelta(config["rho"], config["epsilon"], vocab)
+    # the names the trainer already knows
+    vocab.take_recorded()
+    # the feature names of the latest k-best lists, and the names sharing an id with another name that were handed
+    # to or received from the trainer
+    names = set()
+    aliases = set()
+    while True:
+        command = commands.get()
+        if command is None:
+            return
+        try:
+            (start, end, received) = command
+            for name in received:
+                vocab.record(vocab.lookup(name), name)
+            vocab.take_recorded()
+            aliases.update(name for name in received if vocab.names[vocab.lookup(name)] != name)
+            names.update(received)
+            seen = set()
+            batch = shard[start:end]
+            if config["mixing"] == "ipm":
+                weights = np.array(shared)
+                view.values = weights
+                for nl, refs in batch:
+                    weights_file.update(view, names=names)
+                    out = decoder.translate_sentence(config["decoder_bin"], config["ini"], weights_file, nl,
+                                                     config["kbest"])
+                    translations = list(read_kbest(out.splitlines()))
+                    names = _feature_names(translations)
+                    seen.update(names)
+                    gradient = _gradient(translations, refs, vocab, config["scale"])
+                    if gradient is not None:
+                        delta = adadelta.update(gradient)
+                        weights[delta.ids] += delta.values
+                local = np.memmap(data, dtype=np.float64, mode="w+", shape=(size,))
+                local[:] = weights
+                local.flush()
+                del local
+                payload = data
+            else:
+                view.values = shared
+                weights_file.update(view, names=names)
+                total = IndexedFeatureVector(vocab)
+                kbests = _translate_batch(config, weights_file, w, batch)
+                names = _feature_names([translation for kbest in kbests for translation in kbest])
+                seen = names
+                for kbest, (nl, refs) in zip(kbests, batch):
+                    gradient = _gradient(kbest, refs, vocab, config["scale"])
+                    if gradient is not None:
+                        total += gradient
+                payload = (total.ids, total.values)
+            # the first names of ids new to the worker and the names sharing an id it has not handed on yet
+            new = set(name for name in seen if vocab.names[vocab.lookup(name)] != name) - aliases
+            aliases.update(new)
+            new = [name for i, name in vocab.take_recorded()] + sorted(new)
+            snapshot = instrumentation.snapshot() if instrumentation.enabled else None
+            results.put((w, "ok", (len(batch), new, snapshot, payload)))
+        except Exception:
+            results.put((w, "error", traceback.format_exc()))
+
+
+def _translate_batch(config, weights_file, w, batch):
+    '''
+    Decodes a batch of sentences with one cdec call.
+
+    :param config: a dictionary of the trainer's settings
+    :param weights_file: the WeightsFile to decode with
+    :param w: the worker's number
+    :param batch: list of (sentence, references) pairs
+    :return: a list with the list of Translations of every sentence
+    '''
+    nl_file = os.path.join(config["directory"], "batch.%d" % w)
+    f = open(nl_file, "w")
+    # cdec's ids are the positions in the batch, ids of the sentences themselves are replaced
+    f.writelines(decoder._with_id("%s\n" % re.sub(r'^(\s*<seg[^>]*?)\s+id="[^"]*"', r'\1', nl), i)
+                 for i, (nl, refs) in enumerate(batch))
+    f.close()
+    out = decoder.translate(config["decoder_bin"], config["ini"], weights_file, nl_file, config["kbest"])
+    kbest = [[] for _ in batch]
+    for translation in read_kbest(out.splitlines()):
+        kbest[int(translation.idval)].append(translation)
+    return kbest
+
+
+def _feature_names(translations):
+    '''
+    :param translations: list of Translations
+    :return: the set of the names of their features
+    '''
+    return set(key for translation in translations for key, val in translation.feature_items())
+
+
+def _gradient(translations, references, vocab, scale):
+    '''
+    Selects hope and fear from a k-best list and computes the gradient of the ramp loss between them.
+
+    :param translations: list of the Translations of a sentence
+    :param references: the sentence's true translation options
+    :param vocab: the HashedFeatureVocabulary
+    :param scale: factor the BLEU scores are multiplied with
+    :return: the gradient as IndexedFeatureVector, None if hope and fear are the same or there is no translation
+    '''
+    if not translations:
+        return None
+    for translation, bleu in zip(translations, decoder.per_sentence_bleu_batch(translations, references).tolist()):
+        translation.bleu_score = bleu
+    (hope, fear) = KBestList(translations, vocab).hope_fear(scale)[0]
+    if hope is fear:
+        return None
+    gradient = IndexedFeatureVector(vocab)
+    gradient.axpy(1.0, fear.feature_items())
+    gradient.axpy(-1.0, hope.feature_items())
+    return gradient
\ No newline at end of file
@@ -1,13 +1,25 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from feature_vector import FeatureVector
+import numpy as np
+from feature_vector import FeatureVector, IndexedFeatureVector, vocabulary
+import instrumentation
 
 
-class Translation:
+class Translation(object):
     '''
     A object that stores a translation as returned by cdec.
+
+    The feature string is only parsed into a FeatureVector when features is first accessed, as most entries of a
+    k-best list are only ranked by their decoder score or BLEU. Setting vector_class to IndexedFeatureVector stores
+    the features against the shared feature vocabulary instead, setting it to HashedFeatureVector in the hashed
+    feature space of constant size.
     '''
 
+    vector_class = FeatureVector
+
+    __slots__ = ("idval", "string", "decoder_score", "bleu_score", "decoder_rank", "bleu_rank", "decoder_ori",
+                 "_features", "_features_raw")
+
     def __init__(self, kbest_entry):
         '''
         Expects an k-best list output entry from the cdec decoder. The string is split into its relevant parts
@@ -18,14 +30,204 @@ class Translation:
         self.decoder_rank = None
         self.bleu_rank = None
         self.decoder_ori = None
-        self.features = FeatureVector()
-        (self.idval, self.string, features_raw, self.decoder_score) = tuple(kbest_entry.strip().split(" ||| "))
-        self.decoder_score = float(self.decoder_score)
-        self.features.from_string(features_raw)
+        self._features = None
+        (self.idval, self.string, self._features_raw, decoder_score) = tuple(kbest_entry.strip().split(" ||| "))
+        self.decoder_score = float(decoder_score)
+
+    @property
+    def features(self):
+        '''
+        :return: the translation's features as a FeatureVector, parsed from cdec's output on first access
+        '''
+        if self._features is None:
+            self._features = self.vector_class()
+            self._features.from_string(self._features_raw)
+            self._features_raw = None
+            instrumentation.count("translation.features_parsed")
+        return self._features
+
+    @features.setter
+    def features(self, features):
+        '''
+        :param features: a FeatureVector replacing the translation's features
+        '''
+        self._features = features
+        self._features_raw = None
+
+    def feature_items(self):
+        '''
+        :return: a list of the translation's (name, value) feature pairs, without parsing them into a FeatureVector
+        '''
+        if self._features is not None:
+            return list(self._features)
+        return [(key, float(val)) for key, val in (feature.split("=") for feature in self._features_raw.split(" "))]
+
+    def __getstate__(self):
+        '''
+        Pickling support, which a class with __slots__ and without __dict__ lacks for pickle protocols below 2.
+
+        :return: a dictionary of the slots' values
+        '''
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__ if hasattr(self, slot))
+
+    def __setstate__(self, state):
+        '''
+        :param state: a dictionary as returned by __getstate__
+        '''
+        for slot, val in state.items():
+            setattr(self, slot, val)
 
     def __repr__(self):
         '''
         :return: A Translation objects representation
         '''
         return "<%s:%s:%s:%s:%s>" % (
-            self.string, self.decoder_score, self.bleu_score, self.decoder_rank, self.bleu_rank)
\ No newline at end of file
+            self.string, self.decoder_score, self.bleu_score, self.decoder_rank, self.bleu_rank)
+
+
+class KBestList(object):
+    '''
+    The Translations of one or several sentences together with their features as a sparse matrix in CSR layout
+    (indptr, indices, data) over a FeatureVocabulary, so that all hypotheses can be rescored under new weights
+    with one matrix-vector product. The Translations of a sentence are expected to be contiguous, as cdec
+    writes them.
+    '''
+
+    def __init__(self, translations, vocab=None):
+        '''
+        Builds the feature matrix.
+
+        :param translations: an iterable of Translation objects, e.g. as returned by read_kbest
+        :param vocab: the FeatureVocabulary mapping feature names to columns, the shared vocabulary by default
+        '''
+        self.translations = list(translations)
+        self.vocab = vocabulary if vocab is None else vocab
+        indptr = [0]
+        pairs = []
+        sentence = []
+        for translation in self.translations:
+            pairs.extend(translation.feature_items())
+            indptr.append(len(pairs))
+            if not sentence or sentence[-1][0] != translation.idval:
+                sentence.append((translation.idval, len(indptr) - 2))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        (self.indices, self.data) = self.vocab.encode(pairs)
+        self.rows = np.repeat(np.arange(len(self.translations)), np.diff(self.indptr))
+        # start offset of each sentence and the sentence number of each row
+        self.starts = np.array([start for idval, start in sentence], dtype=np.int64)
+        self.sentences = np.repeat(np.arange(len(self.starts)), np.diff(np.append(self.starts,
+                                                                                  len(self.translations))))
+
+    def scores(self, weights):
+        '''
+        :param weights: a FeatureVector or IndexedFeatureVector of weights
+        :return: an array with the model score of every hypothesis under the weights
+        '''
+        if isinstance(weights, IndexedFeatureVector) and weights.vocab is self.vocab:
+            (ids, values) = weights._items()
+        else:
+            (ids, values) = self.vocab.encode(list(weights), add=False)
+        dense = np.bincount(ids, weights=values, minlength=len(self.vocab))
+        return np.bincount(self.rows, weights=self.data * dense[self.indices], minlength=len(self.translations))
+
+    def rescore(self, weights):
+        '''
+        Sets the decoder_score of every Translation to its model score under the weights and updates the ranks.
+        The score cdec returned is kept in decoder_ori.
+
+        :param weights: a FeatureVector or IndexedFeatureVector of weights
+        :return: an array with the new scores
+        '''
+        scores = self.scores(weights)
+        for translation, score in zip(self.translations, scores.tolist()):
+            if translation.decoder_ori is None:
+                translation.decoder_ori = translation.decoder_score
+            translation.decoder_score = score
+        self.rank()
+        return scores
+
+    def rank(self):
+        '''
+        Sets decoder_rank and, if all Translations have a bleu_score, bleu_rank of every Translation to its position
+        within its sentence when sorted by descending score, starting at 0.
+        '''
+        decoder_ranks = self._ranks(np.array([t.decoder_score for t in self.translations], dtype=np.float64))
+        for translation, rank in zip(self.translations, decoder_ranks.tolist()):
+            translation.decoder_rank = rank
+        if any(t.bleu_score is None for t in self.translations):
+            return
+        bleu_ranks = self._ranks(np.array([t.bleu_score for t in self.translations], dtype=np.float64))
+        for translation, rank in zip(self.translations, bleu_ranks.tolist()):
+            translation.bleu_rank = rank
+
+    def hope_fear(self, scale=1.0):
+        '''
+        Selects for every sentence the hope hypothesis, maximising decoder score plus BLEU, and the fear hypothesis,
+        maximising decoder score minus BLEU. Requires the bleu_score of every Translation.
+
+        :param scale: factor the BLEU scores are multiplied with
+        :return: a list of (hope, fear) Translation pairs, one per sentence
+        '''
+        model = np.array([t.decoder_score for t in self.translations], dtype=np.float64)
+        bleu = scale * np.array([t.bleu_score for t in self.translations], dtype=np.float64)
+        hope = self._best(model + bleu)
+        fear = self._best(model - bleu)
+        return [(self.translations[h], self.translations[f]) for h, f in zip(hope.tolist(), fear.tolist())]
+
+    def _ranks(self, values):
+        '''
+        :param values: an array with one value per hypothesis
+        :return: an array with the position of each hypothesis within its sentence when sorted by descending value
+        '''
+        # the sort is stable, so ties keep cdec's order
+        order = np.lexsort((-values, self.sentences))
+        ranks = np.empty(len(values), dtype=np.int64)
+        ranks[order] = np.arange(len(values)) - self.starts[self.sentences[order]]
+        return ranks
+
+    def _best(self, values):
+        '''
+        :param values: an array with one value per hypothesis
+        :return: an array with the index of the hypothesis with the highest value of every sentence
+        '''
+        return np.nonzero(self._ranks(values) == 0)[0]
+
+    def __len__(self):
+        '''
+        :return: the number of hypotheses
+        '''
+        return len(self.translations)
+
+
+def read_kbest(stream, group=False):
+    '''
+    Lazily parses cdec k-best output, e.g. cdec's stdout while it is still decoding, so that only the current
+    sentence's k-best list has to be kept in memory.
+
+    :param stream: a file object or an iterable of lines in cdec's k-best format
+    :param group: if True, yields a list with all Translations of a sentence instead of single Translations
+    :return: a generator of Translation objects or lists of Translation objects
+    '''
+    if hasattr(stream, "readline"):
+        # iterating a file object directly reads ahead, which would block until cdec has written a full buffer
+        stream = iter(stream.readline, "")
+    kbest = []
+    lines = 0
+    try:
+        for line in stream:
+            if line.strip() == "":
+                continue
+            lines += 1
+            translation = Translation(line)
+            if not group:
+                yield translation
+            elif kbest and kbest[0].idval != translation.idval:
+                yield kbest
+                kbest = [translation]
+            else:
+                kbest.append(translation)
+        if kbest:
+            yield kbest
+    finally:
+        # counted once at the end, so that the per-line loop is not slowed down
+        instrumentation.count("translation.lines_parsed", lines)
\ No newline at end of file